@@ -162,8 +162,6 @@ def create_sample_files():
 
 def create_sample_index():
     """Create a sample search index."""
-    import pickle
-    
     # Create sample index data
     sample_index = {
         "index": {
@@ -246,27 +244,7 @@ def create_sample_index():
     
     print(f" Created sample index: {index_path}")
     
-    # Create TF-IDF vectors
-    tfidf_data = {
-        "document_vectors": {
-            "1F648A7F2C64458CBFAF463A071530ED": [0.8, 0.6, 0.3, 0.1, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
-            "6B3BD97C1234456789AB123456789ABC": [0.1, 0.0, 0.9, 0.8, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
-            "0F64A61C89AB4CDEF0123456789ABCDE": [0.2, 0.0, 0.0, 0.0, 0.9, 0.8, 0.0, 0.0, 0.0, 0.0],
-            "A1B2C3D4E5F678901234567890123456": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.9, 0.8, 0.0, 0.0],
-            "D4E5F678901234567890123456789012": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.9, 0.8]
-        },
-        "term_to_index": {
-            "search": 0, "engine": 1, "web": 2, "crawl": 3, 
-            "inform": 4, "retriev": 5, "tf": 6, "idf": 7, 
-            "cosin": 8, "similar": 9
-        }
-    }
-    
-    tfidf_path = os.path.join('data/index', 'tfidf_vectors.pkl')
-    with open(tfidf_path, 'wb') as f:
-        pickle.dump(tfidf_data, f)
-    
-    print(f" Created TF-IDF vectors: {tfidf_path}")
+    # TF-IDF vectors are built from the index by run_indexer.py (data/index/tfidf_matrix.*)
 
 if __name__ == "__main__":
     print(" CREATING GUARANTEED WORKING SAMPLE DATA")
@@ -279,7 +257,6 @@ if __name__ == "__main__":
     print("\n Files created:")
     print("    data/raw_html/ - 5 sample HTML files")
     print("    data/index/inverted_index.json - Search index")
-    print("    data/index/tfidf_vectors.pkl - TF-IDF vectors")
     
     print("\n Next steps:")
     print("1. Run: python run_indexer.py (to verify processing)")
@@ -5,7 +5,6 @@ Enhance the existing HTML files with better content extraction and fix metadata.
 
 import os
 import json
-import pickle
 from bs4 import BeautifulSoup
 from common.config import Config
 from common.logger import setup_logger
@@ -17,7 +16,7 @@ def enhance_html_files():
     config = Config()
     raw_html_dir = config.get('paths.data_raw')
     index_path = os.path.join(config.get('paths.data_index'), 'inverted_index.json')
-    tfidf_path = os.path.join(config.get('paths.data_index'), 'tfidf_vectors.pkl')
+    tfidf_manifest_path = os.path.join(config.get('paths.data_index'), 'tfidf_matrix.json')
     
     if not os.path.exists(index_path):
         print(" Index file not found")
@@ -101,13 +100,13 @@ def enhance_html_files():
     print(f" Enhanced {enhanced_count} documents!")
     
     # Also update TF-IDF vectors if they exist
-    if os.path.exists(tfidf_path):
+    if os.path.exists(tfidf_manifest_path):
         try:
-            with open(tfidf_path, 'rb') as f:
-                tfidf_data = pickle.load(f)
+            with open(tfidf_manifest_path, 'r', encoding='utf-8') as f:
+                tfidf_manifest = json.load(f)
             
             # The TF-IDF vectors don't need updating, just confirm they exist
-            print(f" TF-IDF vectors verified: {len(tfidf_data.get('document_vectors', {}))} documents")
+            print(f" TF-IDF vectors verified: {len(tfidf_manifest.get('documents', []))} documents")
             
         except Exception as e:
             print(f" Error with TF-IDF vectors: {e}")
@@ -5,8 +5,13 @@ Main script to run the indexer.
 
 import os
 import sys
+import csv
 import json
 import logging
+import argparse
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
 
 # Add src to Python path
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -18,6 +23,9 @@ try:
     from common.logger import setup_logger
     from src.indexer.inverted_index import InvertedIndex
     from src.indexer.tfidf_calculator import TFIDFCalculator
+    from src.indexer.segments import SegmentedIndex
+    from src.indexer.ann_index import ANNIndex
+    from src.indexer.neighbors import DocumentNeighbors
 except ImportError as e:
     print(f"Import error: {e}")
     print("Make sure all dependencies are installed and the project structure is correct.")
@@ -25,105 +33,282 @@ except ImportError as e:
 
 logger = setup_logger(__name__)
 
+def list_html_files(data_dir: str) -> List[str]:
+    """List raw HTML files in a stable order so builds are reproducible."""
+    if not os.path.exists(data_dir):
+        logger.warning(f"Raw HTML directory not found: {data_dir}")
+        return []
+    
+    return [os.path.join(data_dir, filename) for filename in sorted(os.listdir(data_dir))
+            if filename.endswith('.html')]
+
+def load_html_document(filepath: str):
+    """Load a single raw HTML file as a document dict (None on failure)."""
+    filename = os.path.basename(filepath)
+    document_id = filename.replace('.html', '')
+    
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            html_content = f.read()
+        
+        # Extract title from HTML
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html_content, 'html.parser')
+        title = soup.find('title')
+        title_text = title.get_text().strip() if title else f"Document {document_id}"
+        
+        # Extract clean text
+        for script in soup(["script", "style"]):
+            script.decompose()
+        text_content = soup.get_text()
+        lines = (line.strip() for line in text_content.splitlines())
+        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+        clean_content = ' '.join(chunk for chunk in chunks if chunk)
+        
+        logger.debug(f"Loaded document: {document_id} - {title_text}")
+        
+        return {
+            'document_id': document_id,
+            'content': clean_content,
+            'metadata': {
+                'url': f"file://{filepath}",
+                'title': title_text,
+                'filename': filename,
+                'last_modified': os.path.getmtime(filepath)
+            }
+        }
+        
+    except Exception as e:
+        logger.error(f"Error reading {filepath}: {str(e)}")
+        return None
+
 def load_documents_from_raw_html(data_dir: str):
     """Load documents from raw HTML files."""
     documents = []
     
-    if not os.path.exists(data_dir):
-        logger.warning(f"Raw HTML directory not found: {data_dir}")
-        return documents
-    
-    for filename in os.listdir(data_dir):
-        if filename.endswith('.html'):
-            filepath = os.path.join(data_dir, filename)
-            document_id = filename.replace('.html', '')
-            
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    html_content = f.read()
-                
-                # Extract title from HTML
-                from bs4 import BeautifulSoup
-                soup = BeautifulSoup(html_content, 'html.parser')
-                title = soup.find('title')
-                title_text = title.get_text().strip() if title else f"Document {document_id}"
-                
-                # Extract clean text
-                for script in soup(["script", "style"]):
-                    script.decompose()
-                text_content = soup.get_text()
-                lines = (line.strip() for line in text_content.splitlines())
-                chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                clean_content = ' '.join(chunk for chunk in chunks if chunk)
-                
-                documents.append({
-                    'document_id': document_id,
-                    'content': clean_content,
-                    'metadata': {
-                        'url': f"file://{filepath}",
-                        'title': title_text,
-                        'filename': filename
-                    }
-                })
-                
-                logger.debug(f"Loaded document: {document_id} - {title_text}")
-                
-            except Exception as e:
-                logger.error(f"Error reading {filepath}: {str(e)}")
+    for filepath in list_html_files(data_dir):
+        document = load_html_document(filepath)
+        if document:
+            documents.append(document)
     
     return documents
 
+def build_partial_index(filepaths: List[str]) -> InvertedIndex:
+    """Parse and index one shard of HTML files (runs inside a worker process)."""
+    partial_index = InvertedIndex()
+    
+    for filepath in filepaths:
+        document = load_html_document(filepath)
+        if document:
+            partial_index.add_document(document['document_id'], document['content'], document['metadata'])
+    
+    return partial_index
+
+def build_index_parallel(filepaths: List[str], num_workers: int) -> InvertedIndex:
+    """Build the index by sharding files across a process pool and merging the partials.
+    
+    Shards are contiguous runs of the sorted file list and are merged in order,
+    so the result is identical to adding the documents sequentially.
+    """
+    # A few shards per worker keeps the pool busy when documents vary in size
+    shard_count = min(len(filepaths), num_workers * 4)
+    shard_size = -(-len(filepaths) // shard_count)
+    shards = [filepaths[i:i + shard_size] for i in range(0, len(filepaths), shard_size)]
+    
+    logger.info(f"Building index from {len(filepaths)} files in {len(shards)} shards with {num_workers} workers...")
+    
+    inverted_index = InvertedIndex()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for partial_index in executor.map(build_partial_index, shards):
+            inverted_index.merge(partial_index)
+    
+    return inverted_index
+
+def load_tfidf_for_update(index_dir: str, segmented_index: SegmentedIndex):
+    """Load the index's TF-IDF matrix into memory for updating, or return None if there is no usable one.
+    
+    Call it before changing the index, while the index still matches the matrix's signature.
+    """
+    matrix_path = os.path.join(index_dir, 'tfidf_matrix')
+    if not os.path.exists(TFIDFCalculator.matrix_manifest_path(matrix_path)):
+        return None
+    
+    tfidf_calculator = TFIDFCalculator(segmented_index)
+    try:
+        tfidf_calculator.load_document_matrix(matrix_path, mmap_mode=None)
+    except ValueError as e:
+        logger.warning(f"TF-IDF vectors will not be updated ({str(e)})")
+        return None
+    return tfidf_calculator
+
+def build_ann_index(config: Config, tfidf_calculator: TFIDFCalculator):
+    """Build and save the ANN index over the TF-IDF vectors, reporting recall@k and latency against exact search."""
+    ann_index = ANNIndex()
+    ann_index.build_index(tfidf_calculator)
+    ann_path = os.path.join(config.get('paths.data_index'), 'ann_index')
+    ann_index.save_index(ann_path)
+    print(f"ANN index ({ann_index.backend}) saved to: {ann_path}")
+    
+    # The sample queries stand in for real traffic when measuring the approximation
+    queries_path = os.path.join(config.get('paths.data_queries'), 'sample_queries.csv')
+    if not os.path.exists(queries_path):
+        return
+    with open(queries_path, 'r', encoding='utf-8', newline='') as f:
+        queries = [row['query'] for row in csv.DictReader(f) if row.get('query')]
+    
+    query_vectors = [tfidf_calculator.get_query_vector(tfidf_calculator.index.preprocess_text(query))
+                     for query in queries]
+    report = ann_index.evaluate(tfidf_calculator, query_vectors, config.get('processor.top_k_results', 10))
+    logger.info(f"ANN evaluation: {report}")
+    recall = f"{report['recall_at_k']:.3f}" if report['recall_at_k'] is not None else "n/a"
+    print(f"ANN recall@{report['k']}: {recall} over {report['queries']} sample queries, "
+          f"{report['ann_latency_ms']:.2f} ms vs {report['exact_latency_ms']:.2f} ms exact per query")
+
+def build_neighbor_table(config: Config, tfidf_calculator: TFIDFCalculator):
+    """Precompute and save every document's most similar documents for the /similar endpoint."""
+    neighbors = DocumentNeighbors()
+    neighbors.build_table(tfidf_calculator)
+    neighbors_path = os.path.join(config.get('paths.data_index'), 'neighbors')
+    neighbors.save_table(neighbors_path)
+    print(f"Neighbor table ({neighbors.neighbors.shape[1]} per document) saved to: {neighbors_path}")
+
+def index_incrementally(config: Config, html_files: List[str]):
+    """Index new and recrawled HTML files into a new segment and drop removed ones."""
+    index_dir = config.get('paths.data_index')
+    segments_dir = os.path.join(index_dir, 'segments')
+    base_index_path = os.path.join(index_dir, 'inverted_index.bin')
+    
+    segmented_index = SegmentedIndex(segments_dir)
+    
+    # Start from the last full build so incremental segments stack on top of it
+    if not segmented_index.segments and os.path.exists(base_index_path):
+        segmented_index.add_segment_file(base_index_path)
+    
+    tfidf_calculator = load_tfidf_for_update(index_dir, segmented_index)
+    known_documents = dict(segmented_index.document_metadata)
+    files_by_id = {os.path.basename(filepath).replace('.html', ''): filepath for filepath in html_files}
+    
+    new_files = [filepath for doc_id, filepath in files_by_id.items() if doc_id not in known_documents]
+    changed_files = [filepath for doc_id, filepath in files_by_id.items()
+                     if doc_id in known_documents and
+                     os.path.getmtime(filepath) > known_documents[doc_id].get('last_modified', 0)]
+    removed_ids = [doc_id for doc_id in known_documents if doc_id not in files_by_id]
+    
+    logger.info(f"Incremental indexing: {len(new_files)} new, {len(changed_files)} changed, "
+                f"{len(removed_ids)} removed of {len(html_files)} HTML files")
+    
+    for doc_id in removed_ids:
+        segmented_index.delete_document(doc_id)
+    
+    # add_document replaces (tombstones) the previous version of a changed document
+    # Their analyzed terms give the TF-IDF rows without scanning the vocabulary
+    document_terms = {}
+    for filepath in new_files + changed_files:
+        document = load_html_document(filepath)
+        if document:
+            terms = segmented_index.add_document(document['document_id'], document['content'], document['metadata'])
+            if terms:
+                document_terms[document['document_id']] = terms
+    
+    segmented_index.flush()
+    segmented_index.wait_for_merges()
+    
+    # Only the changed documents' TF-IDF rows are rewritten; IDF is applied at query time
+    if tfidf_calculator is not None:
+        tfidf_calculator.remove_documents(removed_ids)
+        tfidf_calculator.add_documents(list(document_terms), document_terms)
+        tfidf_calculator.save_document_matrix(os.path.join(index_dir, 'tfidf_matrix'))
+        print(f"TF-IDF vectors updated: {len(tfidf_calculator.document_ids)} documents")
+        build_ann_index(config, tfidf_calculator)
+        build_neighbor_table(config, tfidf_calculator)
+    
+    stats = segmented_index.get_statistics()
+    segmented_index.close()
+    
+    print(f"\nIncremental indexing completed!")
+    print(f"Documents added: {len(new_files)}, updated: {len(changed_files)}, deleted: {len(removed_ids)}")
+    print(f"Documents in index: {stats['total_documents']} across {stats['segment_count']} segments")
+    print(f"Segments directory: {segments_dir}")
+
 def main():
     """Main function to run the indexer."""
+    parser = argparse.ArgumentParser(description="Build the search index from data/raw_html.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only index new or changed HTML files, appending a segment instead of rebuilding")
+    args = parser.parse_args()
+    
     try:
         config = Config()
         
-        # Initialize indexer
-        inverted_index = InvertedIndex()
-        
-        # Load documents from raw HTML
         raw_html_dir = config.get('paths.data_raw')
-        logger.info(f"Loading documents from {raw_html_dir}...")
-        
-        documents = load_documents_from_raw_html(raw_html_dir)
+        html_files = list_html_files(raw_html_dir)
         
-        if not documents:
+        if not html_files:
             logger.warning("No documents found to index")
             print("No HTML documents found in data/raw_html/")
             print("Please run the crawler first to download web pages.")
             return
         
-        # Add documents to index
-        logger.info(f"Indexing {len(documents)} documents...")
+        if args.incremental:
+            index_incrementally(config, html_files)
+            return
+        
+        num_workers = config.get('indexer.num_workers', 1) or os.cpu_count() or 1
         
-        for doc in documents:
-            inverted_index.add_document(
-                doc['document_id'],
-                doc['content'],
-                doc['metadata']
-            )
+        if num_workers > 1 and len(html_files) > 1:
+            inverted_index = build_index_parallel(html_files, num_workers)
+        else:
+            # Initialize indexer
+            inverted_index = InvertedIndex()
+            
+            # Load documents from raw HTML
+            logger.info(f"Loading documents from {raw_html_dir}...")
+            documents = load_documents_from_raw_html(raw_html_dir)
+            
+            # Add documents to index
+            logger.info(f"Indexing {len(documents)} documents...")
+            
+            for doc in documents:
+                inverted_index.add_document(
+                    doc['document_id'],
+                    doc['content'],
+                    doc['metadata']
+                )
+        
+        # Drop rare terms and mark common ones as stop terms
+        pruning = inverted_index.prune_vocabulary()
         
         # Calculate statistics
         stats = inverted_index.get_statistics()
         logger.info(f"Indexing completed: {stats}")
         
         # Save inverted index
-        index_path = os.path.join(config.get('paths.data_index'), 'inverted_index.json')
+        index_path = os.path.join(config.get('paths.data_index'), 'inverted_index.bin')
         inverted_index.save_index(index_path)
         print(f"Inverted index saved to: {index_path}")
         
+        # A full rebuild supersedes any incremental segments
+        segments_dir = os.path.join(config.get('paths.data_index'), 'segments')
+        if os.path.exists(segments_dir):
+            shutil.rmtree(segments_dir)
+        
         # Calculate and save TF-IDF vectors
         logger.info("Calculating TF-IDF vectors...")
         tfidf_calculator = TFIDFCalculator(inverted_index)
         tfidf_calculator.calculate_tfidf()
         
-        tfidf_path = os.path.join(config.get('paths.data_index'), 'tfidf_vectors.pkl')
-        tfidf_calculator.save_tfidf_vectors(tfidf_path)
-        print(f"TF-IDF vectors saved to: {tfidf_path}")
+        matrix_path = os.path.join(config.get('paths.data_index'), 'tfidf_matrix')
+        tfidf_calculator.save_document_matrix(matrix_path)
+        print(f"TF-IDF document matrix saved to: {matrix_path}")
+        
+        build_ann_index(config, tfidf_calculator)
+        build_neighbor_table(config, tfidf_calculator)
         
         print(f"\nIndexing completed successfully!")
         print(f"Documents indexed: {stats['total_documents']}")
-        print(f"Vocabulary size: {stats['vocabulary_size']}")
+        print(f"Vocabulary size: {stats['vocabulary_size']} "
+              f"({pruning.get('pruned_rare_terms', 0)} rare terms pruned, "
+              f"{pruning.get('pruned_common_terms', 0)} common terms only scored alone)")
         print(f"Total terms: {stats['total_terms']}")
         
     except Exception as e:
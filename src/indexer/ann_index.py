@@ -0,0 +1,301 @@
+"""
+Approximate nearest-neighbor index over the TF-IDF document vectors.
+
+TF-IDF rows are as wide as the vocabulary, so they are first reduced to
+``indexer.vector_embedding_dim`` dimensions: every term is hashed to one
+dimension with a random sign (a count sketch, which preserves inner products
+in expectation), or kept in its own dimension when the vocabulary is no wider
+than that. The reduced, unit-length vectors go into a FAISS IVF or HNSW index
+when ``indexer.use_faiss`` is set and ``faiss`` is importable, and otherwise
+into an inverted-file index in plain NumPy: spherical k-means cells, of which
+a query only scans the ``nprobe`` closest.
+
+The ANN index is a first-stage retriever: ``search`` returns candidate rows
+of the document matrix, which ``TFIDFCalculator.get_candidate_scores``
+re-ranks exactly.
+"""
+
+import os
+import json
+import time
+import zlib
+import numpy as np
+from typing import Dict, List, Any
+from scipy import sparse
+from common.config import Config
+from common.logger import setup_logger
+from .tfidf_calculator import TFIDFCalculator
+from .topk import top_k_indices
+
+logger = setup_logger(__name__)
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# Rows reduced (and assigned to cells) per step, bounding the dense temporaries
+BLOCK_ROWS = 4096
+
+class ANNIndex:
+    """First-stage approximate retriever over reduced TF-IDF document vectors."""
+    
+    def __init__(self, backend: str = None):
+        self.config = Config()
+        self.embedding_dim = self.config.get('indexer.vector_embedding_dim', 300)
+        self.dimension = self.embedding_dim
+        self.index_type = self.config.get('indexer.ann.index_type', 'ivf')
+        self.nlist = self.config.get('indexer.ann.nlist', 64)
+        self.nprobe = self.config.get('indexer.ann.nprobe', 16)
+        self.hnsw_m = self.config.get('indexer.ann.hnsw_m', 32)
+        self.candidate_factor = self.config.get('indexer.ann.candidates', 10)
+        
+        if backend is None:
+            backend = 'faiss' if self.config.get('indexer.use_faiss', False) else 'numpy'
+            if backend == 'faiss' and faiss is None:
+                logger.warning("indexer.use_faiss is set but faiss is not installed, using the NumPy ANN index")
+                backend = 'numpy'
+        if backend not in ('faiss', 'numpy'):
+            raise ValueError(f"Unknown ANN backend: {backend}")
+        if backend == 'faiss' and faiss is None:
+            raise ValueError("The FAISS ANN backend needs the faiss package")
+        self.backend = backend
+        
+        self.document_ids = []
+        self.signature = None
+        self.buckets = None
+        self.signs = None
+        self.vectors = None
+        self.centroids = None
+        self.cell_order = None
+        self.cell_offsets = None
+        self.faiss_index = None
+    
+    def build_index(self, calculator: TFIDFCalculator):
+        """Build the index from a calculator's document matrix (removed documents are compacted away first)."""
+        calculator.compact()
+        self.document_ids = list(calculator.document_ids)
+        self.signature = calculator.index_signature()
+        self._set_projection(list(calculator.term_to_index))
+        
+        # Integer codes only differ from the weights by a per-row scale, which normalization removes
+        matrix = calculator.document_matrix
+        weights = sparse.diags(calculator.idf)
+        self.vectors = np.zeros((matrix.shape[0], self.dimension), dtype=np.float32)
+        for start in range(0, matrix.shape[0], BLOCK_ROWS):
+            block = matrix[start:start + BLOCK_ROWS].astype(np.float64) @ weights @ self._projection_matrix()
+            self.vectors[start:start + BLOCK_ROWS] = self._normalize(block.toarray())
+        
+        if self.backend == 'faiss':
+            self._build_faiss()
+        else:
+            self._build_cells()
+        
+        logger.info(f"Built {self.backend} ANN index of {len(self.document_ids)} documents "
+                    f"in {self.dimension} dimensions")
+    
+    def _set_projection(self, terms: List[str]):
+        """Map every term (column) to one reduced dimension and a sign."""
+        self.dimension = self.embedding_dim
+        if len(terms) <= self.dimension:
+            self.dimension = max(len(terms), 1)
+            self.buckets = np.arange(len(terms), dtype=np.int32)
+            self.signs = np.ones(len(terms), dtype=np.int8)
+            return
+        
+        hashes = np.array([zlib.crc32(term.encode('utf-8')) for term in terms], dtype=np.int64)
+        self.buckets = (hashes % self.dimension).astype(np.int32)
+        self.signs = np.where(hashes >> 31, -1, 1).astype(np.int8)
+    
+    def _projection_matrix(self) -> sparse.csr_matrix:
+        """Sparse terms x dimensions matrix holding each term's sign in its dimension."""
+        columns = len(self.buckets)
+        return sparse.csr_matrix((self.signs.astype(np.float64), self.buckets, np.arange(columns + 1)),
+                                 shape=(columns, self.dimension))
+    
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+    
+    def _build_faiss(self):
+        vectors = np.ascontiguousarray(self.vectors)
+        if self.index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(self.dimension, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        else:
+            quantizer = faiss.IndexFlatIP(self.dimension)
+            index = faiss.IndexIVFFlat(quantizer, self.dimension, max(1, min(self.nlist, len(vectors))),
+                                       faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+        index.add(vectors)
+        self.faiss_index = index
+        # FAISS keeps its own copy of the vectors
+        self.vectors = None
+    
+    def _build_cells(self, iterations: int = 10):
+        """Spherical k-means cells, stored as the document rows sorted by cell plus each cell's offsets."""
+        vectors = self.vectors
+        cells = max(1, min(self.nlist, len(vectors)))
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(len(vectors), cells, replace=False)] if len(vectors) else \
+            np.zeros((1, self.dimension), dtype=np.float32)
+        
+        for _ in range(iterations):
+            assignments = self._assign(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            # Cells left empty keep their centroid
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = self._normalize(sums)
+        
+        assignments = self._assign(vectors, centroids)
+        self.centroids = centroids
+        self.cell_order = np.argsort(assignments, kind='stable').astype(np.int64)
+        self.cell_offsets = np.searchsorted(assignments[self.cell_order], np.arange(len(centroids) + 1))
+    
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """Index of every vector's most similar centroid."""
+        assignments = np.zeros(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), BLOCK_ROWS):
+            assignments[start:start + BLOCK_ROWS] = np.argmax(vectors[start:start + BLOCK_ROWS] @ centroids.T, axis=1)
+        return assignments
+    
+    def project_query(self, query_vector: np.ndarray) -> np.ndarray:
+        """Reduce a query vector over the vocabulary to a unit vector in the index's space."""
+        # Terms added after the index was built have no dimension
+        columns = np.flatnonzero(query_vector[:len(self.buckets)])
+        reduced = np.bincount(self.buckets[columns], weights=query_vector[columns] * self.signs[columns],
+                              minlength=self.dimension)
+        return self._normalize(reduced[np.newaxis, :].astype(np.float32))[0]
+    
+    def search(self, query_vector: np.ndarray, k: int) -> np.ndarray:
+        """Return the document matrix rows of the (approximately) ``k`` most similar documents, best first."""
+        query = self.project_query(query_vector)
+        if k <= 0 or not query.any() or not self.document_ids:
+            return np.zeros(0, dtype=np.int64)
+        
+        if self.faiss_index is not None:
+            if self.index_type == 'hnsw':
+                self.faiss_index.hnsw.efSearch = max(k, 16)
+            else:
+                self.faiss_index.nprobe = self.nprobe
+            _, rows = self.faiss_index.search(query[np.newaxis, :], k)
+            rows = rows[0]
+            return rows[rows >= 0].astype(np.int64)
+        
+        # Scan the documents of the nprobe cells closest to the query
+        cells = top_k_indices(self.centroids @ query, self.nprobe)
+        rows = np.concatenate([self.cell_order[self.cell_offsets[cell]:self.cell_offsets[cell + 1]]
+                               for cell in cells.tolist()])
+        return rows[top_k_indices(self.vectors[rows] @ query, k)]
+    
+    def search_scores(self, calculator: TFIDFCalculator, query_vector: np.ndarray,
+                      top_k: int) -> List[Dict[str, Any]]:
+        """ANN candidates (``candidate_factor`` per result) re-ranked exactly: an approximate ``get_document_scores``."""
+        candidates = self.search(query_vector, top_k * self.candidate_factor)
+        return calculator.get_candidate_scores(query_vector, candidates, top_k)
+    
+    def evaluate(self, calculator: TFIDFCalculator, query_vectors: List[np.ndarray], k: int = 10) -> Dict[str, Any]:
+        """Compare ``search_scores`` with exact search: mean recall@k and per-query latency in milliseconds.
+        
+        Queries without exact matches are left out of the recall.
+        """
+        recalls = []
+        ann_seconds = exact_seconds = 0.0
+        for query_vector in query_vectors:
+            start = time.perf_counter()
+            approximate = self.search_scores(calculator, query_vector, k)
+            ann_seconds += time.perf_counter() - start
+            
+            start = time.perf_counter()
+            exact = calculator.get_document_scores(query_vector, k)
+            exact_seconds += time.perf_counter() - start
+            
+            if exact:
+                found = {score['document_id'] for score in approximate}
+                recalls.append(sum(score['document_id'] in found for score in exact) / len(exact))
+        
+        queries = max(len(query_vectors), 1)
+        return {
+            'queries': len(query_vectors),
+            'k': k,
+            'recall_at_k': float(np.mean(recalls)) if recalls else None,
+            'ann_latency_ms': 1000 * ann_seconds / queries,
+            'exact_latency_ms': 1000 * exact_seconds / queries
+        }
+    
+    def save_index(self, filepath: str):
+        """Save the index as a JSON manifest plus ``.npy`` arrays (and a FAISS index file) next to it.
+        
+        Files are written under temporary names and renamed into place, like
+        the document matrix.
+        """
+        arrays = {'buckets': self.buckets, 'signs': self.signs}
+        if self.faiss_index is not None:
+            path = self._array_path(filepath, 'faiss')
+            faiss.write_index(self.faiss_index, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        else:
+            arrays.update({'vectors': self.vectors, 'centroids': self.centroids,
+                           'cell_order': self.cell_order, 'cell_offsets': self.cell_offsets})
+        for name, array in arrays.items():
+            path = self._array_path(filepath, name)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(path + '.tmp', path)
+        
+        manifest = {
+            'backend': self.backend,
+            'index_type': self.index_type if self.backend == 'faiss' else 'ivf',
+            'dimension': self.dimension,
+            'index': self.signature,
+            'documents': self.document_ids
+        }
+        manifest_path = self.manifest_path(filepath)
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        
+        logger.info(f"ANN index saved to {filepath}")
+    
+    def load_index(self, filepath: str, calculator: TFIDFCalculator, mmap_mode: str = 'r'):
+        """Load an index saved by ``save_index`` for the calculator's document matrix.
+        
+        Raises ValueError when the index was built for other document rows or
+        needs FAISS where it is not installed.
+        """
+        with open(self.manifest_path(filepath), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        
+        if manifest['documents'] != list(calculator.document_ids) or manifest['index'] != calculator.index_signature():
+            raise ValueError(f"ANN index {filepath} was built for a different document matrix; rebuild it with run_indexer.py")
+        if manifest['backend'] == 'faiss' and faiss is None:
+            raise ValueError(f"ANN index {filepath} was built with FAISS, which is not installed")
+        
+        self.backend = manifest['backend']
+        self.index_type = manifest['index_type']
+        self.dimension = manifest['dimension']
+        self.document_ids = manifest['documents']
+        self.signature = manifest['index']
+        
+        names = ['buckets', 'signs']
+        if self.backend == 'faiss':
+            self.faiss_index = faiss.read_index(self._array_path(filepath, 'faiss'))
+        else:
+            names += ['vectors', 'centroids', 'cell_order', 'cell_offsets']
+        for name in names:
+            setattr(self, name, np.load(self._array_path(filepath, name), mmap_mode=mmap_mode, allow_pickle=False))
+        
+        logger.info(f"Loaded {self.backend} ANN index of {len(self.document_ids)} documents from {filepath}")
+    
+    @staticmethod
+    def manifest_path(filepath: str) -> str:
+        """Return the JSON manifest path of an ANN index."""
+        return os.path.splitext(filepath)[0] + '.json'
+    
+    @staticmethod
+    def _array_path(filepath: str, name: str) -> str:
+        extension = 'faiss' if name == 'faiss' else f"{name}.npy"
+        return f"{os.path.splitext(filepath)[0]}.{extension}"
@@ -1,7 +1,9 @@
 import numpy as np
-from typing import List, Dict, Any
+from scipy import sparse
+from typing import List, Dict, Any, Iterator, Tuple
 from common.config import Config
 from common.logger import setup_logger
+from .topk import top_k_indices, top_k_per_row
 
 logger = setup_logger(__name__)
 
@@ -29,40 +31,114 @@ class CosineSimilarity:
             return 0.0
     
     def rank_documents(self, query_vector: np.ndarray, document_vectors: Dict[str, np.ndarray], top_k: int = 10) -> List[Dict[str, Any]]:
-        """Rank documents by cosine similarity to query vector."""
-        scores = []
+        """Rank documents by cosine similarity to query vector.
         
-        for doc_id, doc_vector in document_vectors.items():
-            similarity = self.calculate_similarity(query_vector, doc_vector)
-            scores.append({
-                'document_id': doc_id,
-                'similarity_score': similarity
-            })
+        The vectors are stacked into a sparse matrix and ranked by
+        ``rank_matrix``; callers ranking many queries against the same
+        documents should build that matrix once with ``normalize_rows``.
+        """
+        document_ids = list(document_vectors.keys())
+        if not document_ids:
+            return []
+        matrix = sparse.vstack([sparse.csr_matrix(np.ravel(document_vectors[doc_id])) for doc_id in document_ids],
+                               format='csr')
+        return self.rank_matrix(query_vector, self.normalize_rows(matrix), document_ids, top_k)
+    
+    def rank_matrix(self, query_vector: np.ndarray, document_matrix, document_ids: List[str],
+                    top_k: int = 10) -> List[Dict[str, Any]]:
+        """Rank the rows of a pre-normalized (``normalize_rows``) dense or sparse document matrix.
+        
+        Row ``i`` belongs to ``document_ids[i]``. One matrix-vector product
+        scores every document and only the best ``top_k`` are sorted; equal
+        scores keep row order.
+        """
+        query_vector = np.asarray(query_vector, dtype=np.float64).ravel()
+        query_norm = np.linalg.norm(query_vector)
+        if query_norm == 0:
+            similarities = np.zeros(document_matrix.shape[0])
+        else:
+            similarities = np.asarray(document_matrix @ (query_vector / query_norm)).ravel()
         
-        # Sort by similarity score (descending)
-        scores.sort(key=lambda x: x['similarity_score'], reverse=True)
-        return scores[:top_k]
+        # Results only for the top K, by similarity score (descending)
+        return [{'document_id': document_ids[row], 'similarity_score': float(similarities[row])}
+                for row in top_k_indices(similarities, top_k).tolist()]
     
-    def batch_similarity(self, vectors: List[np.ndarray]) -> np.ndarray:
-        """Calculate pairwise cosine similarities for a list of vectors."""
+    def batch_similarity(self, vectors, memory_mb: float = None) -> np.ndarray:
+        """Calculate pairwise cosine similarities for a list of vectors or a (sparse) matrix of rows.
+        
+        The N x N result is filled from ``similarity_blocks``, so apart from
+        the result only one block of rows is computed at a time; sparse input
+        (e.g. ``TFIDFCalculator.get_query_matrix``) stays sparse until then.
+        Use ``top_k_neighbors`` when the full matrix does not fit in memory.
+        """
         try:
-            # Normalize vectors
-            normalized_vectors = []
-            for vector in vectors:
-                norm = np.linalg.norm(vector)
-                if norm > 0:
-                    normalized_vectors.append(vector / norm)
-                else:
-                    normalized_vectors.append(np.zeros_like(vector))
-            
-            # Convert to matrix
-            matrix = np.array(normalized_vectors)
-            
-            # Calculate similarity matrix
-            similarity_matrix = np.dot(matrix, matrix.T)
-            
+            count = vectors.shape[0] if sparse.issparse(vectors) else len(vectors)
+            similarity_matrix = np.empty((count, count))
+            for start, block in self.similarity_blocks(vectors, memory_mb):
+                similarity_matrix[start:start + len(block)] = block
             return similarity_matrix
             
         except Exception as e:
             logger.error(f"Error in batch similarity calculation: {str(e)}")
-            return np.zeros((len(vectors), len(vectors)))
\ No newline at end of file
+            count = vectors.shape[0] if sparse.issparse(vectors) else len(vectors)
+            return np.zeros((count, count))
+    
+    def similarity_blocks(self, vectors, memory_mb: float = None) -> Iterator[Tuple[int, np.ndarray]]:
+        """Stream the pairwise cosine similarity matrix as (first row, dense rows x N block) tiles.
+        
+        Rows are normalized once; each block then takes one matrix product.
+        Blocks have as many rows as keep a block (and, for sparse input, the
+        sparse product it is densified from) within ``memory_mb`` megabytes,
+        ``indexer.similarity_memory_mb`` by default, and at least one row.
+        """
+        normalized = self.normalize_rows(vectors)
+        count = normalized.shape[0]
+        if memory_mb is None:
+            memory_mb = self.config.get('indexer.similarity_memory_mb', 256)
+        bytes_per_entry = 20 if sparse.issparse(normalized) else 8
+        block_rows = max(1, int(memory_mb * (1 << 20)) // max(1, count * bytes_per_entry))
+        
+        transposed = normalized.T.tocsr() if sparse.issparse(normalized) else normalized.T
+        for start in range(0, count, block_rows):
+            block = normalized[start:start + block_rows] @ transposed
+            yield start, block.toarray() if sparse.issparse(block) else block
+    
+    def top_k_neighbors(self, vectors, k: int, memory_mb: float = None,
+                        include_self: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """Return every row's ``k`` most similar rows as (indices, similarities) arrays of shape N x k.
+        
+        Neighbors are in rank order (ties by row index) and, unless
+        ``include_self``, exclude the row itself. Blocks come from
+        ``similarity_blocks`` and only their top k are kept, so memory stays
+        within the budget plus the N x k result.
+        """
+        if memory_mb is None:
+            memory_mb = self.config.get('indexer.similarity_memory_mb', 256)
+        count = vectors.shape[0] if sparse.issparse(vectors) else len(vectors)
+        k = max(0, min(k, count if include_self else count - 1))
+        indices = np.zeros((count, k), dtype=np.int64)
+        similarities = np.zeros((count, k))
+        
+        # Selecting a block's top k takes about twice the block's memory again
+        for start, block in self.similarity_blocks(vectors, memory_mb / 3):
+            rows = slice(start, start + len(block))
+            if not include_self:
+                block[np.arange(len(block)), np.arange(start, start + len(block))] = -np.inf
+            best = top_k_per_row(block, k)
+            indices[rows] = best
+            similarities[rows] = np.take_along_axis(block, best, axis=1)
+        
+        return indices, similarities
+    
+    @staticmethod
+    def normalize_rows(vectors):
+        """Return the vectors as a float64 (sparse) matrix of unit rows; zero vectors stay zero."""
+        if sparse.issparse(vectors):
+            matrix = sparse.csr_matrix(vectors, dtype=np.float64)
+            norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        else:
+            matrix = np.asarray(vectors, dtype=np.float64).reshape(len(vectors), -1)
+            norms = np.linalg.norm(matrix, axis=1)
+        
+        scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        return sparse.csr_matrix(sparse.diags(scale) @ matrix) if sparse.issparse(matrix) else matrix * scale[:, np.newaxis]
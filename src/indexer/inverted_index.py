@@ -1,10 +1,17 @@
 import os
 import json
 import pickle
+import uuid
 from collections import defaultdict, Counter
-from typing import Dict, List, Set, Any
+from typing import Dict, List, Set, Any, Tuple
+import numpy as np
 from common.config import Config
 from common.logger import setup_logger
+from .postings import PostingList, intersect_postings, intersect_sorted, match_phrase, minimal_spans
+from .term_dictionary import TermDictionary
+from .scoring import BM25, ImpactIndex
+from .topk import top_k_indices
+from .postings_format import write_index, read_index, is_binary_index, MappedIndex
 import nltk
 from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
@@ -17,10 +24,24 @@ class InvertedIndex:
     
     def __init__(self):
         self.config = Config()
-        self.index = defaultdict(dict)  # term -> {doc_id: [positions]}
+        self.index = defaultdict(PostingList)  # term -> PostingList over integer doc ids
         self.document_metadata = {}     # doc_id -> {url, title, word_count, etc.}
-        self.vocabulary = set()
         self.total_documents = 0
+        self._terms = None              # front-coded dictionary of index keys, built on demand
+        
+        # Ranking model for search(); BM25 impacts are precomputed per posting
+        # and rebuilt on demand after documents are added
+        self.scoring_model = self.config.get('indexer.scoring.model', 'tfidf')
+        self.bm25 = BM25.from_config(self.config)
+        self._impacts = None            # ImpactIndex: quantized impacts and their upper bounds
+        
+        # Thresholds and counts of prune_vocabulary(), plus the common terms it made stop terms
+        self.pruning = {}
+        self._build_id = None           # id of the current document set, see build_id
+        
+        # Postings refer to documents by integer id; doc_ids maps them back to
+        # external ids and the bitmap marks tombstoned ids awaiting compaction
+        self._reset_documents([])
         
         # Initialize NLP tools
         self._initialize_nlp()
@@ -40,6 +61,25 @@ class InvertedIndex:
         self.stop_words = set(stopwords.words('english'))
         self.stemmer = PorterStemmer()
     
+    def __getstate__(self) -> Dict[str, Any]:
+        """Pickle only index data; NLP tools are rebuilt on unpickling."""
+        if self.is_memory_mapped:
+            raise TypeError("A memory-mapped index cannot be pickled")
+        
+        state = self.__dict__.copy()
+        for transient in ('config', 'stop_words', 'stemmer', '_terms', '_impacts'):
+            state.pop(transient, None)
+        return state
+    
+    def __setstate__(self, state: Dict[str, Any]):
+        """Restore index data and reinitialize configuration and NLP tools."""
+        self.__dict__.update(state)
+        self._terms = None
+        self._impacts = None
+        self._document_lengths = None
+        self.config = Config()
+        self._initialize_nlp()
+    
     def preprocess_text(self, text: str) -> List[str]:
         """Preprocess text: tokenize, remove stopwords, and stem."""
         if not text:
@@ -68,18 +108,48 @@ class InvertedIndex:
             logger.error(f"Error preprocessing text: {str(e)}")
             return []
     
-    def add_document(self, document_id: str, content: str, metadata: Dict[str, Any] = None):
-        """Add a document to the inverted index."""
+    def _assign_id(self, document_id: str) -> int:
+        """Give a document the next integer id."""
+        internal_id = len(self.doc_ids)
+        self.doc_ids.append(document_id)
+        self.doc_id_map[document_id] = internal_id
+        self._document_lengths = None
+        if internal_id >= len(self.deletion_bitmap):
+            grown = np.zeros(max(16, 2 * len(self.deletion_bitmap)), dtype=bool)
+            grown[:len(self.deletion_bitmap)] = self.deletion_bitmap
+            self.deletion_bitmap = grown
+        return internal_id
+    
+    def _reset_documents(self, doc_ids: List[str]):
+        """Install a document table with no tombstones."""
+        self.doc_ids = list(doc_ids)
+        self.doc_id_map = {document_id: internal_id for internal_id, document_id in enumerate(self.doc_ids)}
+        self.deletion_bitmap = np.zeros(len(self.doc_ids), dtype=bool)
+        self.deleted_count = 0
+        self._document_lengths = None  # indexed tokens per internal id, see document_lengths
+    
+    def add_document(self, document_id: str, content: str, metadata: Dict[str, Any] = None) -> List[str]:
+        """Add a document to the inverted index.
+        
+        Returns the document's analyzed terms (empty if nothing was indexed).
+        """
+        if self.is_memory_mapped:
+            raise RuntimeError("Cannot add documents to a memory-mapped index; load it with mmap=False")
+        
         if not content:
             logger.warning(f"Empty content for document {document_id}")
-            return
+            return []
         
         # Preprocess content
         tokens = self.preprocess_text(content)
         
         if not tokens:
             logger.warning(f"No valid tokens found for document {document_id}")
-            return
+            return []
+        
+        # Re-adding a document tombstones the previous version under its old id
+        self.delete_document(document_id)
+        internal_id = self._assign_id(document_id)
         
         # Update document metadata
         self.document_metadata[document_id] = {
@@ -88,6 +158,8 @@ class InvertedIndex:
             'word_count': len(tokens),
             'token_count': len(tokens)
         }
+        if metadata and metadata.get('last_modified'):
+            self.document_metadata[document_id]['last_modified'] = metadata['last_modified']
         
         # Update index with positional information
         term_positions = defaultdict(list)
@@ -95,86 +167,727 @@ class InvertedIndex:
             term_positions[token].append(position)
         
         for term, positions in term_positions.items():
-            self.index[term][document_id] = positions
-            self.vocabulary.add(term)
+            if term not in self.index:
+                self._terms = None
+            self.index[term].append(internal_id, positions)
         
+        self._impacts = None
+        self._build_id = None
         self.total_documents += 1
         logger.debug(f"Added document {document_id} with {len(tokens)} tokens")
+        return tokens
+    
+    def update_document(self, document_id: str, content: str, metadata: Dict[str, Any] = None):
+        """Replace a document's content and metadata (adds it if it is new)."""
+        self.add_document(document_id, content, metadata)
+    
+    def delete_document(self, document_id: str) -> bool:
+        """Delete a document by tombstoning it; its postings are purged by compact().
+        
+        Queries skip tombstoned documents, so deletion is O(1). Tombstones can be
+        recorded on a memory-mapped index too, since they live only in memory.
+        """
+        internal_id = self.doc_id_map.pop(document_id, None)
+        if internal_id is None:
+            return False
+        
+        self.document_metadata.pop(document_id, None)
+        self.deletion_bitmap[internal_id] = True
+        self.deleted_count += 1
+        self.total_documents -= 1
+        self._build_id = None
+        self._document_lengths = None
+        logger.debug(f"Deleted document {document_id}")
+        return True
+    
+    @property
+    def deleted_documents(self) -> Set[str]:
+        """External ids of tombstoned document versions awaiting compaction."""
+        if not self.deleted_count:
+            return set()
+        return {self.doc_ids[internal_id] for internal_id in np.flatnonzero(self.deletion_bitmap).tolist()}
+    
+    def compact(self) -> int:
+        """Purge postings of tombstoned documents, renumber the rest and drop empty terms."""
+        if self.is_memory_mapped:
+            raise RuntimeError("Cannot compact a memory-mapped index; merge it into a new index instead")
+        
+        purged = self.deleted_count
+        if purged:
+            index, doc_ids = self._compacted()
+            self.index = defaultdict(PostingList, index)
+            self._terms = None
+            self._impacts = None
+            self._reset_documents(doc_ids)
+            logger.info(f"Compacted index, purged {purged} deleted documents")
+        return purged
+    
+    def _compacted(self):
+        """Return (postings, document table) with tombstoned documents removed.
+        
+        Live documents keep their relative order, so renumbered posting lists
+        stay sorted. Without tombstones the live structures are returned as is.
+        """
+        if not self.deleted_count:
+            return self.index, self.doc_ids
+        
+        live = ~self.deletion_bitmap[:len(self.doc_ids)]
+        new_ids = np.cumsum(live) - 1
+        index = {}
+        for term in self.index:
+            postings = self.index[term]
+            doc_ids = postings.doc_id_array()
+            keep = live[doc_ids]
+            if keep.any():
+                index[term] = postings.select(keep, new_ids[doc_ids[keep]])
+        doc_ids = [document_id for document_id, is_live in zip(self.doc_ids, live.tolist()) if is_live]
+        return index, doc_ids
+    
+    def get_postings(self, term: str) -> Dict[str, List[int]]:
+        """Get a term's postings as {doc_id: positions}, without tombstoned documents."""
+        postings = self.index.get(term)
+        if postings is None:
+            return {}
+        
+        result = {}
+        positions = postings.position_array().tolist()
+        offsets = postings.offsets.tolist()
+        for i, internal_id in enumerate(postings.doc_id_array().tolist()):
+            if not self.deletion_bitmap[internal_id]:
+                result[self.doc_ids[internal_id]] = positions[offsets[i]:offsets[i + 1]]
+        return result
+    
+    @property
+    def terms(self) -> TermDictionary:
+        """Sorted, front-coded dictionary of the indexed terms (term -> ordinal)."""
+        if self.is_memory_mapped:
+            return self.index.terms
+        if self._terms is None:
+            self._terms = TermDictionary.from_terms(term for term, postings in self.index.items() if len(postings))
+        return self._terms
+    
+    @property
+    def vocabulary(self):
+        """Set-like view of the indexed terms, in sorted order."""
+        return self.terms.keys()
+    
+    @property
+    def is_memory_mapped(self) -> bool:
+        """Whether postings are served lazily from a memory-mapped file."""
+        return isinstance(self.index, MappedIndex)
+    
+    def merge(self, other: 'InvertedIndex'):
+        """Merge a partial index built over a later run of documents into this one.
+        
+        Merging partials in document order gives the same index as adding every
+        document to a single index sequentially.
+        """
+        if self.is_memory_mapped:
+            raise RuntimeError("Cannot merge into a memory-mapped index; load it with mmap=False")
+        
+        # Pruning records carry over: our thresholds win, counts add up and
+        # stop terms keep applying to the merged documents
+        if other.pruning:
+            pruning = dict(other.pruning, **self.pruning)
+            for key in ('pruned_rare_terms', 'pruned_common_terms', 'pruned_postings'):
+                pruning[key] = self.pruning.get(key, 0) + other.pruning.get(key, 0)
+            pruning['stop_terms'] = sorted(self.stop_terms.union(other.pruning.get('stop_terms', ())))
+            self.pruning = pruning
+        
+        # Copy metadata before tombstones: the other index may still take deletions
+        other_doc_ids = list(other.doc_ids)
+        other_metadata = dict(other.document_metadata)
+        other_live = ~other.deletion_bitmap[:len(other_doc_ids)]
+        
+        # Live documents of the other index get fresh ids after ours; a document
+        # present in both is replaced by the later version
+        remap = np.full(len(other_doc_ids), -1, dtype=np.int64)
+        for other_id in np.flatnonzero(other_live).tolist():
+            document_id = other_doc_ids[other_id]
+            self.delete_document(document_id)
+            remap[other_id] = self._assign_id(document_id)
+            self.document_metadata[document_id] = other_metadata.get(document_id, {})
+            self.total_documents += 1
+        
+        # Tombstoned postings of the other index are dropped rather than carried over
+        for term in other.index:
+            postings = other.index[term]
+            new_ids = remap[postings.doc_id_array()]
+            keep = new_ids >= 0
+            if keep.any():
+                if term not in self.index:
+                    self._terms = None
+                self.index[term].extend(postings.select(keep, new_ids[keep]))
+        self._impacts = None
+        self._build_id = None
+    
+    def prune_vocabulary(self, min_document_frequency=None, max_document_frequency=None) -> Dict[str, Any]:
+        """Drop terms found in too few documents and mark those in too many as stop terms.
+        
+        Thresholds default to ``indexer.min_document_frequency`` and
+        ``indexer.max_document_frequency``; like scikit-learn's min_df/max_df
+        an int is a document count and a float a fraction of the documents.
+        Rare terms lose their postings, so they take no space in the index,
+        the TF-IDF matrix or query vectors, and query terms that were pruned
+        are ignored. Common terms keep their postings but are left out of
+        scoring (``scoring_terms``) and document similarity unless a query has
+        no other terms, so a query of common terms still finds its documents.
+        Documents added afterwards, including segments written by
+        ``SegmentedIndex``, are indexed unpruned: within a new batch every new
+        term is rare, so pruning it there would hide new vocabulary until the
+        next full build. Pruning is skipped when it would leave no terms at
+        all. Returns the pruning statistics.
+        """
+        if self.is_memory_mapped:
+            raise RuntimeError("Cannot prune a memory-mapped index; load it with mmap=False")
+        
+        if min_document_frequency is None:
+            min_document_frequency = self.config.get('indexer.min_document_frequency', 1)
+        if max_document_frequency is None:
+            max_document_frequency = self.config.get('indexer.max_document_frequency', 1.0)
+        min_count = (min_document_frequency * self.total_documents if isinstance(min_document_frequency, float)
+                     else min_document_frequency)
+        max_count = (max_document_frequency * self.total_documents if isinstance(max_document_frequency, float)
+                     else max_document_frequency)
+        
+        terms = [term for term in self.index if len(self.index[term])]
+        frequencies = np.fromiter((self.get_document_frequency(term) for term in terms), dtype=np.int64,
+                                  count=len(terms))
+        rare = frequencies < min_count
+        common = (frequencies > max_count) & ~rare
+        if (rare | common).all() and len(terms):
+            logger.warning(f"Vocabulary pruning to document frequencies [{min_count}, {max_count}] "
+                           f"would remove all {len(terms)} terms; skipped")
+            return self.pruning
+        
+        pruned_postings = 0
+        for term in np.asarray(terms, dtype=object)[rare].tolist():
+            pruned_postings += len(self.index.pop(term))
+        if rare.any():
+            self._terms = None
+            self._impacts = None
+            self._document_lengths = None
+            self._build_id = None
+        
+        common_terms = np.asarray(terms, dtype=object)[common].tolist()
+        self.pruning = {
+            'min_document_frequency': min_document_frequency,
+            'max_document_frequency': max_document_frequency,
+            'pruned_rare_terms': self.pruning.get('pruned_rare_terms', 0) + int(np.count_nonzero(rare)),
+            'pruned_common_terms': self.pruning.get('pruned_common_terms', 0) + len(common_terms),
+            'pruned_postings': self.pruning.get('pruned_postings', 0) + pruned_postings,
+            'stop_terms': sorted(set(self.pruning.get('stop_terms', ())).union(common_terms))
+        }
+        logger.info(f"Pruned {int(np.count_nonzero(rare))} rare terms ({pruned_postings} postings) and marked "
+                    f"{len(common_terms)} common terms as stop terms, {len(terms) - int(np.count_nonzero(rare))} terms left")
+        return self.pruning
+    
+    @property
+    def build_id(self) -> str:
+        """Random id of the current document set, saved with the index.
+        
+        Adding, deleting or pruning starts a new id, so files derived from the
+        index (e.g. the TF-IDF matrix) can be matched to it without reading
+        every document.
+        """
+        if self._build_id is None:
+            self._build_id = uuid.uuid4().hex
+        return self._build_id
+    
+    @property
+    def stop_terms(self) -> set:
+        """Terms ``prune_vocabulary`` found too common to score with (see ``scoring_terms``)."""
+        return set(self.pruning.get('stop_terms', ()))
+    
+    def scoring_terms(self, query_terms: List[str]) -> List[str]:
+        """Drop stop terms from analyzed query terms, unless the query has nothing else."""
+        stop_terms = self.stop_terms
+        kept = [term for term in query_terms if term not in stop_terms]
+        return kept if kept else query_terms
     
     def get_document_frequency(self, term: str) -> int:
         """Get the number of documents containing the term."""
-        return len(self.index.get(term, {}))
+        if self.deleted_count:
+            postings = self.index.get(term)
+            if postings is None:
+                return 0
+            return int(len(postings) - np.count_nonzero(self.deletion_bitmap[postings.doc_id_array()]))
+        if self.is_memory_mapped:
+            return self.index.document_frequency(term)
+        postings = self.index.get(term)
+        return len(postings) if postings is not None else 0
     
     def get_term_frequency(self, term: str, document_id: str) -> int:
         """Get the frequency of a term in a specific document."""
-        return len(self.index.get(term, {}).get(document_id, []))
+        internal_id = self.doc_id_map.get(document_id)
+        postings = self.index.get(term)
+        if internal_id is None or postings is None:
+            return 0
+        return postings.frequency(internal_id)
     
-    def search(self, query: str, top_k: int = 10) -> List[Dict[str, Any]]:
-        """Search the index for a query (basic boolean search)."""
-        query_terms = self.preprocess_text(query)
+    def search(self, query: str, top_k: int = 10, phrases: List[Tuple[str, int]] = None) -> List[Dict[str, Any]]:
+        """Search the index for a query (basic boolean search).
         
-        if not query_terms:
+        ``phrases`` optionally restricts results to documents containing each
+        (phrase, slop) pair: slop 0 is an exact phrase and slop n matches the
+        terms in any order with at most n other tokens between them (NEAR/n).
+        """
+        query_terms = self.scoring_terms(self.preprocess_text(query))
+        phrase_terms = self.preprocess_phrases(phrases)
+        
+        if not query_terms and not phrase_terms:
+            return []
+        
+        required_terms = {term for term in query_terms if term in self.index}
+        for terms, _ in phrase_terms:
+            required_terms.update(terms)
+        return self.search_terms(query_terms, list(required_terms), top_k, phrase_terms)
+    
+    def preprocess_phrases(self, phrases: List[Tuple[str, int]]) -> List[Tuple[List[str], int]]:
+        """Preprocess (phrase, slop) pairs into (terms, slop), dropping phrases with no terms."""
+        phrase_terms = []
+        for phrase, slop in phrases or []:
+            terms = self.preprocess_text(phrase)
+            if terms:
+                phrase_terms.append((terms, slop))
+        return phrase_terms
+    
+    def search_terms(self, query_terms: List[str], required_terms: List[str], top_k: int = 10,
+                     phrase_terms: List[Tuple[List[str], int]] = None) -> List[Dict[str, Any]]:
+        """Score the documents containing every required term by summed query term frequency."""
+        if not required_terms or any(term not in self.index for term in required_terms):
             return []
         
-        # Find documents containing all query terms
-        relevant_docs = set()
+        # Find documents containing all required terms, starting from the rarest term
+        term_postings = {term: self.index[term] for term in required_terms}
+        candidates = intersect_postings(list(term_postings.values()))
+        if self.deleted_count:
+            candidates = candidates[~self.deletion_bitmap[candidates]]
+        for terms, slop in phrase_terms or []:
+            candidates = self._match_phrase(terms, slop, candidates)
+        
+        # Score by summed BM25 impacts, or by summed term frequency
+        use_bm25 = self.scoring_model == 'bm25'
+        scores = np.zeros(len(candidates), dtype=np.int64)
         for term in query_terms:
-            if term in self.index:
-                if not relevant_docs:
-                    relevant_docs = set(self.index[term].keys())
-                else:
-                    relevant_docs = relevant_docs.intersection(self.index[term].keys())
+            postings = term_postings.get(term)
+            if postings is not None:
+                rows = np.searchsorted(postings.doc_id_array(), candidates)
+                weights = self.impacts(term) if use_bm25 else postings.frequency_array()
+                scores += weights[rows]
+        if use_bm25:
+            scores = scores * self.impact_scale
         
-        # Calculate simple score based on term frequency
+        return self._top_results(candidates, scores, top_k)
+    
+    def _top_results(self, candidates: np.ndarray, scores: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+        """Build result dicts for the top K candidates by score, best first."""
+        winners = top_k_indices(scores, top_k)
         results = []
-        for doc_id in relevant_docs:
-            score = sum(self.get_term_frequency(term, doc_id) for term in query_terms)
+        for internal_id, score in zip(candidates[winners].tolist(), scores[winners].tolist()):
+            document_id = self.doc_ids[internal_id]
             results.append({
-                'document_id': doc_id,
+                'document_id': document_id,
                 'score': score,
-                'metadata': self.document_metadata.get(doc_id, {})
+                'metadata': self.document_metadata.get(document_id, {})
             })
+        return results
+    
+    @property
+    def impact_index(self) -> ImpactIndex:
+        """BM25 impacts and bounds, computed if none are loaded or additions invalidated them."""
+        if self._impacts is None:
+            self._impacts = self.bm25.compute_impacts(self.index)
+        return self._impacts
+    
+    def impacts(self, term: str) -> np.ndarray:
+        """Quantized BM25 impacts of a term's postings (multiply sums by ``impact_scale``)."""
+        impacts = self.impact_index.impacts.get(term)
+        return impacts if impacts is not None else np.zeros(0, dtype=self.bm25.impact_dtype)
+    
+    def upper_bound(self, term: str) -> int:
+        """Largest quantized impact of a term: no document gains more from it."""
+        return self.impact_index.upper_bounds.get(term, 0)
+    
+    def block_bounds(self, term: str, candidates: np.ndarray) -> np.ndarray:
+        """Largest impact of the postings block each candidate would fall in (0 past the last block)."""
+        impact_index = self.impact_index
+        last_ids = impact_index.block_last_ids[term]
+        blocks = np.searchsorted(last_ids, candidates)
+        maxima = np.append(impact_index.block_maxima[term], 0).astype(np.int64)
+        return maxima[blocks]
+    
+    @property
+    def impact_scale(self) -> float:
+        """Score represented by one unit of quantized impact."""
+        return self.impact_index.scale
+    
+    def rank(self, query: str, top_k: int = 10, phrases: List[Tuple[str, int]] = None) -> List[Dict[str, Any]]:
+        """Rank documents containing any query term by BM25 (ranked retrieval).
+        
+        Unlike search(), documents need not contain every term; ``phrases``
+        still restricts results to documents matching each (phrase, slop).
+        """
+        query_terms = self.scoring_terms(self.preprocess_text(query))
+        phrase_terms = self.preprocess_phrases(phrases)
+        if not query_terms:
+            query_terms = self.scoring_terms([term for terms, _ in phrase_terms for term in terms])
+        return self.rank_terms(query_terms, top_k, phrase_terms)
+    
+    def rank_terms(self, query_terms: List[str], top_k: int = 10,
+                   phrase_terms: List[Tuple[List[str], int]] = None, prune: bool = True) -> List[Dict[str, Any]]:
+        """Rank documents holding any query term by summed BM25 impacts.
+        
+        With ``prune`` the MaxScore strategy skips documents that cannot reach
+        the top K. Real scores of the rarest term's documents give a lower
+        bound on the K-th best score; terms whose upper bounds add up to less
+        than it are non-essential, so only documents in the other terms'
+        postings are accumulated, and each candidate drops out as soon as its
+        score plus the bounds of the terms left to check falls short. Block-Max
+        metadata tightens both steps: essential postings blocks whose maximum
+        cannot reach the threshold are skipped, and candidates are bounded by
+        the maxima of the blocks they fall in rather than whole-term maxima.
+        The top K is identical to exhaustive evaluation.
+        """
+        # Repeated query terms weigh their impacts by the query term frequency
+        weights = Counter(term for term in query_terms if term in self.index and len(self.index[term]))
+        if not weights:
+            return []
+        
+        required_ids = self._required_ids(phrase_terms)
+        if required_ids is not None and not len(required_ids):
+            return []
+        
+        bounds = {term: weight * self.upper_bound(term) for term, weight in weights.items()}
+        terms = sorted(weights, key=lambda term: bounds[term])
+        
+        # Pruning pays off only when scoring the rarest term's documents against
+        # every term is cheap next to accumulating all postings
+        threshold = 0
+        rarest = min(terms, key=lambda term: len(self.index[term]))
+        total_postings = sum(len(self.index[term]) for term in terms)
+        if prune and top_k > 0 and len(terms) > 1 and len(self.index[rarest]) * len(terms) * 8 < total_postings:
+            seeds = self.index[rarest].doc_id_array()
+            seeds = seeds[self._admissible(seeds, phrase_terms, required_ids)]
+            if len(seeds) >= top_k:
+                seed_scores = self._score_candidates(seeds, terms, weights)
+                threshold = int(np.partition(seed_scores, len(seeds) - top_k)[len(seeds) - top_k])
+        
+        # The lowest-bound terms that together cannot reach the threshold are non-essential
+        essential_from, non_essential_bound = 0, 0
+        while essential_from < len(terms) and non_essential_bound + bounds[terms[essential_from]] < threshold:
+            non_essential_bound += bounds[terms[essential_from]]
+            essential_from += 1
+        
+        # One accumulator slot per document holding an essential term; a block
+        # is skipped when even its best posting plus every other term's bound
+        # falls short (such documents cannot enter the top K, whatever partial
+        # score they collect from other lists)
+        essential = terms[essential_from:]
+        total_bound = sum(bounds.values())
+        doc_chunks, impact_chunks = [], []
+        for term in essential:
+            doc_ids, impacts = self.index[term].doc_id_array(), self.impacts(term)
+            if threshold:
+                block_maxima = self.impact_index.block_maxima[term].astype(np.int64) * weights[term]
+                live_blocks = block_maxima + (total_bound - bounds[term]) >= threshold
+                if not live_blocks.all():
+                    in_live_block = np.repeat(live_blocks, self.impact_index.block_size)[:len(doc_ids)]
+                    doc_ids, impacts = doc_ids[in_live_block], impacts[in_live_block]
+            doc_chunks.append(doc_ids)
+            impact_chunks.append(impacts.astype(np.int64) * weights[term])
+        candidates, scores = self._accumulate(np.concatenate(doc_chunks), np.concatenate(impact_chunks))
+        
+        # Check non-essential terms from the highest bound down, dropping
+        # candidates whose score plus the block bounds of the terms left is hopeless
+        non_essential = terms[:essential_from]
+        remaining = np.zeros(len(candidates), dtype=np.int64)
+        for term in non_essential:
+            remaining += self.block_bounds(term, candidates) * weights[term]
+        for term in reversed(non_essential):
+            viable = scores + remaining >= threshold
+            candidates, scores, remaining = candidates[viable], scores[viable], remaining[viable]
+            remaining -= self.block_bounds(term, candidates) * weights[term]
+            scores += self._score_candidates(candidates, [term], weights)
         
-        # Sort by score and return top K
-        results.sort(key=lambda x: x['score'], reverse=True)
-        return results[:top_k]
+        keep = self._admissible(candidates, phrase_terms, required_ids)
+        return self._top_results(candidates[keep], scores[keep] * self.impact_scale, top_k)
     
-    def save_index(self, filepath: str):
-        """Save the inverted index to a JSON file."""
+    def _required_ids(self, phrase_terms: List[Tuple[List[str], int]]) -> np.ndarray:
+        """Ids of documents holding every phrase term (None without phrases, empty if a term is missing)."""
+        if not phrase_terms:
+            return None
+        required_terms = {term for terms, _ in phrase_terms for term in terms}
+        if any(term not in self.index for term in required_terms):
+            return np.zeros(0, dtype=np.uint32)
+        return intersect_postings([self.index[term] for term in required_terms])
+    
+    def document_lengths(self) -> np.ndarray:
+        """Indexed tokens (summed term frequencies) of every internal id, 0 for deleted documents.
+        
+        These are the lengths BM25 normalizes by, as in ``BM25.compute_impacts``.
+        """
+        if self._document_lengths is None:
+            posting_lists = [postings for postings in self.index.values() if len(postings)]
+            lengths = np.zeros(len(self.doc_ids), dtype=np.float64)
+            if posting_lists:
+                doc_ids = np.concatenate([postings.doc_id_array() for postings in posting_lists])
+                frequencies = np.concatenate([postings.frequency_array() for postings in posting_lists])
+                lengths += np.bincount(doc_ids, weights=frequencies, minlength=len(lengths))[:len(lengths)]
+            lengths[self.deletion_bitmap[:len(lengths)]] = 0
+            self._document_lengths = lengths
+        return self._document_lengths
+    
+    def bm25_statistics(self, terms: List[str]) -> Dict[str, Any]:
+        """This index's share of the collection statistics BM25 needs for ``terms``.
+        
+        Summing them over several indexes (e.g. segments) gives the statistics
+        of their union for ``rank_with_statistics``.
+        """
+        lengths = self.document_lengths()
+        return {
+            'total_documents': int(np.count_nonzero(lengths)),
+            'total_length': float(lengths.sum()),
+            'document_frequencies': {term: self.get_document_frequency(term) for term in set(terms)}
+        }
+    
+    def rank_with_statistics(self, query_terms: List[str], statistics: Dict[str, Any], top_k: int = 10,
+                             phrase_terms: List[Tuple[List[str], int]] = None) -> List[Dict[str, Any]]:
+        """Rank this index's documents by exact BM25 under given collection statistics.
+        
+        ``statistics`` has the document count, total document length and the
+        query terms' document frequencies of a whole collection (see
+        ``bm25_statistics``), so indexes holding parts of it score their
+        documents on one scale. Scores are computed from the term frequencies
+        rather than the stored impacts, whose quantization depends on this
+        index alone.
+        """
+        weights = Counter(term for term in query_terms if term in self.index and len(self.index[term]))
+        if not weights:
+            return []
+        required_ids = self._required_ids(phrase_terms)
+        if required_ids is not None and not len(required_ids):
+            return []
+        
+        total_documents = statistics['total_documents']
+        average_length = statistics['total_length'] / max(1, total_documents) or 1.0
+        lengths = self.document_lengths()
+        k1, b = self.bm25.k1, self.bm25.b
+        doc_chunks, score_chunks = [], []
+        for term, weight in weights.items():
+            postings = self.index[term]
+            doc_ids = postings.doc_id_array()
+            frequencies = postings.frequency_array().astype(np.float64)
+            idf = self.bm25.idf(statistics['document_frequencies'][term], total_documents)
+            normalization = k1 * (1 - b + b * lengths[doc_ids] / average_length)
+            doc_chunks.append(doc_ids)
+            score_chunks.append(weight * idf * frequencies * (k1 + 1) / (frequencies + normalization))
+        
+        candidates, slots = np.unique(np.concatenate(doc_chunks), return_inverse=True)
+        scores = np.bincount(slots, weights=np.concatenate(score_chunks), minlength=len(candidates))
+        keep = self._admissible(candidates, phrase_terms, required_ids)
+        return self._top_results(candidates[keep], scores[keep], top_k)
+    
+    def _accumulate(self, doc_ids: np.ndarray, impacts: np.ndarray):
+        """Sum impacts per document; returns (ascending doc ids, int64 scores).
+        
+        Every document with a posting is a candidate, even if its impacts sum
+        to zero. The dense accumulator is used when there are many postings
+        per document, a sort of the postings otherwise.
+        """
+        if len(doc_ids) * 8 >= len(self.doc_ids):
+            # Dense accumulator: linear in postings plus documents, no sort
+            accumulator = np.bincount(doc_ids, weights=impacts, minlength=len(self.doc_ids))
+            present = np.zeros(len(accumulator), dtype=bool)
+            present[doc_ids] = True
+            candidates = np.flatnonzero(present)
+            return candidates.astype(np.uint32), accumulator[candidates].astype(np.int64)
+        candidates, slots = np.unique(doc_ids, return_inverse=True)
+        return (candidates.astype(np.uint32),
+                np.bincount(slots, weights=impacts, minlength=len(candidates)).astype(np.int64))
+    
+    def _score_candidates(self, candidates: np.ndarray, terms: List[str], weights: Dict[str, int]) -> np.ndarray:
+        """Sum the weighted impacts of the terms for each candidate.
+        
+        Few candidates binary-search a term's postings; many use a dense
+        scatter of the term's impacts that they then read back.
+        """
+        scores = np.zeros(len(candidates), dtype=np.int64)
+        dense = None
+        for term in terms:
+            doc_ids, impacts = self.index[term].doc_id_array(), self.impacts(term)
+            if len(candidates) * 16 < len(doc_ids):
+                rows = np.minimum(np.searchsorted(doc_ids, candidates), len(doc_ids) - 1)
+                present = doc_ids[rows] == candidates
+                scores[present] += impacts[rows[present]].astype(np.int64) * weights[term]
+            else:
+                if dense is None:
+                    dense = np.zeros(len(self.doc_ids), dtype=np.int64)
+                dense[doc_ids] = impacts
+                scores += dense[candidates] * weights[term]
+                dense[doc_ids] = 0
+        return scores
+    
+    def _admissible(self, candidates: np.ndarray, phrase_terms: List[Tuple[List[str], int]],
+                    required_ids: np.ndarray) -> np.ndarray:
+        """Mask of candidates that are live and match every phrase constraint."""
+        keep = ~self.deletion_bitmap[candidates] if self.deleted_count else np.ones(len(candidates), dtype=bool)
+        if phrase_terms:
+            matched = intersect_sorted(candidates[keep], required_ids)
+            for terms, slop in phrase_terms:
+                matched = self._match_phrase(terms, slop, matched)
+            keep &= np.isin(candidates, matched)
+        return keep
+    
+    def _match_phrase(self, terms: List[str], slop: int, candidates: np.ndarray) -> np.ndarray:
+        """Keep the candidates where the terms form a phrase (slop 0) or lie within slop of each other."""
+        if len(candidates) == 0 or len(terms) == 1:
+            return candidates
+        if slop == 0:
+            matched, _ = match_phrase([self.index[term] for term in terms], candidates)
+            return matched
+        
+        distinct_terms = list(dict.fromkeys(terms))
+        spans, _ = minimal_spans([self.index[term] for term in distinct_terms], candidates)
+        return candidates[spans - (len(distinct_terms) - 1) <= slop]
+    
+    def match_phrases(self, phrases: List[Tuple[str, int]]) -> Set[str]:
+        """Return the ids of live documents matching every (phrase, slop) pair."""
+        phrase_terms = self.preprocess_phrases(phrases)
+        required_terms = {term for terms, _ in phrase_terms for term in terms}
+        if not required_terms or any(term not in self.index for term in required_terms):
+            return set()
+        
+        candidates = intersect_postings([self.index[term] for term in required_terms])
+        if self.deleted_count:
+            candidates = candidates[~self.deletion_bitmap[candidates]]
+        for terms, slop in phrase_terms:
+            candidates = self._match_phrase(terms, slop, candidates)
+        return {self.doc_ids[internal_id] for internal_id in candidates.tolist()}
+    
+    def covering_spans(self, query_terms: List[str], document_ids: List[str]) -> Dict[str, Tuple[int, int]]:
+        """Get (span, matched terms) for candidate documents from the positional postings.
+        
+        The span is the width of the tightest window holding every query term
+        the document contains, so only the candidates' postings are touched.
+        Documents not in this index are left out.
+        """
+        terms = [term for term in dict.fromkeys(query_terms) if term in self.index]
+        internal_ids = sorted(self.doc_id_map[document_id] for document_id in document_ids
+                              if document_id in self.doc_id_map)
+        if not internal_ids:
+            return {}
+        
+        candidates = np.asarray(internal_ids, dtype=np.uint32)
+        spans, matched = minimal_spans([self.index[term] for term in terms], candidates)
+        return {self.doc_ids[internal_id]: (span, count)
+                for internal_id, span, count in zip(internal_ids, spans.tolist(), matched.tolist())}
+    
+    def save_index(self, filepath: str, format: str = None):
+        """Save the inverted index in the binary format, or as JSON for debugging.
+
+        The format defaults to JSON for ``.json`` paths and binary otherwise.
+        Tombstoned documents are left out of the saved file.
+        """
+        if format is None:
+            format = 'json' if filepath.endswith('.json') else 'binary'
+        
         try:
-            # Convert defaultdict to regular dict for JSON serialization
-            index_serializable = {term: dict(docs) for term, docs in self.index.items()}
-            
-            index_data = {
-                'index': index_serializable,
-                'document_metadata': self.document_metadata,
-                'vocabulary': list(self.vocabulary),
-                'total_documents': self.total_documents
-            }
-            
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(index_data, f, indent=2, ensure_ascii=False)
+            index, doc_ids = self._compacted()
+            if format == 'json':
+                self._save_json(filepath, index, doc_ids)
+            elif format == 'binary':
+                write_index(filepath, index, doc_ids, self.document_metadata, self.total_documents, scoring=self.bm25,
+                            pruning=self.pruning, build_id=self.build_id)
+            else:
+                raise ValueError(f"Unknown index format: {format}")
             
-            logger.info(f"Index saved to {filepath} with {self.total_documents} documents")
+            logger.info(f"Index saved to {filepath} ({format}) with {self.total_documents} documents")
             
         except Exception as e:
             logger.error(f"Error saving index to {filepath}: {str(e)}")
             raise
     
-    def load_index(self, filepath: str):
-        """Load the inverted index from a JSON file."""
+    def _save_json(self, filepath: str, index: Dict[str, PostingList], doc_ids: List[str]):
+        """Write the index as indented JSON, keyed by external document ids."""
+        index_serializable = {}
+        for term, postings in index.items():
+            if not len(postings):
+                continue
+            positions = postings.position_array().tolist()
+            offsets = postings.offsets.tolist()
+            index_serializable[term] = {
+                doc_ids[internal_id]: positions[offsets[i]:offsets[i + 1]]
+                for i, internal_id in enumerate(postings.doc_id_array().tolist())
+            }
+        
+        index_data = {
+            'index': index_serializable,
+            'document_metadata': self.document_metadata,
+            'vocabulary': sorted(index_serializable.keys()),
+            'total_documents': self.total_documents,
+            'pruning': self.pruning,
+            'build_id': self.build_id
+        }
+        
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(index_data, f, indent=2, ensure_ascii=False)
+    
+    def _load_json_postings(self, index_data: Dict[str, Any]):
+        """Convert JSON {term: {doc_id: positions}} postings to integer-id posting lists."""
+        doc_ids = list(index_data['document_metadata'].keys())
+        doc_id_map = {document_id: internal_id for internal_id, document_id in enumerate(doc_ids)}
+        
+        # Postings may reference documents without metadata (e.g. hand-built indexes)
+        index = defaultdict(PostingList)
+        for term, docs in index_data['index'].items():
+            for document_id in docs:
+                if document_id not in doc_id_map:
+                    doc_id_map[document_id] = len(doc_ids)
+                    doc_ids.append(document_id)
+            for internal_id, document_id in sorted((doc_id_map[document_id], document_id) for document_id in docs):
+                index[term].append(internal_id, docs[document_id])
+        return index, doc_ids
+    
+    def load_index(self, filepath: str, mmap: bool = False):
+        """Load the inverted index from a binary or JSON file (detected from its contents).
+        
+        With ``mmap=True`` a binary index is memory-mapped and postings are
+        decoded only when a term is looked up; the index is then read-only.
+        """
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                index_data = json.load(f)
+            self.close()
             
-            # Convert back to defaultdict
-            self.index = defaultdict(dict)
-            for term, docs in index_data['index'].items():
-                self.index[term] = docs
+            if mmap and is_binary_index(filepath):
+                mapped_index = MappedIndex(filepath)
+                self.index = mapped_index
+                self._reset_documents(mapped_index.documents)
+                self.document_metadata = mapped_index.document_metadata
+                self.total_documents = mapped_index.total_documents
+                self.pruning = mapped_index.pruning
+                self._build_id = mapped_index.build_id
+                self._load_impacts(mapped_index.scoring, mapped_index.impacts)
+                logger.info(f"Index memory-mapped from {filepath} with {self.total_documents} documents")
+                return
             
+            if is_binary_index(filepath):
+                index_data = read_index(filepath)
+                self.index = defaultdict(PostingList, index_data['index'])
+                self._terms = index_data['terms']
+                doc_ids = index_data['documents']
+                self._load_impacts(index_data['scoring'], index_data['impacts'])
+            else:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    index_data = json.load(f)
+                self.index, doc_ids = self._load_json_postings(index_data)
+                self._terms = None
+                self._impacts = None
+            
+            self._reset_documents(doc_ids)
             self.document_metadata = index_data['document_metadata']
-            self.vocabulary = set(index_data['vocabulary'])
             self.total_documents = index_data['total_documents']
+            self.pruning = index_data.get('pruning', {})
+            self._build_id = index_data.get('build_id')
             
             logger.info(f"Index loaded from {filepath} with {self.total_documents} documents")
             
@@ -182,14 +895,35 @@ class InvertedIndex:
             logger.error(f"Error loading index from {filepath}: {str(e)}")
             raise
     
+    def _load_impacts(self, scoring: Dict[str, Any], impacts: ImpactIndex):
+        """Use impacts stored with the index if they were computed with the configured BM25 parameters."""
+        self._impacts = impacts if self.bm25.matches(scoring) else None
+    
+    def close(self):
+        """Release the memory map of a memory-mapped index, if any."""
+        if self.is_memory_mapped:
+            self.index.close()
+            self.index = defaultdict(PostingList)
+            self._terms = None
+            self._impacts = None
+            self.pruning = {}
+            self._build_id = None
+            self._reset_documents([])
+    
     def get_statistics(self) -> Dict[str, Any]:
         """Get index statistics."""
-        total_terms = sum(len(docs) for docs in self.index.values())
+        if self.deleted_count:
+            total_terms = sum(self.get_document_frequency(term) for term in self.index)
+        elif self.is_memory_mapped:
+            total_terms = self.index.total_postings()
+        else:
+            total_terms = sum(len(postings) for postings in self.index.values())
         avg_doc_length = sum(meta.get('word_count', 0) for meta in self.document_metadata.values()) / max(1, self.total_documents)
         
         return {
             'total_documents': self.total_documents,
-            'vocabulary_size': len(self.vocabulary),
+            'vocabulary_size': len(self.terms),
             'total_terms': total_terms,
-            'average_document_length': avg_doc_length
+            'average_document_length': avg_doc_length,
+            'pruned_terms': self.pruning.get('pruned_rare_terms', 0) + self.pruning.get('pruned_common_terms', 0)
         }
\ No newline at end of file
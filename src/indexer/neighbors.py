@@ -0,0 +1,123 @@
+"""
+Precomputed "more like this" table: every document's most similar documents.
+
+Computing a document's neighbors on demand means comparing its TF-IDF vector
+with every other one. Instead the indexer computes the top
+``indexer.similar_documents`` neighbors of every document offline, in
+memory-bounded blocks (``CosineSimilarity.top_k_neighbors``), and stores them
+as a documents x N table of neighbor rows and similarities. Serving a lookup
+is a dictionary access and a slice.
+"""
+
+import os
+import json
+import numpy as np
+from typing import Dict, List, Any, Optional
+from scipy import sparse
+from common.config import Config
+from common.logger import setup_logger
+from .tfidf_calculator import TFIDFCalculator
+from .cosine_similarity import CosineSimilarity
+
+logger = setup_logger(__name__)
+
+class DocumentNeighbors:
+    """Table of every document's nearest neighbors by TF-IDF cosine similarity."""
+    
+    def __init__(self):
+        self.config = Config()
+        self.count = self.config.get('indexer.similar_documents', 10)
+        self.document_ids = []   # row -> doc_id
+        self.document_rows = {}  # doc_id -> row
+        self.neighbors = np.zeros((0, 0), dtype=np.int32)  # rows of every row's neighbors, best first
+        self.similarities = np.zeros((0, 0), dtype=np.float32)
+        self.signature = None
+    
+    def build_table(self, calculator: TFIDFCalculator, count: int = None):
+        """Compute the ``count`` (default ``indexer.similar_documents``) nearest neighbors of every document."""
+        if count is not None:
+            self.count = count
+        calculator.compact()
+        
+        # Row scales of integer codes do not change a row's direction, so the codes can stand in for the weights;
+        # stop terms are left out, so sharing them alone does not make documents similar
+        vectors = sparse.csr_matrix(calculator.document_matrix.astype(np.float64) @
+                                    sparse.diags(calculator.similarity_idf))
+        neighbors, similarities = CosineSimilarity().top_k_neighbors(vectors, self.count)
+        
+        self._set_table(list(calculator.document_ids), neighbors.astype(np.int32),
+                        similarities.astype(np.float32), calculator.index_signature())
+        logger.info(f"Computed {neighbors.shape[1]} neighbors for each of {len(self.document_ids)} documents")
+    
+    def _set_table(self, document_ids: List[str], neighbors: np.ndarray, similarities: np.ndarray,
+                   signature: Dict[str, Any]):
+        self.document_ids = document_ids
+        self.document_rows = {doc_id: row for row, doc_id in enumerate(document_ids)}
+        self.neighbors = neighbors
+        self.similarities = similarities
+        self.signature = signature
+    
+    def similar(self, document_id: str, top_k: int = None) -> Optional[List[Dict[str, Any]]]:
+        """Return up to ``top_k`` documents most similar to ``document_id``, best first (None if it is unknown).
+        
+        Neighbors with no terms in common (similarity 0) are left out.
+        """
+        row = self.document_rows.get(document_id)
+        if row is None:
+            return None
+        
+        neighbors, similarities = self.neighbors[row, :top_k], self.similarities[row, :top_k]
+        return [{'document_id': self.document_ids[neighbor], 'similarity_score': similarity}
+                for neighbor, similarity in zip(neighbors.tolist(), similarities.tolist()) if similarity > 0]
+    
+    def save_table(self, filepath: str):
+        """Save the table as ``<base>.neighbors.npy`` and ``<base>.similarities.npy`` plus a JSON manifest.
+        
+        Like the document matrix, files are written under temporary names and
+        renamed into place, and the manifest records the index signature.
+        """
+        for name, array in (('neighbors', self.neighbors), ('similarities', self.similarities)):
+            path = self._array_path(filepath, name)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(path + '.tmp', path)
+        
+        manifest = {
+            'count': int(self.neighbors.shape[1]),
+            'index': self.signature,
+            'documents': self.document_ids
+        }
+        manifest_path = self.manifest_path(filepath)
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        
+        logger.info(f"Neighbor table {self.neighbors.shape} saved to {filepath}")
+    
+    def load_table(self, filepath: str, signature: Dict[str, Any], mmap_mode: str = 'r'):
+        """Load a table saved by ``save_table``, memory-mapped by default.
+        
+        Raises ValueError unless it was built for the index with ``signature``
+        (see ``TFIDFCalculator.index_signature``).
+        """
+        with open(self.manifest_path(filepath), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        
+        if manifest.get('index') != signature:
+            raise ValueError(f"Neighbor table {filepath} was built for a different index; rebuild it with run_indexer.py")
+        
+        arrays = [np.load(self._array_path(filepath, name), mmap_mode=mmap_mode, allow_pickle=False)
+                  for name in ('neighbors', 'similarities')]
+        self.count = manifest['count']
+        self._set_table(manifest['documents'], arrays[0], arrays[1], manifest['index'])
+        
+        logger.info(f"Neighbor table of {len(self.document_ids)} documents loaded from {filepath}")
+    
+    @staticmethod
+    def manifest_path(filepath: str) -> str:
+        """Return the JSON manifest path of a neighbor table."""
+        return os.path.splitext(filepath)[0] + '.json'
+    
+    @staticmethod
+    def _array_path(filepath: str, name: str) -> str:
+        return f"{os.path.splitext(filepath)[0]}.{name}.npy"
@@ -0,0 +1,265 @@
+from array import array
+from bisect import bisect_left
+from typing import List, Iterator, Tuple
+import numpy as np
+
+class PostingList:
+    """Postings of one term stored as parallel typed arrays.
+
+    ``doc_ids`` holds ascending integer document ids, ``frequencies`` the term
+    frequency per document and ``positions`` every document's positions back to
+    back. Lists being built are backed by ``array('I')``; lists decoded from disk
+    hold NumPy uint32 arrays, which are copied into arrays on the first append.
+    """
+
+    __slots__ = ('doc_ids', 'frequencies', 'positions', '_offsets')
+
+    def __init__(self, doc_ids=None, frequencies=None, positions=None):
+        self.doc_ids = array('I') if doc_ids is None else doc_ids
+        self.frequencies = array('I') if frequencies is None else frequencies
+        self.positions = array('I') if positions is None else positions
+        self._offsets = None
+
+    def __getstate__(self):
+        return (self.doc_ids, self.frequencies, self.positions)
+
+    def __setstate__(self, state):
+        self.doc_ids, self.frequencies, self.positions = state
+        self._offsets = None
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, PostingList):
+            return NotImplemented
+        return (np.array_equal(self.doc_id_array(), other.doc_id_array()) and
+                np.array_equal(self.frequency_array(), other.frequency_array()) and
+                np.array_equal(self.position_array(), other.position_array()))
+
+    def __repr__(self) -> str:
+        return f"PostingList({len(self)} documents, {len(self.positions)} positions)"
+
+    @staticmethod
+    def _extend(values, new_values):
+        """Extend a build array, copying it first if it is a NumPy array or a view pins its buffer."""
+        if not isinstance(values, array):
+            values = _to_array(values)
+        try:
+            values.extend(new_values)
+            return values
+        except BufferError:
+            values = array('I', values)
+            values.extend(new_values)
+            return values
+
+    def append(self, doc_id: int, positions: List[int]):
+        """Append a document; ids must be appended in ascending order."""
+        if len(self.doc_ids) and doc_id <= self.doc_ids[-1]:
+            raise ValueError(f"Document id {doc_id} appended out of order")
+        self.doc_ids = self._extend(self.doc_ids, (doc_id,))
+        self.frequencies = self._extend(self.frequencies, (len(positions),))
+        self.positions = self._extend(self.positions, positions)
+        self._offsets = None
+
+    def extend(self, other: 'PostingList'):
+        """Append all postings of a list whose ids all follow this one's."""
+        if not len(other):
+            return
+        if len(self.doc_ids) and int(other.doc_ids[0]) <= self.doc_ids[-1]:
+            raise ValueError("Posting lists must be extended in ascending document order")
+        self.doc_ids = self._extend(self.doc_ids, _to_array(other.doc_id_array()))
+        self.frequencies = self._extend(self.frequencies, _to_array(other.frequency_array()))
+        self.positions = self._extend(self.positions, _to_array(other.position_array()))
+        self._offsets = None
+
+    def doc_id_array(self) -> np.ndarray:
+        return np.asarray(self.doc_ids, dtype=np.uint32)
+
+    def frequency_array(self) -> np.ndarray:
+        return np.asarray(self.frequencies, dtype=np.uint32)
+
+    def position_array(self) -> np.ndarray:
+        return np.asarray(self.positions, dtype=np.uint32)
+
+    @property
+    def offsets(self) -> np.ndarray:
+        """Start offset of every document's positions (length ``len(self) + 1``)."""
+        if self._offsets is None or len(self._offsets) != len(self) + 1:
+            offsets = np.zeros(len(self) + 1, dtype=np.int64)
+            np.cumsum(self.frequency_array(), out=offsets[1:])
+            self._offsets = offsets
+        return self._offsets
+
+    def find(self, doc_id: int) -> int:
+        """Return the index of a document in this list, or -1."""
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < len(self.doc_ids) and self.doc_ids[i] == doc_id:
+            return i
+        return -1
+
+    def frequency(self, doc_id: int) -> int:
+        """Return the term frequency in a document (0 if absent)."""
+        i = self.find(doc_id)
+        return int(self.frequencies[i]) if i >= 0 else 0
+
+    def positions_at(self, i: int):
+        """Return the positions of the i-th document in this list."""
+        offsets = self.offsets
+        return self.positions[offsets[i]:offsets[i + 1]]
+
+    def positions_for(self, doc_id: int) -> List[int]:
+        """Return a document's positions (empty if absent)."""
+        i = self.find(doc_id)
+        return list(self.positions_at(i)) if i >= 0 else []
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        """Iterate (doc_id, frequency) pairs."""
+        return zip(self.doc_id_array().tolist(), self.frequency_array().tolist())
+
+    def select(self, keep: np.ndarray, new_doc_ids: np.ndarray = None) -> 'PostingList':
+        """Return a new list with only the postings where ``keep`` is true.
+
+        ``new_doc_ids`` optionally renumbers the kept documents (it must stay
+        ascending), which is how compaction and merges remap ids.
+        """
+        doc_ids = self.doc_id_array()[keep]
+        if new_doc_ids is not None:
+            doc_ids = new_doc_ids
+        frequencies = self.frequency_array()[keep]
+        position_mask = np.repeat(keep, self.frequency_array().astype(np.int64))
+        positions = self.position_array()[position_mask]
+        return PostingList(_to_array(doc_ids), _to_array(frequencies), _to_array(positions))
+
+
+def _to_array(values: np.ndarray) -> array:
+    """Copy a NumPy vector into a growable ``array('I')``."""
+    result = array('I')
+    result.frombytes(np.ascontiguousarray(values, dtype=np.uint32).tobytes())
+    return result
+
+def intersect_sorted(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Intersect two ascending id arrays by binary-searching the shorter one into the longer.
+
+    This costs O(m log n) for lengths m <= n, so a rare term intersected with a
+    very common one only pays for the rare term's postings.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return a
+    positions = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[positions] == a]
+
+def intersect_postings(posting_lists: List[PostingList]) -> np.ndarray:
+    """Return the doc ids present in every posting list, intersecting rarest first."""
+    if not posting_lists:
+        return np.zeros(0, dtype=np.uint32)
+    ordered = sorted(posting_lists, key=len)
+    candidates = ordered[0].doc_id_array()
+    for postings in ordered[1:]:
+        if not len(candidates):
+            break
+        candidates = intersect_sorted(candidates, postings.doc_id_array())
+    return candidates
+
+def _gather_positions(postings: PostingList, candidates: np.ndarray):
+    """Return (candidate index, position) pairs for a list's candidate documents.
+
+    Candidates missing from the list contribute no pairs; pairs come out
+    grouped by candidate and sorted by position within each candidate.
+    """
+    doc_ids = postings.doc_id_array()
+    if not len(doc_ids):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    rows = np.minimum(np.searchsorted(doc_ids, candidates), len(doc_ids) - 1)
+    offsets = postings.offsets
+    starts = offsets[rows]
+    lengths = np.where(doc_ids[rows] == candidates, offsets[rows + 1] - starts, 0)
+    owners = np.repeat(np.arange(len(candidates), dtype=np.int64), lengths)
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    positions = postings.position_array()[np.arange(len(owners)) + shift].astype(np.int64)
+    return owners, positions
+
+def match_phrase(posting_lists: List[PostingList], candidates: np.ndarray):
+    """Find candidates where the lists' terms occur consecutively, in list order.
+
+    Each term's occurrences are turned into (candidate, phrase start) keys by
+    subtracting the term's offset in the phrase; keys present for every term
+    are phrase matches. Returns (matching doc ids, phrase occurrence counts).
+    """
+    keys = None
+    for offset, postings in enumerate(posting_lists):
+        owners, positions = _gather_positions(postings, candidates)
+        starts = positions - offset
+        valid = starts >= 0
+        term_keys = (owners[valid] << 32) | starts[valid]
+        keys = term_keys if keys is None else intersect_sorted(keys, term_keys)
+        if not len(keys):
+            break
+
+    matched, counts = np.unique(keys >> 32, return_counts=True)
+    return candidates[matched], counts
+
+def _min_covering_span(positions: List[int], labels: List[int], term_count: int) -> int:
+    """Sliding-window minimum span of positions covering ``term_count`` distinct labels."""
+    counts = {}
+    best = None
+    left = 0
+    for right, label in enumerate(labels):
+        counts[label] = counts.get(label, 0) + 1
+        while len(counts) == term_count:
+            span = positions[right] - positions[left]
+            if best is None or span < best:
+                best = span
+            counts[labels[left]] -= 1
+            if counts[labels[left]] == 0:
+                del counts[labels[left]]
+            left += 1
+    return best
+
+def minimal_spans(posting_lists: List[PostingList], candidates: np.ndarray):
+    """Return, per candidate, the smallest window covering the terms it contains.
+
+    Lists must be for distinct terms. Returns (spans, matched) where matched is
+    the number of the terms present in the candidate and span is last minus
+    first position of the tightest window holding each of them (0 when fewer
+    than two terms are present).
+    """
+    term_count = len(posting_lists)
+    spans = np.zeros(len(candidates), dtype=np.int64)
+    if not term_count or not len(candidates):
+        return spans, np.zeros(len(candidates), dtype=np.int64)
+
+    gathered = [_gather_positions(postings, candidates) for postings in posting_lists]
+    matched = np.zeros(len(candidates), dtype=np.int64)
+    for owners, _ in gathered:
+        matched[np.unique(owners)] += 1
+    if term_count < 2:
+        return spans, matched
+
+    owners = np.concatenate([owner for owner, _ in gathered])
+    positions = np.concatenate([position for _, position in gathered])
+    labels = np.repeat(np.arange(term_count), [len(owner) for owner, _ in gathered])
+    # Each list is already sorted by (owner, position), so a stable sort merges the runs
+    order = np.argsort((owners << 32) | positions, kind='stable')
+    owners, positions, labels = owners[order], positions[order], labels[order]
+
+    if term_count == 2:
+        # With two terms the best window is always a pair of neighbours with different labels
+        valid = (owners[1:] == owners[:-1]) & (labels[1:] != labels[:-1])
+        pair_owners = owners[1:][valid]
+        gaps = (positions[1:] - positions[:-1])[valid]
+        if len(gaps):
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(pair_owners)) + 1))
+            spans[pair_owners[starts]] = np.minimum.reduceat(gaps, starts)
+        return spans, matched
+
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(owners)) + 1, [len(owners)])).tolist()
+    owner_list, positions, labels = owners.tolist(), positions.tolist(), labels.tolist()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        owner = owner_list[start]
+        if matched[owner] >= 2:
+            spans[owner] = _min_covering_span(positions[start:end], labels[start:end], int(matched[owner]))
+    return spans, matched
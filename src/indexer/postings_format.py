@@ -0,0 +1,468 @@
+"""
+Binary on-disk format for the inverted index.
+
+File layout (all integers little-endian):
+
+    magic            8 bytes   b'SEIDX\\x00\\x00\\x00'
+    version          uint32
+    header length    uint64
+    header           UTF-8 JSON (document table, metadata, build id, section
+                     sizes and optional scoring and vocabulary pruning records)
+    term dictionary  front-coded TermDictionary of the sorted terms (UTF-8 byte
+                     order matches str order); a term's ordinal indexes the stats
+    term stats       uint32[term_count] document frequencies
+                     uint32[term_count] collection frequencies
+                     uint64[term_count] byte offsets into the postings section
+    postings         per term: varbyte doc-id gaps, varbyte term frequencies,
+                     varbyte position gaps (restarting at every document)
+    impacts          optional; one quantized ranking impact (uint8, or uint16
+                     above 8 bits) per posting, in term then document order,
+                     described by the header's ``scoring`` entry
+    upper bounds     with impacts: the largest impact of every term, in the
+                     same integer type, for dynamic pruning
+    block maxima     with impacts: every term's postings split into blocks of
+                     ``block_size``; the largest impact of each block (impact
+                     type), then the last doc id of each block (uint32)
+
+External document ids are stored once in the document table; postings use the
+integer id (the position in that table) so doc-id lists can be delta-gap encoded.
+The dictionary and the fixed-width stats arrays let MappedIndex look terms up
+and locate postings directly in an mmap.
+"""
+
+import json
+import mmap
+import struct
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, List, Any, Iterable, Iterator
+import numpy as np
+from .postings import PostingList
+from .term_dictionary import TermDictionary
+from .scoring import BM25, ImpactIndex
+
+MAGIC = b'SEIDX\x00\x00\x00'
+FORMAT_VERSION = 5
+
+_PREAMBLE = struct.Struct('<8sIQ')
+
+
+def encode_varbyte(values: Iterable[int]) -> bytes:
+    """Encode non-negative integers as variable-byte (LEB128) codes."""
+    values = np.asarray(values, dtype=np.uint64).ravel()
+    if values.size == 0:
+        return b''
+
+    # Number of 7-bit groups needed per value (at least one, even for zero)
+    bit_lengths = np.zeros(values.size, dtype=np.int64)
+    remaining = values.copy()
+    while remaining.any():
+        nonzero = remaining > 0
+        bit_lengths[nonzero] += 7
+        remaining >>= np.uint64(7)
+    byte_counts = np.maximum(bit_lengths // 7, 1)
+
+    max_bytes = int(byte_counts.max())
+    groups = np.zeros((values.size, max_bytes), dtype=np.uint8)
+    for k in range(max_bytes):
+        chunk = (values >> np.uint64(7 * k)) & np.uint64(0x7F)
+        continuation = (byte_counts > k + 1).astype(np.uint64) << np.uint64(7)
+        groups[:, k] = (chunk | continuation).astype(np.uint8)
+
+    mask = np.arange(max_bytes) < byte_counts[:, None]
+    return groups[mask].tobytes()
+
+
+def decode_varbyte(data) -> np.ndarray:
+    """Decode a buffer of variable-byte codes into a uint64 array."""
+    encoded = np.frombuffer(data, dtype=np.uint8)
+    if encoded.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    ends = np.flatnonzero((encoded & 0x80) == 0)
+    if ends.size == 0 or ends[-1] != encoded.size - 1:
+        raise ValueError("Truncated variable-byte stream")
+
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    # Shift of each byte within its value: 0, 7, 14, ...
+    lengths = ends - starts + 1
+    offsets_in_value = np.arange(encoded.size) - np.repeat(starts, lengths)
+    payload = (encoded & 0x7F).astype(np.uint64) << (offsets_in_value * 7).astype(np.uint64)
+    return np.add.reduceat(payload, starts)
+
+
+def _segmented_cumsum(gaps: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Prefix-sum gaps, restarting the running total at every segment boundary."""
+    if gaps.size == 0:
+        return gaps.astype(np.int64)
+
+    lengths = lengths.astype(np.int64)
+    running = np.cumsum(gaps.astype(np.int64))
+    starts = np.concatenate(([0], np.cumsum(lengths[:-1])))
+    base = np.where(starts > 0, running[np.maximum(starts - 1, 0)], 0)
+    return running - np.repeat(base, lengths)
+
+
+def _encode_term_postings(postings: PostingList) -> bytes:
+    """Encode one term's postings as doc gaps, frequencies and position gaps."""
+    doc_ids = postings.doc_id_array().astype(np.int64)
+    frequencies = postings.frequency_array().astype(np.int64)
+    positions = postings.position_array().astype(np.int64)
+
+    # Position gaps restart at the first occurrence in every document
+    position_gaps = np.diff(positions, prepend=0)
+    doc_starts = postings.offsets[:-1]
+    position_gaps[doc_starts] = positions[doc_starts]
+
+    doc_gaps = np.diff(doc_ids, prepend=0)
+    return encode_varbyte(np.concatenate((doc_gaps, frequencies, position_gaps)))
+
+
+def write_index(filepath: str, index: Mapping, documents: List[str],
+                document_metadata: Dict[str, Dict[str, Any]], total_documents: int,
+                scoring: BM25 = None, pruning: Dict[str, Any] = None, build_id: str = None):
+    """Write an inverted index to the binary format.
+
+    ``index`` maps terms to PostingLists whose integer doc ids index into
+    ``documents``, the table of external document ids. With ``scoring`` the
+    quantized BM25 impact of every posting is precomputed and stored too.
+    ``pruning`` records a vocabulary pruning pass (see
+    ``InvertedIndex.prune_vocabulary``) in the header, and ``build_id`` the
+    document set the file holds (see ``InvertedIndex.build_id``).
+    """
+    terms = sorted(term for term, postings in index.items() if len(postings))
+    dictionary_bytes = TermDictionary.encode(terms)
+
+    document_frequencies = np.zeros(len(terms), dtype='<u4')
+    collection_frequencies = np.zeros(len(terms), dtype='<u4')
+    postings_offsets = np.zeros(len(terms), dtype='<u8')
+    postings_chunks = []
+    postings_size = 0
+
+    for i, term in enumerate(terms):
+        postings = index[term]
+        document_frequencies[i] = len(postings)
+        collection_frequencies[i] = len(postings.positions)
+        postings_offsets[i] = postings_size
+
+        chunk = _encode_term_postings(postings)
+        postings_chunks.append(chunk)
+        postings_size += len(chunk)
+
+    header = {
+        'documents': list(documents),
+        'document_metadata': document_metadata,
+        'total_documents': total_documents,
+        'term_count': len(terms),
+        'dictionary_size': len(dictionary_bytes),
+        'postings_size': postings_size
+    }
+
+    impacts_bytes = b''
+    if scoring is not None:
+        impact_index = scoring.compute_impacts({term: index[term] for term in terms})
+        sections = [
+            [impact_index.impacts[term] for term in terms],
+            [np.asarray([impact_index.upper_bounds[term] for term in terms], dtype=scoring.impact_dtype)],
+            [impact_index.block_maxima[term] for term in terms],
+            [impact_index.block_last_ids[term].astype('<u4') for term in terms]
+        ]
+        impacts_bytes = b''.join(array.tobytes() for section in sections for array in section)
+        header['scoring'] = dict(scoring.parameters(), impact_scale=impact_index.scale)
+    if pruning:
+        header['pruning'] = pruning
+    if build_id:
+        header['build_id'] = build_id
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+
+    with open(filepath, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        f.write(dictionary_bytes)
+        f.write(document_frequencies.tobytes())
+        f.write(collection_frequencies.tobytes())
+        f.write(postings_offsets.tobytes())
+        for chunk in postings_chunks:
+            f.write(chunk)
+        f.write(impacts_bytes)
+
+
+def is_binary_index(filepath: str) -> bool:
+    """Check whether a file starts with the binary index magic bytes."""
+    try:
+        with open(filepath, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def _parse_preamble(buffer) -> Dict[str, Any]:
+    """Validate the preamble and return the header plus section offsets."""
+    if len(buffer) < _PREAMBLE.size:
+        raise ValueError("File too small to be a binary index")
+
+    magic, version, header_length = _PREAMBLE.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a binary index file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported index format version {version} (expected {FORMAT_VERSION}); "
+                         f"rebuild the index with run_indexer.py")
+
+    header_start = _PREAMBLE.size
+    header = json.loads(bytes(buffer[header_start:header_start + header_length]).decode('utf-8'))
+
+    dictionary_start = header_start + header_length
+    stats_start = dictionary_start + header['dictionary_size']
+    postings_start = stats_start + header['term_count'] * 16
+
+    header['_dictionary_start'] = dictionary_start
+    header['_stats_start'] = stats_start
+    header['_postings_start'] = postings_start
+    return header
+
+
+def _parse_terms(buffer, header: Dict[str, Any]) -> TermDictionary:
+    """Open the term dictionary section in place."""
+    return TermDictionary(buffer, header['_dictionary_start'])
+
+
+def _parse_term_stats(buffer, header: Dict[str, Any]):
+    """Return (document frequencies, collection frequencies, postings offsets)."""
+    count = header['term_count']
+    start = header['_stats_start']
+    document_frequencies = np.frombuffer(buffer, dtype='<u4', count=count, offset=start)
+    collection_frequencies = np.frombuffer(buffer, dtype='<u4', count=count, offset=start + 4 * count)
+    postings_offsets = np.frombuffer(buffer, dtype='<u8', count=count, offset=start + 8 * count)
+    return document_frequencies, collection_frequencies, postings_offsets
+
+
+def _impact_dtype(scoring: Dict[str, Any]) -> np.dtype:
+    return BM25(scoring['k1'], scoring['b'], scoring['impact_bits']).impact_dtype
+
+
+def _impact_sections(scoring: Dict[str, Any], start: int, document_frequencies: np.ndarray):
+    """Return [(start, dtype, per-term counts or None)] for the impacts, upper bounds and block sections."""
+    dtype = _impact_dtype(scoring)
+    block_counts = -(-document_frequencies.astype(np.int64) // scoring['block_size'])
+    layout = [(dtype, document_frequencies.astype(np.int64)), (dtype, None),
+              (dtype, block_counts), (np.dtype('<u4'), block_counts)]
+    sections = []
+    for section_dtype, counts in layout:
+        sections.append((start, section_dtype, counts))
+        total = len(document_frequencies) if counts is None else int(counts.sum())
+        start += total * section_dtype.itemsize
+    return sections
+
+
+def read_index(filepath: str) -> Dict[str, Any]:
+    """Read a whole binary index file into memory."""
+    with open(filepath, 'rb') as f:
+        buffer = f.read()
+
+    header = _parse_preamble(buffer)
+    # Detach the dictionary from the file buffer so it does not keep the whole file alive
+    start = header['_dictionary_start']
+    terms = TermDictionary(buffer[start:start + header['dictionary_size']])
+    document_frequencies, collection_frequencies, _ = _parse_term_stats(buffer, header)
+
+    postings_start = header['_postings_start']
+    values = decode_varbyte(buffer[postings_start:postings_start + header['postings_size']]).astype(np.int64)
+
+    # Split the decoded stream into doc gaps, frequencies and position gaps for all terms at once
+    document_frequencies = document_frequencies.astype(np.int64)
+    value_counts = 2 * document_frequencies + collection_frequencies.astype(np.int64)
+    # One start per term, so a file without terms gives empty arrays
+    term_starts = np.cumsum(value_counts) - value_counts
+    offsets_in_term = np.arange(values.size) - np.repeat(term_starts, value_counts)
+    df_per_value = np.repeat(document_frequencies, value_counts)
+
+    frequencies = values[(offsets_in_term >= df_per_value) & (offsets_in_term < 2 * df_per_value)]
+    doc_ids = _segmented_cumsum(values[offsets_in_term < df_per_value], document_frequencies).astype(np.uint32)
+    positions = _segmented_cumsum(values[offsets_in_term >= 2 * df_per_value], frequencies).astype(np.uint32)
+    frequencies = frequencies.astype(np.uint32)
+
+    # Every term's PostingList is a view into the three shared arrays
+    doc_bounds = np.concatenate(([0], np.cumsum(document_frequencies))).tolist()
+    position_bounds = np.concatenate(([0], np.cumsum(collection_frequencies, dtype=np.int64))).tolist()
+    index = {}
+    for i, term in enumerate(terms):
+        d0, d1 = doc_bounds[i], doc_bounds[i + 1]
+        p0, p1 = position_bounds[i], position_bounds[i + 1]
+        index[term] = PostingList(doc_ids[d0:d1], frequencies[d0:d1], positions[p0:p1])
+
+    impact_index = None
+    scoring = header.get('scoring')
+    if scoring is not None:
+        # Copied out of the file buffer, like the dictionary
+        term_list = list(terms)
+        sections = []
+        for start, dtype, counts in _impact_sections(scoring, postings_start + header['postings_size'],
+                                                     document_frequencies):
+            count = len(term_list) if counts is None else int(counts.sum())
+            values = np.frombuffer(buffer, dtype=dtype, count=count, offset=start).copy()
+            if counts is None:
+                sections.append(dict(zip(term_list, values.tolist())))
+            else:
+                bounds = np.concatenate(([0], np.cumsum(counts))).tolist()
+                sections.append({term: values[bounds[i]:bounds[i + 1]] for i, term in enumerate(term_list)})
+        impacts, upper_bounds, block_maxima, block_last_ids = sections
+        impact_index = ImpactIndex(scoring['impact_scale'], scoring['block_size'], impacts, upper_bounds,
+                                   block_last_ids, block_maxima)
+
+    return {
+        'index': index,
+        'documents': header['documents'],
+        'document_metadata': header['document_metadata'],
+        'terms': terms,
+        'total_documents': header['total_documents'],
+        'scoring': scoring,
+        'impacts': impact_index,
+        'pruning': header.get('pruning', {}),
+        'build_id': header.get('build_id')
+    }
+
+
+class MappedTermArrays(Mapping):
+    """term -> values of one impact section of a mapped index.
+
+    ``counts`` gives each term's number of values (None for one scalar per
+    term). Lookups copy the term's values out of the map, so no array keeps
+    the map from being closed.
+    """
+
+    def __init__(self, mapped_index: 'MappedIndex', start: int, dtype: np.dtype, counts: np.ndarray = None):
+        self._mapped_index = mapped_index
+        self._start = start
+        self._dtype = dtype
+        self._offsets = None if counts is None else np.concatenate(([0], np.cumsum(counts)))
+
+    def __getitem__(self, term: str):
+        ordinal = self._mapped_index.terms[term]
+        itemsize = self._dtype.itemsize
+        if self._offsets is None:
+            position = self._start + ordinal * itemsize
+            return int(np.frombuffer(self._mapped_index._mmap[position:position + itemsize], dtype=self._dtype)[0])
+        start = self._start + int(self._offsets[ordinal]) * itemsize
+        end = self._start + int(self._offsets[ordinal + 1]) * itemsize
+        return np.frombuffer(self._mapped_index._mmap[start:end], dtype=self._dtype)
+
+    def __contains__(self, term) -> bool:
+        return term in self._mapped_index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._mapped_index)
+
+    def __len__(self) -> int:
+        return len(self._mapped_index)
+
+
+class MappedIndex(Mapping):
+    """Memory-mapped binary index exposing term -> PostingList lazily.
+
+    Only the header (document table and metadata) is parsed when the file is
+    opened; term lookups binary-search the mapped dictionary and postings are
+    decoded on first access, so startup cost and resident memory do not grow
+    with the number of postings and the pages are shared between processes.
+    """
+
+    def __init__(self, filepath: str, cache_size: int = 1024):
+        self.filepath = filepath
+        self._file = open(filepath, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            header = _parse_preamble(self._mmap)
+        except ValueError:
+            self._mmap.close()
+            self._file.close()
+            raise
+        self.documents = header['documents']
+        self.document_metadata = header['document_metadata']
+        self.total_documents = header['total_documents']
+        self.pruning = header.get('pruning', {})
+        self.build_id = header.get('build_id')
+
+        self.terms = _parse_terms(self._mmap, header)
+        self._document_frequencies, self._collection_frequencies, self._postings_offsets = \
+            _parse_term_stats(self._mmap, header)
+        self._postings_start = header['_postings_start']
+        self._postings_size = header['postings_size']
+
+        self.scoring = header.get('scoring')
+        self._impacts = None
+
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+
+    @property
+    def impacts(self) -> ImpactIndex:
+        """Stored impacts and their bounds, or None; section offsets are computed on first use."""
+        if self._impacts is None and self.scoring is not None:
+            sections = [MappedTermArrays(self, start, dtype, counts) for start, dtype, counts in
+                        _impact_sections(self.scoring, self._postings_start + self._postings_size,
+                                         self._document_frequencies)]
+            impacts, upper_bounds, block_maxima, block_last_ids = sections
+            self._impacts = ImpactIndex(self.scoring['impact_scale'], self.scoring['block_size'], impacts,
+                                        upper_bounds, block_last_ids, block_maxima)
+        return self._impacts
+
+    def document_frequency(self, term: str) -> int:
+        """Return a term's document frequency without decoding its postings."""
+        ordinal = self.terms.find(term)
+        return int(self._document_frequencies[ordinal]) if ordinal >= 0 else 0
+
+    def total_postings(self) -> int:
+        """Return the number of (term, document) postings in the index."""
+        return int(self._document_frequencies.sum(dtype=np.int64))
+
+    def _decode_postings(self, ordinal: int) -> PostingList:
+        start = int(self._postings_offsets[ordinal])
+        if ordinal + 1 < len(self.terms):
+            end = int(self._postings_offsets[ordinal + 1])
+        else:
+            end = self._postings_size
+
+        values = decode_varbyte(self._mmap[self._postings_start + start:self._postings_start + end]).astype(np.int64)
+        df = int(self._document_frequencies[ordinal])
+        doc_ids = np.cumsum(values[:df]).astype(np.uint32)
+        frequencies = values[df:2 * df]
+        positions = _segmented_cumsum(values[2 * df:], frequencies).astype(np.uint32)
+        return PostingList(doc_ids, frequencies.astype(np.uint32), positions)
+
+    def __getitem__(self, term: str) -> PostingList:
+        with self._cache_lock:
+            postings = self._cache.get(term)
+            if postings is not None:
+                self._cache.move_to_end(term)
+                return postings
+
+        postings = self._decode_postings(self.terms[term])
+        with self._cache_lock:
+            self._cache[term] = postings
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return postings
+
+    def __contains__(self, term) -> bool:
+        return term in self.terms
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.terms)
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def close(self):
+        """Release the memory map and file handle."""
+        self._cache.clear()
+        # NumPy views over the map must go before it can be closed
+        self._document_frequencies = self._collection_frequencies = self._postings_offsets = None
+        self.terms = None
+        self.scoring = self._impacts = None
+        self._mmap.close()
+        self._file.close()
@@ -0,0 +1,137 @@
+"""
+Precomputed term impact scores for ranking.
+
+A posting's impact is its term's whole contribution to a document's score, so
+it can be computed once at index time and quantized into a small integer;
+scoring a query then only sums the impacts of the query terms' postings.
+"""
+
+from collections.abc import Mapping
+from typing import Dict, Tuple
+import numpy as np
+
+SCORING_MODELS = ('tfidf', 'bm25')
+
+
+class ImpactIndex:
+    """Quantized impacts of an index plus the upper bounds used for pruning.
+
+    ``impacts[term]`` is aligned with the term's postings and
+    ``upper_bounds[term]`` is its largest impact. Postings are also split into
+    blocks of ``block_size``; ``block_last_ids[term]`` and ``block_maxima[term]``
+    hold each block's last doc id and largest impact (Block-Max metadata).
+    Sections are any term-keyed Mapping, so they can be dicts of arrays or
+    views over a memory-mapped index.
+    """
+
+    def __init__(self, scale: float, block_size: int, impacts: Mapping, upper_bounds: Mapping,
+                 block_last_ids: Mapping, block_maxima: Mapping):
+        self.scale = scale
+        self.block_size = block_size
+        self.impacts = impacts
+        self.upper_bounds = upper_bounds
+        self.block_last_ids = block_last_ids
+        self.block_maxima = block_maxima
+
+
+class BM25:
+    """Okapi BM25 with per-posting impacts quantized to ``impact_bits`` integers.
+
+    All impacts share one scale (the largest impact maps to the top integer
+    value), so summed quantized impacts rank documents like the exact scores
+    up to rounding, and ``sum * impact_scale`` approximates the BM25 score.
+    Every posting gets an impact of at least 1, so any match scores above 0.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, impact_bits: int = 8, block_size: int = 128):
+        if not 1 <= impact_bits <= 16:
+            raise ValueError(f"impact_bits must be between 1 and 16, got {impact_bits}")
+        if block_size < 1:
+            raise ValueError(f"block_size must be positive, got {block_size}")
+        self.k1 = float(k1)
+        self.b = float(b)
+        self.impact_bits = int(impact_bits)
+        self.block_size = int(block_size)
+
+    @classmethod
+    def from_config(cls, config) -> 'BM25':
+        """Read k1, b, the impact precision and the block size from ``indexer.scoring``."""
+        return cls(k1=config.get('indexer.scoring.k1', 1.2),
+                   b=config.get('indexer.scoring.b', 0.75),
+                   impact_bits=config.get('indexer.scoring.impact_bits', 8),
+                   block_size=config.get('indexer.scoring.block_size', 128))
+
+    @property
+    def impact_dtype(self) -> np.dtype:
+        return np.dtype(np.uint8 if self.impact_bits <= 8 else '<u2')
+
+    def parameters(self) -> Dict[str, float]:
+        """Parameters the stored impacts depend on."""
+        return {'model': 'bm25', 'k1': self.k1, 'b': self.b, 'impact_bits': self.impact_bits,
+                'block_size': self.block_size}
+
+    def matches(self, parameters: Dict[str, float]) -> bool:
+        """Whether impacts stored with ``parameters`` were computed with this model."""
+        return parameters is not None and all(parameters.get(key) == value
+                                              for key, value in self.parameters().items())
+
+    @staticmethod
+    def idf(document_frequencies: np.ndarray, total_documents: int) -> np.ndarray:
+        """BM25 inverse document frequency, kept positive for very common terms."""
+        document_frequencies = np.asarray(document_frequencies, dtype=np.float64)
+        return np.log(1 + (total_documents - document_frequencies + 0.5) / (document_frequencies + 0.5))
+
+    def compute_impacts(self, index: Mapping) -> ImpactIndex:
+        """Compute quantized impacts and their upper bounds for a term -> PostingList mapping.
+
+        Document lengths are the number of indexed tokens (the summed term
+        frequencies of each document), and the collection size is the number of
+        documents with postings. The per-term arrays of the result are views
+        into one array per section.
+        """
+        terms = list(index.keys())
+        posting_lists = [index[term] for term in terms]
+        lengths = np.fromiter((len(postings) for postings in posting_lists), dtype=np.int64, count=len(terms))
+        empty = np.zeros(0, dtype=self.impact_dtype)
+        if not lengths.sum():
+            return ImpactIndex(1.0, self.block_size, dict.fromkeys(terms, empty), dict.fromkeys(terms, 0),
+                               dict.fromkeys(terms, np.zeros(0, dtype=np.uint32)), dict.fromkeys(terms, empty))
+
+        doc_ids = np.concatenate([postings.doc_id_array() for postings in posting_lists]).astype(np.int64)
+        frequencies = np.concatenate([postings.frequency_array() for postings in posting_lists]).astype(np.float64)
+
+        # Length normalization: |d| / avgdl over the documents that have postings
+        document_lengths = np.bincount(doc_ids, weights=frequencies)
+        indexed = document_lengths > 0
+        total_documents = int(np.count_nonzero(indexed))
+        average_length = document_lengths[indexed].mean()
+        normalization = self.k1 * (1 - self.b + self.b * document_lengths[doc_ids] / average_length)
+
+        idf = np.repeat(self.idf(lengths, total_documents), lengths)
+        impacts = idf * frequencies * (self.k1 + 1) / (frequencies + normalization)
+
+        max_value = (1 << self.impact_bits) - 1
+        scale = float(impacts.max()) / max_value if impacts.max() > 0 else 1.0
+        quantized = np.clip(np.rint(impacts / scale), 1, max_value).astype(self.impact_dtype)
+
+        bounds = np.concatenate(([0], np.cumsum(lengths)))
+        upper_bounds = np.zeros(len(terms), dtype=np.int64)
+        nonempty = lengths > 0
+        upper_bounds[nonempty] = np.maximum.reduceat(quantized, bounds[:-1][nonempty])
+
+        # Every term's postings split into blocks of block_size; all blocks are non-empty
+        block_counts = -(-lengths // self.block_size)
+        block_bounds = np.concatenate(([0], np.cumsum(block_counts)))
+        offsets_in_term = np.arange(len(quantized)) - np.repeat(bounds[:-1], lengths)
+        block_of_posting = np.repeat(block_bounds[:-1], lengths) + offsets_in_term // self.block_size
+        block_starts = np.flatnonzero(np.diff(block_of_posting, prepend=-1))
+        block_maxima = np.maximum.reduceat(quantized, block_starts)
+        block_last_ids = doc_ids[np.append(block_starts[1:], len(quantized)) - 1].astype(np.uint32)
+
+        bounds, block_bounds = bounds.tolist(), block_bounds.tolist()
+        return ImpactIndex(
+            scale, self.block_size,
+            {term: quantized[bounds[i]:bounds[i + 1]] for i, term in enumerate(terms)},
+            dict(zip(terms, upper_bounds.tolist())),
+            {term: block_last_ids[block_bounds[i]:block_bounds[i + 1]] for i, term in enumerate(terms)},
+            {term: block_maxima[block_bounds[i]:block_bounds[i + 1]] for i, term in enumerate(terms)})
@@ -0,0 +1,566 @@
+import os
+import json
+import shutil
+import threading
+import uuid
+from collections import ChainMap
+from contextlib import contextmanager
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import Dict, List, Any, Tuple, Iterator
+from common.config import Config
+from common.logger import setup_logger
+from .inverted_index import InvertedIndex
+from .term_dictionary import TermDictionary
+from .topk import top_k_items
+
+logger = setup_logger(__name__)
+
+@dataclass
+class Segment:
+    """An immutable, memory-mapped index segment."""
+
+    name: str
+    index: InvertedIndex
+    references: int = 0  # queries currently reading the segment (see SegmentedIndex._pinned)
+
+    @property
+    def document_count(self) -> int:
+        return self.index.total_documents
+
+class TieredMergePolicy:
+    """Merge runs of adjacent segments whose sizes fall in the same tier.
+
+    A segment's tier is log_{segments_per_tier} of its document count, so
+    segments are merged once ``segments_per_tier`` of a similar size pile up and
+    the number of live segments stays logarithmic in the corpus size.
+    """
+
+    def __init__(self, segments_per_tier: int = 4, max_deleted_ratio: float = 0.3):
+        self.segments_per_tier = max(2, segments_per_tier)
+        self.max_deleted_ratio = max_deleted_ratio
+
+    def _tier(self, document_count: int) -> int:
+        tier = 0
+        while document_count >= self.segments_per_tier:
+            document_count //= self.segments_per_tier
+            tier += 1
+        return tier
+
+    def find_merges(self, document_counts: List[int], deleted_counts: List[int] = None) -> List[Tuple[int, int]]:
+        """Return non-overlapping [start, end) ranges of segments to merge.
+
+        A segment whose share of deleted documents exceeds ``max_deleted_ratio``
+        is rewritten on its own so its tombstoned postings get purged.
+        """
+        deleted_counts = deleted_counts or [0] * len(document_counts)
+        merges = []
+        start = 0
+        while start < len(document_counts):
+            tier = self._tier(document_counts[start])
+            end = start + 1
+            while end < len(document_counts) and self._tier(document_counts[end]) == tier:
+                end += 1
+
+            run_start = start
+            while end - run_start >= self.segments_per_tier:
+                merges.append((run_start, run_start + self.segments_per_tier))
+                run_start += self.segments_per_tier
+
+            for position in range(run_start, end):
+                stored = document_counts[position] + deleted_counts[position]
+                if deleted_counts[position] and deleted_counts[position] > self.max_deleted_ratio * stored:
+                    merges.append((position, position + 1))
+            start = end
+
+        return merges
+
+class SegmentedPostings(Mapping):
+    """Read-only term -> {doc_id: positions} view across a snapshot of segments."""
+
+    def __init__(self, indexes: List[InvertedIndex]):
+        self._indexes = indexes
+
+    def __getitem__(self, term: str) -> Dict[str, List[int]]:
+        postings = {}
+        found = False
+        for index in self._indexes:
+            if term in index.index:
+                postings.update(index.get_postings(term))
+                found = True
+        if not found:
+            raise KeyError(term)
+        return postings
+
+    def __contains__(self, term) -> bool:
+        return any(term in index.index for index in self._indexes)
+
+    def __iter__(self) -> Iterator[str]:
+        seen = set()
+        for index in self._indexes:
+            for term in index.index:
+                if term not in seen:
+                    seen.add(term)
+                    yield term
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+class SegmentedIndex:
+    """Inverted index made of immutable on-disk segments plus an in-memory buffer.
+
+    New documents go into the buffer, which is sealed into a fresh binary
+    segment by ``flush``; queries read every live segment, and a merge policy
+    combines small segments in a background thread. Adding documents therefore
+    costs time proportional to the new data rather than to the corpus.
+    Segments are not vocabulary-pruned (see ``InvertedIndex.prune_vocabulary``);
+    the stop terms and pruning records of adopted builds survive merges.
+    """
+
+    MANIFEST_NAME = 'segments.json'
+
+    def __init__(self, directory: str, merge_policy: TieredMergePolicy = None, background_merges: bool = None):
+        self.config = Config()
+        self.directory = directory
+        self.merge_policy = merge_policy or TieredMergePolicy(
+            self.config.get('indexer.segments.segments_per_tier', 4))
+        self.background_merges = (self.config.get('indexer.segments.background_merges', True)
+                                  if background_merges is None else background_merges)
+        self.max_buffered_documents = self.config.get('indexer.segments.max_buffered_documents', 1000)
+
+        self.buffer = InvertedIndex()
+        self.segments: List[Segment] = []
+        self._generation = 0
+        self._build_id = None  # id of the current document set, see build_id
+        self._orphans_removed = False  # see _remove_orphans
+        self._retired: List[Segment] = []  # merged away, but still read by running queries
+        self._lock = threading.RLock()
+        self._merge_thread = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_segments()
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        """Check whether a directory holds a segmented index."""
+        return os.path.exists(os.path.join(directory, cls.MANIFEST_NAME))
+
+    def _load_segments(self):
+        """Open the segments listed in the manifest."""
+        manifest_path = os.path.join(self.directory, self.MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            self._generation = manifest['generation']
+            self._build_id = manifest.get('build_id')
+            deleted = manifest.get('deleted', {})
+            for name in manifest['segments']:
+                segment = self._open_segment(name)
+                for doc_id in deleted.get(name, []):
+                    segment.index.delete_document(doc_id)
+                self.segments.append(segment)
+
+        logger.info(f"Opened segmented index at {self.directory} with {len(self.segments)} segments")
+
+    def _open_segment(self, name: str) -> Segment:
+        index = InvertedIndex()
+        index.load_index(os.path.join(self.directory, name), mmap=True)
+        return Segment(name, index)
+
+    def _next_segment_name(self) -> str:
+        with self._lock:
+            if not self._orphans_removed:
+                self._remove_orphans()
+            self._generation += 1
+            return f"segment_{self._generation:06d}.bin"
+
+    def _remove_orphans(self):
+        """Drop segment files the manifest does not list, left behind by an interrupted flush or merge.
+
+        Only a writer does this, before it writes its first segment: an
+        instance that merely opened the directory could otherwise delete a
+        segment another process is still writing. A directory has one writer
+        at a time.
+        """
+        live_names = {segment.name for segment in self.segments}
+        for filename in os.listdir(self.directory):
+            if filename.startswith('segment_') and filename not in live_names:
+                self._remove_file(filename)
+        self._orphans_removed = True
+
+    def _write_manifest(self):
+        """Atomically replace the manifest with the current segment list."""
+        manifest = {
+            'generation': self._generation,
+            'build_id': self.build_id,
+            'segments': [segment.name for segment in self.segments],
+            'deleted': {segment.name: sorted(segment.index.deleted_documents)
+                        for segment in self.segments if segment.index.deleted_count}
+        }
+        manifest_path = os.path.join(self.directory, self.MANIFEST_NAME)
+        temp_path = manifest_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temp_path, manifest_path)
+
+    def _remove_file(self, filename: str):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError as e:
+            # Still mapped elsewhere (e.g. on Windows); cleaned up on the next open
+            logger.warning(f"Could not remove segment file {filename}: {str(e)}")
+
+    def add_segment_file(self, filepath: str) -> Segment:
+        """Adopt an existing binary index file (e.g. a full build) as a new segment."""
+        name = self._next_segment_name()
+        shutil.copyfile(filepath, os.path.join(self.directory, name))
+        segment = self._open_segment(name)
+
+        with self._lock:
+            # A lone adopted build keeps its id, so files built for it (e.g. the TF-IDF matrix) still match
+            self._build_id = (segment.index.build_id if not self.segments and not self.buffer.total_documents
+                              else None)
+            self.segments.append(segment)
+            self._write_manifest()
+
+        logger.info(f"Added {filepath} as segment {name} with {segment.document_count} documents")
+        return segment
+
+    def add_document(self, document_id: str, content: str, metadata: Dict[str, Any] = None) -> List[str]:
+        """Buffer a document; the buffer is flushed once it reaches the configured size.
+
+        Adding a document that already lives in a sealed segment tombstones the
+        old version there, so this doubles as an update. Returns the document's
+        analyzed terms, like ``InvertedIndex.add_document``.
+        """
+        with self._lock:
+            self._build_id = None
+            if self._delete_from_segments(document_id):
+                self._write_manifest()
+            terms = self.buffer.add_document(document_id, content, metadata)
+            buffer_full = self.buffer.total_documents >= self.max_buffered_documents
+        if buffer_full:
+            self.flush()
+        return terms
+
+    def update_document(self, document_id: str, content: str, metadata: Dict[str, Any] = None):
+        """Replace a document with a new version."""
+        self.add_document(document_id, content, metadata)
+
+    def delete_document(self, document_id: str) -> bool:
+        """Tombstone a document wherever it lives; merges purge its postings."""
+        with self._lock:
+            deleted = self.buffer.delete_document(document_id)
+            if deleted:
+                self._build_id = None
+            if self._delete_from_segments(document_id):
+                self._write_manifest()
+                deleted = True
+        if deleted:
+            self.maybe_merge()
+        return deleted
+
+    def _delete_from_segments(self, document_id: str) -> bool:
+        """Tombstone a document in the sealed segments that contain it."""
+        deleted = False
+        for segment in self.segments:
+            if segment.index.delete_document(document_id):
+                deleted = True
+        if deleted:
+            self._build_id = None
+        return deleted
+
+    def flush(self) -> Segment:
+        """Seal buffered documents into a new immutable segment."""
+        with self._lock:
+            if self.buffer.total_documents == 0:
+                return None
+
+            name = self._next_segment_name()
+            self.buffer.save_index(os.path.join(self.directory, name), format='binary')
+            segment = self._open_segment(name)
+
+            self.segments.append(segment)
+            self._write_manifest()
+            self.buffer = InvertedIndex()
+
+        logger.info(f"Flushed segment {name} with {segment.document_count} documents")
+        self.maybe_merge()
+        return segment
+
+    def maybe_merge(self):
+        """Run the merge policy, in a background thread if configured."""
+        if not self.background_merges:
+            self._run_merges()
+            return
+
+        with self._lock:
+            if self._merge_thread and self._merge_thread.is_alive():
+                return
+            self._merge_thread = threading.Thread(target=self._run_merges, name='segment-merger', daemon=True)
+            self._merge_thread.start()
+
+    def wait_for_merges(self):
+        """Block until any background merge has finished."""
+        thread = self._merge_thread
+        if thread:
+            thread.join()
+
+    def _run_merges(self):
+        """Keep merging until the policy finds nothing left to merge."""
+        try:
+            while True:
+                with self._lock:
+                    snapshot = list(self.segments)
+                merges = self.merge_policy.find_merges(
+                    [segment.document_count for segment in snapshot],
+                    [segment.index.deleted_count for segment in snapshot])
+                if not merges:
+                    return
+                for start, end in merges:
+                    self._merge_segments(snapshot[start:end])
+        except Exception as e:
+            logger.error(f"Error merging segments: {str(e)}")
+
+    def _merge_segments(self, group: List[Segment]):
+        """Merge adjacent segments into one and swap it into the segment list."""
+        with self._lock:
+            deleted_before = [set(segment.index.deleted_documents) for segment in group]
+
+        # Tombstoned documents are dropped by merge(), which purges their postings
+        merged = InvertedIndex()
+        for segment in group:
+            merged.merge(segment.index)
+
+        name = self._next_segment_name()
+        merged.save_index(os.path.join(self.directory, name), format='binary')
+        merged_segment = self._open_segment(name)
+
+        with self._lock:
+            # Carry over deletions that arrived while the merge was running
+            for segment, before in zip(group, deleted_before):
+                for doc_id in segment.index.deleted_documents - before:
+                    merged_segment.index.delete_document(doc_id)
+
+            position = self.segments.index(group[0])
+            self.segments[position:position + len(group)] = [merged_segment]
+            self._write_manifest()
+
+            self._retired.extend(group)
+        self._release([])
+
+        logger.info(f"Merged {len(group)} segments into {name} ({merged_segment.document_count} documents)")
+
+    def _snapshot(self) -> List[InvertedIndex]:
+        """Return the indexes currently visible to queries, oldest first."""
+        with self._lock:
+            return [segment.index for segment in self.segments] + [self.buffer]
+
+    @contextmanager
+    def _pinned(self):
+        """Snapshot the visible indexes, keeping their segments open until the block ends.
+
+        A merge retires the segments it replaces, but their maps are only
+        closed and their files removed once no query still reads them.
+        """
+        with self._lock:
+            segments = list(self.segments)
+            for segment in segments:
+                segment.references += 1
+            snapshot = [segment.index for segment in segments] + [self.buffer]
+        try:
+            yield snapshot
+        finally:
+            self._release(segments)
+
+    def _release(self, segments: List[Segment]):
+        """Drop the references of a finished query; close and delete retired segments nobody reads any more."""
+        with self._lock:
+            for segment in segments:
+                segment.references -= 1
+            released = [segment for segment in self._retired if not segment.references]
+            self._retired = [segment for segment in self._retired if segment.references]
+        for segment in released:
+            segment.index.close()
+            self._remove_file(segment.name)
+
+    @property
+    def indexes(self) -> List[InvertedIndex]:
+        """The segment indexes and the buffer currently visible to queries, oldest first.
+
+        Unlike the query methods this does not keep merged-away segments open;
+        read it while no merge runs (e.g. after ``wait_for_merges``).
+        """
+        return self._snapshot()
+
+    @property
+    def build_id(self) -> str:
+        """Random id of the current document set, kept in the manifest.
+
+        Like ``InvertedIndex.build_id`` it changes with every added or deleted
+        document; merges keep it, since they do not change the documents.
+        """
+        if self._build_id is None:
+            self._build_id = uuid.uuid4().hex
+        return self._build_id
+
+    @property
+    def index(self) -> SegmentedPostings:
+        return SegmentedPostings(self._snapshot())
+
+    @property
+    def document_metadata(self) -> ChainMap:
+        # Later segments win, matching the overwrite order of sequential adds
+        return ChainMap(*[index.document_metadata for index in reversed(self._snapshot())])
+
+    @property
+    def terms(self) -> TermDictionary:
+        """Front-coded dictionary of the terms across all segments."""
+        terms = set()
+        with self._pinned() as snapshot:
+            for index in snapshot:
+                terms.update(index.vocabulary)
+        return TermDictionary.from_terms(terms)
+    
+    @property
+    def vocabulary(self):
+        return self.terms.keys()
+
+    @property
+    def total_documents(self) -> int:
+        with self._pinned() as snapshot:
+            return sum(index.total_documents for index in snapshot)
+
+    @property
+    def is_memory_mapped(self) -> bool:
+        return False
+
+    @property
+    def stop_terms(self) -> set:
+        """Stop terms of any segment (see InvertedIndex.prune_vocabulary)."""
+        stop_terms = set()
+        with self._pinned() as snapshot:
+            for index in snapshot:
+                stop_terms.update(index.pruning.get('stop_terms', ()))
+        return stop_terms
+
+    def scoring_terms(self, query_terms: List[str]) -> List[str]:
+        """Drop stop terms from analyzed query terms, unless the query has nothing else."""
+        stop_terms = self.stop_terms
+        kept = [term for term in query_terms if term not in stop_terms]
+        return kept if kept else query_terms
+
+    def preprocess_text(self, text: str) -> List[str]:
+        """Preprocess text with the same pipeline the segments were built with."""
+        return self.buffer.preprocess_text(text)
+
+    def get_postings(self, term: str) -> Dict[str, List[int]]:
+        """Get a term's live postings ({doc_id: positions}) across all segments."""
+        return self.index.get(term, {})
+    
+    def get_document_frequency(self, term: str) -> int:
+        """Get the number of documents containing the term across all segments."""
+        with self._pinned() as snapshot:
+            return sum(index.get_document_frequency(term) for index in snapshot)
+
+    def get_term_frequency(self, term: str, document_id: str) -> int:
+        """Get the frequency of a term in a specific document."""
+        with self._pinned() as snapshot:
+            for index in snapshot:
+                frequency = index.get_term_frequency(term, document_id)
+                if frequency:
+                    return frequency
+        return 0
+
+    def search(self, query: str, top_k: int = 10, phrases: List[Tuple[str, int]] = None) -> List[Dict[str, Any]]:
+        """Search all live segments (same semantics as InvertedIndex.search)."""
+        query_terms = self.scoring_terms(self.preprocess_text(query))
+        phrase_terms = self.buffer.preprocess_phrases(phrases)
+
+        if not query_terms and not phrase_terms:
+            return []
+
+        # A term is required if any segment has it; each live document sits in
+        # exactly one segment, so the global top K is among the per-segment top Ks
+        results = []
+        with self._pinned() as snapshot:
+            required_terms = {term for term in query_terms if any(term in index.index for index in snapshot)}
+            for terms, _ in phrase_terms:
+                required_terms.update(terms)
+
+            for index in snapshot:
+                results.extend(index.search_terms(query_terms, list(required_terms), top_k, phrase_terms))
+
+        return top_k_items(results, top_k, key=lambda x: x['score'])
+
+    def rank(self, query: str, top_k: int = 10, phrases: List[Tuple[str, int]] = None) -> List[Dict[str, Any]]:
+        """Rank documents in all live segments by BM25 (same semantics as InvertedIndex.rank).
+
+        Document count, lengths and document frequencies are summed over the
+        live segments, so every segment scores against the whole collection
+        and the merged scores equal those of one index over the same documents.
+        """
+        query_terms = self.scoring_terms(self.preprocess_text(query))
+        phrase_terms = self.buffer.preprocess_phrases(phrases)
+        if not query_terms:
+            query_terms = self.scoring_terms([term for terms, _ in phrase_terms for term in terms])
+
+        results = []
+        with self._pinned() as snapshot:
+            statistics = {'total_documents': 0, 'total_length': 0.0,
+                          'document_frequencies': dict.fromkeys(query_terms, 0)}
+            for index in snapshot:
+                part = index.bm25_statistics(query_terms)
+                statistics['total_documents'] += part['total_documents']
+                statistics['total_length'] += part['total_length']
+                for term, frequency in part['document_frequencies'].items():
+                    statistics['document_frequencies'][term] += frequency
+            for index in snapshot:
+                results.extend(index.rank_with_statistics(query_terms, statistics, top_k, phrase_terms))
+
+        return top_k_items(results, top_k, key=lambda x: x['score'])
+
+    def match_phrases(self, phrases: List[Tuple[str, int]]) -> set:
+        """Return the ids of live documents matching every (phrase, slop) pair."""
+        matches = set()
+        with self._pinned() as snapshot:
+            for index in snapshot:
+                matches.update(index.match_phrases(phrases))
+        return matches
+
+    def covering_spans(self, query_terms: List[str], document_ids: List[str]) -> Dict[str, Tuple[int, int]]:
+        """Get (span, matched terms) for candidate documents across all segments."""
+        spans = {}
+        with self._pinned() as snapshot:
+            for index in snapshot:
+                spans.update(index.covering_spans(query_terms, document_ids))
+        return spans
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Get index statistics across all segments."""
+        with self._pinned() as snapshot:
+            total_documents = sum(index.total_documents for index in snapshot)
+            total_words = sum(meta.get('word_count', 0) for index in snapshot
+                              for meta in index.document_metadata.values())
+
+            return {
+                'total_documents': total_documents,
+                'vocabulary_size': len(self.terms),
+                'total_terms': sum(index.get_statistics()['total_terms'] for index in snapshot),
+                'average_document_length': total_words / max(1, total_documents),
+                'segment_count': len(snapshot) - 1,
+                'buffered_documents': self.buffer.total_documents
+            }
+
+    def close(self):
+        """Flush buffered documents, finish merges and release segment maps."""
+        self.flush()
+        self.wait_for_merges()
+        with self._lock:
+            for segment in self.segments:
+                segment.index.close()
+            for segment in self._retired:
+                segment.index.close()
+                self._remove_file(segment.name)
+            self.segments = []
+            self._retired = []
@@ -0,0 +1,194 @@
+import struct
+from bisect import bisect_left
+from collections.abc import Mapping
+from typing import Iterable, Iterator, List, Tuple
+import numpy as np
+
+_HEADER = struct.Struct('<III')  # term count, block size, block count
+
+def _write_varbyte(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varbyte(data, pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def _prefix_successor(prefix: bytes) -> bytes:
+    """Return the smallest byte string greater than every string starting with prefix."""
+    stripped = prefix.rstrip(b'\xff')
+    if not stripped:
+        return None
+    return stripped[:-1] + bytes([stripped[-1] + 1])
+
+class TermDictionary(Mapping):
+    """Sorted term -> ordinal dictionary stored with front coding.
+
+    Terms are sorted by their UTF-8 bytes (the same order as ``sorted()`` on
+    str) and grouped into blocks of ``block_size``. Within a block every term
+    is stored as (shared prefix length, suffix length, suffix) relative to the
+    previous term. Lookups binary-search the block heads and then scan one
+    block, and prefix ranges give autocomplete/wildcard callers the matching
+    terms without scanning the vocabulary.
+
+    Serialized layout: header ``<III``, uint32[block_count + 1] block offsets,
+    then the encoded blocks. The dictionary can be opened directly over a
+    bytes object or an mmap.
+    """
+
+    def __init__(self, buffer, offset: int = 0):
+        self._buffer = buffer
+        self._count, self.block_size, block_count = _HEADER.unpack_from(buffer, offset)
+        offsets_start = offset + _HEADER.size
+        # Copy the (small) block table so no view pins an mmap open
+        self._block_offsets = np.frombuffer(buffer, dtype='<u4', count=block_count + 1,
+                                            offset=offsets_start).astype(np.int64)
+        self._data_start = offsets_start + 4 * (block_count + 1)
+        self.nbytes = self._data_start - offset + int(self._block_offsets[-1])
+
+    @classmethod
+    def from_terms(cls, terms: Iterable[str], block_size: int = 16) -> 'TermDictionary':
+        """Build a dictionary from any iterable of distinct terms."""
+        return cls(cls.encode(terms, block_size))
+
+    @staticmethod
+    def encode(terms: Iterable[str], block_size: int = 16) -> bytes:
+        """Front-code terms into the serialized dictionary layout."""
+        encoded_terms = sorted(term.encode('utf-8') for term in terms)
+        data = bytearray()
+        block_offsets = []
+        previous = b''
+        for i, term in enumerate(encoded_terms):
+            if i % block_size == 0:
+                block_offsets.append(len(data))
+                previous = b''
+            shared = 0
+            limit = min(len(previous), len(term))
+            while shared < limit and previous[shared] == term[shared]:
+                shared += 1
+            _write_varbyte(data, shared)
+            _write_varbyte(data, len(term) - shared)
+            data += term[shared:]
+            previous = term
+        block_offsets.append(len(data))
+
+        header = _HEADER.pack(len(encoded_terms), block_size, len(block_offsets) - 1)
+        return header + np.asarray(block_offsets, dtype='<u4').tobytes() + bytes(data)
+
+    def to_bytes(self) -> bytes:
+        """Return the serialized dictionary."""
+        start = self._data_start - 4 * len(self._block_offsets) - _HEADER.size
+        return bytes(self._buffer[start:start + self.nbytes])
+
+    def _block_bytes(self, block: int) -> bytes:
+        start = self._data_start + int(self._block_offsets[block])
+        end = self._data_start + int(self._block_offsets[block + 1])
+        return self._buffer[start:end]
+
+    def _decode_block(self, block: int) -> List[bytes]:
+        data = self._block_bytes(block)
+        terms = []
+        previous = b''
+        pos = 0
+        while pos < len(data):
+            shared, pos = _read_varbyte(data, pos)
+            length, pos = _read_varbyte(data, pos)
+            previous = previous[:shared] + data[pos:pos + length]
+            pos += length
+            terms.append(previous)
+        return terms
+
+    def _block_head(self, block: int) -> bytes:
+        data = self._block_bytes(block)
+        _, pos = _read_varbyte(data, 0)
+        length, pos = _read_varbyte(data, pos)
+        return data[pos:pos + length]
+
+    def _find_block(self, target: bytes) -> int:
+        """Return the last block whose head is <= target, or -1."""
+        low, high = 0, len(self._block_offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self._block_head(middle) <= target:
+                low = middle + 1
+            else:
+                high = middle
+        return low - 1
+
+    def _lower_bound(self, target: bytes) -> int:
+        """Return the ordinal of the first term >= target."""
+        block = self._find_block(target)
+        if block < 0:
+            return 0
+        terms = self._decode_block(block)
+        return block * self.block_size + bisect_left(terms, target)
+
+    def find(self, term: str) -> int:
+        """Return the ordinal of a term, or -1 if it is not in the dictionary."""
+        target = term.encode('utf-8')
+        block = self._find_block(target)
+        if block < 0:
+            return -1
+        terms = self._decode_block(block)
+        i = bisect_left(terms, target)
+        if i < len(terms) and terms[i] == target:
+            return block * self.block_size + i
+        return -1
+
+    def term_at(self, ordinal: int) -> str:
+        """Return the term stored at an ordinal."""
+        if not 0 <= ordinal < self._count:
+            raise IndexError(ordinal)
+        block, i = divmod(ordinal, self.block_size)
+        return self._decode_block(block)[i].decode('utf-8')
+
+    def prefix_range(self, prefix: str) -> range:
+        """Return the ordinals of all terms starting with ``prefix``."""
+        encoded = prefix.encode('utf-8')
+        start = self._lower_bound(encoded)
+        successor = _prefix_successor(encoded)
+        end = self._lower_bound(successor) if successor is not None else self._count
+        return range(start, end)
+
+    def iter_range(self, start: int, end: int) -> Iterator[str]:
+        """Iterate the terms with ordinals in [start, end), decoding block by block."""
+        end = min(end, self._count)
+        ordinal = max(start, 0)
+        while ordinal < end:
+            block, i = divmod(ordinal, self.block_size)
+            for term in self._decode_block(block)[i:i + end - ordinal]:
+                yield term.decode('utf-8')
+                ordinal += 1
+
+    def with_prefix(self, prefix: str, limit: int = None) -> List[str]:
+        """Return the terms starting with ``prefix`` in sorted order."""
+        ordinals = self.prefix_range(prefix)
+        end = ordinals.stop if limit is None else min(ordinals.stop, ordinals.start + limit)
+        return list(self.iter_range(ordinals.start, end))
+
+    def __getitem__(self, term: str) -> int:
+        ordinal = self.find(term) if isinstance(term, str) else -1
+        if ordinal < 0:
+            raise KeyError(term)
+        return ordinal
+
+    def __contains__(self, term) -> bool:
+        return isinstance(term, str) and self.find(term) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        return self.iter_range(0, self._count)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __reduce__(self):
+        return (TermDictionary, (self.to_bytes(),))
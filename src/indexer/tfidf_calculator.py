@@ -1,57 +1,504 @@
+import os
+import json
 import numpy as np
-from typing import Dict, List, Any
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Mapping
+from typing import Dict, List, Any, Iterator
+from scipy import sparse
 from common.config import Config
 from common.logger import setup_logger
 from .inverted_index import InvertedIndex
+from .topk import top_k_indices, top_k_per_row
 
 logger = setup_logger(__name__)
 
+# Storage types of the document weights (indexer.tfidf_precision); the integer
+# modes hold codes of each document's weights relative to its largest weight
+WEIGHT_PRECISIONS = {
+    'float64': np.float64,
+    'float32': np.float32,
+    'uint16': np.uint16,
+    'uint8': np.uint8,
+}
+
+class DocumentVectors(Mapping):
+    """Read-only doc_id -> dense TF-IDF vector view over the sparse document matrix.
+    
+    Rows are densified only when a single document's vector is requested;
+    integer codes are scaled back to term frequencies and weighted by the
+    current IDF.
+    """
+    
+    def __init__(self, matrix: sparse.csr_matrix, document_rows: Dict[str, int], row_scales: np.ndarray = None,
+                 idf: np.ndarray = None):
+        self._matrix = matrix
+        self._document_rows = document_rows
+        self._row_scales = row_scales
+        self._idf = idf
+    
+    def __getitem__(self, doc_id: str) -> np.ndarray:
+        row = self._document_rows[doc_id]
+        vector = self._matrix[row].toarray().ravel().astype(np.float64)
+        if self._row_scales is not None:
+            vector *= self._row_scales[row]
+        return vector * self._idf if self._idf is not None else vector
+    
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._document_rows
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._document_rows)
+    
+    def __len__(self) -> int:
+        return len(self._document_rows)
+
+def index_signature(index) -> Dict[str, Any]:
+    """Identify an index's state: its build id plus its document count.
+    
+    A document matrix only loads against an index with the signature it was
+    saved with, so a rebuilt or incrementally updated index cannot be paired
+    with stale weights. The build id is stored in the index file or segment
+    manifest, so this costs nothing per document. The index's vocabulary is
+    not part of it: the matrix keeps the columns of terms that merges removed,
+    and its manifest records its own column count next to the signature.
+    """
+    return {
+        'total_documents': index.total_documents,
+        'build_id': index.build_id
+    }
+
 class TFIDFCalculator:
-    """TF-IDF calculator for document ranking."""
+    """TF-IDF calculator for document ranking.
+    
+    The document matrix holds length-normalized term frequencies only; IDF is
+    applied at query time from per-term document frequencies, so documents
+    can be added and removed (``add_documents``/``remove_documents``) without
+    touching the other rows, and ``calculate_tfidf`` becomes an optional full
+    rebuild. With ``A = log(N + 1) + 1`` and ``b = log(df + 1)`` a term's IDF
+    is ``A - b``, so each row's squared TF-IDF norm is
+    ``A^2 S0 - 2A S1 + S2`` with ``Sk = sum(tf^2 b^k)``. These three moments
+    are stored per row: a change of ``N`` costs nothing, and a change of a
+    term's document frequency only updates the rows in its postings.
+    
+    Term frequencies are stored with ``indexer.tfidf_precision``. Cosine
+    similarity only depends on the direction of a document's vector, so the
+    integer modes store every row as codes relative to its largest term
+    frequency (1 up to 255 or 65535) plus one scale per row, and score the
+    codes directly; the scales only matter for ``document_vectors``.
+    """
     
     def __init__(self, inverted_index: InvertedIndex):
         self.index = inverted_index
         self.config = Config()
-        self.tfidf_vectors = {}  # doc_id -> {term: tfidf_score}
-        self.term_to_index = {}  # term -> index in vector
-        self.document_vectors = {}  # doc_id -> numpy array
+        self.precision = self.config.get('indexer.tfidf_precision', 'float64')
+        if self.precision not in WEIGHT_PRECISIONS:
+            raise ValueError(f"Unknown TF-IDF precision {self.precision!r}, "
+                             f"expected one of {', '.join(WEIGHT_PRECISIONS)}")
+        self.term_to_index = {}  # term -> column in the document matrix
+        self.document_ids = []   # row -> doc_id
+        self.document_rows = {}  # doc_id -> row
+        self.document_matrix = sparse.csr_matrix((0, 0))  # documents x terms, CSR
+        self._term_matrix = sparse.csc_matrix((0, 0))  # same weights, column-major (see term_matrix)
+        self._appended_postings = None  # (columns, rows, weights) of rows appended since, sorted by column
+        self._buffers = {}  # name -> buffer with spare capacity behind an appended array
+        self.row_scales = None  # weight per code of every row (integer precisions only)
+        self.live_rows = np.zeros(0, dtype=bool)  # False for rows of removed documents until compact()
+        self.document_frequencies = np.zeros(0, dtype=np.int64)  # live rows holding every term
+        self.norm_moments = np.zeros((0, 3))  # S0, S1, S2 of every row (see class docstring)
+        self._idf = None  # IDF and row norms for the current statistics, derived on demand
+        self._document_norms = None
+        self.document_vectors = {}  # doc_id -> dense vector view
+        self.tfidf_vectors = self.document_vectors
     
     def calculate_tfidf(self):
-        """Calculate TF-IDF scores for all documents and terms."""
+        """Calculate TF-IDF scores for all documents and terms.
+        
+        Term frequencies are built directly from the postings into a CSR
+        matrix, so time and memory are proportional to the number of postings.
+        """
         logger.info("Calculating TF-IDF scores...")
         
-        # Create term to index mapping
-        self.term_to_index = {term: idx for idx, term in enumerate(self.index.vocabulary)}
-        vocabulary_size = len(self.index.vocabulary)
+        # Create term to index mapping (sorted, so columns match the binary index's term ordinals)
+        self.term_to_index = {term: idx for idx, term in enumerate(sorted(self.index.vocabulary))}
+        terms = list(self.term_to_index.keys())
+        
+        document_ids, rows, columns, frequencies = self._collect_postings(terms)
+        word_counts = np.array([self.index.document_metadata[doc_id].get('word_count', 1) or 1
+                                for doc_id in document_ids], dtype=np.float64)
+        
+        # Term Frequency (TF) normalized by document length; IDF is applied at query time
+        weights = frequencies / word_counts[rows]
+        
+        matrix = sparse.csr_matrix((weights, (rows, columns)), shape=(len(document_ids), len(terms)))
+        matrix, row_scales = self._quantize(matrix)
+        self._set_document_matrix(matrix, document_ids, row_scales=row_scales)
+        
+        logger.info(f"TF-IDF calculation completed for {len(self.document_ids)} documents "
+                    f"({matrix.nnz} non-zero weights, {self.precision})")
+    
+    def add_documents(self, document_ids: List[str], document_terms: Dict[str, List[str]] = None) -> int:
+        """Add rows for documents already added to the index, replacing older rows.
+        
+        Only the new documents' postings are read, and the norms of other
+        documents are updated for the terms whose document frequency changed,
+        so the documents are searchable without recomputing the matrix. When
+        ``document_terms`` maps the documents to the analyzed terms
+        ``add_document`` returned for them, their term frequencies are counted
+        from those instead of being looked up in every posting list. Rows are
+        appended in place, so the cost follows the new documents rather than
+        the matrix. Documents the index does not hold are skipped. Returns the
+        number of rows added.
+        """
+        document_ids, rows, terms, frequencies = self._collect_document_postings(document_ids, document_terms)
+        if not document_ids:
+            return 0
+        self.remove_documents(document_ids)
+        
+        # Terms new to the matrix get columns after the existing ones
+        new_terms = [term for term in dict.fromkeys(terms) if term not in self.term_to_index]
+        for term in new_terms:
+            self.term_to_index[term] = len(self.term_to_index)
+        if new_terms:
+            self.document_frequencies = self._extend_array(
+                'document_frequencies', self.document_frequencies, np.zeros(len(new_terms), dtype=np.int64))
+        vocabulary_size = len(self.term_to_index)
+        
+        columns = np.fromiter((self.term_to_index[term] for term in terms), dtype=np.int64, count=len(terms))
+        word_counts = np.array([self.index.document_metadata[doc_id].get('word_count', 1) or 1
+                                for doc_id in document_ids], dtype=np.float64)
+        weights = frequencies / word_counts[rows]
+        block = sparse.csr_matrix((weights, (rows, columns)), shape=(len(document_ids), vocabulary_size))
+        block, block_scales = self._quantize(block)
+        
+        self._shift_document_frequencies(block.indices, 1)
+        block_moments = self._norm_moments(block, np.log(self.document_frequencies + 1.0))
+        
+        if not self.document_matrix.shape[0]:
+            self._set_document_matrix(block, document_ids, block_moments, row_scales=block_scales)
+        else:
+            self._append_rows(block, document_ids, block_moments, block_scales)
+        
+        logger.info(f"Added TF-IDF rows for {len(document_ids)} documents ({len(new_terms)} new terms)")
+        return len(document_ids)
+    
+    def _append_rows(self, block: sparse.csr_matrix, document_ids: List[str], block_moments: np.ndarray,
+                     block_scales: np.ndarray = None):
+        """Append rows after the document matrix, keeping their postings in the appended-postings tail."""
+        matrix = self.document_matrix
+        first_row = matrix.shape[0]
+        data = self._extend_array('data', matrix.data, block.data)
+        indices = self._extend_array('indices', matrix.indices, block.indices)
+        indptr = self._extend_array('indptr', matrix.indptr, block.indptr[1:] + matrix.nnz)
+        self.document_matrix = sparse.csr_matrix((data, indices, indptr),
+                                                 shape=(first_row + block.shape[0], block.shape[1]), copy=False)
+        
+        self.document_ids.extend(document_ids)
+        self.document_rows.update((doc_id, first_row + row) for row, doc_id in enumerate(document_ids))
+        self.live_rows = self._extend_array('live_rows', self.live_rows, np.ones(len(document_ids), dtype=bool))
+        self.norm_moments = self._extend_array('norm_moments', self.norm_moments, block_moments)
+        if self.row_scales is not None:
+            self.row_scales = self._extend_array('row_scales', self.row_scales, block_scales)
+        
+        # Column-sorted postings of the new rows stand in for their part of the term matrix
+        block_rows = first_row + np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+        tail = [np.asarray(block.indices, dtype=np.int64), block_rows, block.data]
+        if self._appended_postings is not None:
+            tail = [np.concatenate(pair) for pair in zip(self._appended_postings, tail)]
+        order = np.argsort(tail[0], kind='stable')
+        self._appended_postings = tuple(array[order] for array in tail)
+        # Fold the tail in once it outgrows the term matrix, keeping appends amortized
+        if len(order) > self._term_matrix.nnz:
+            self._fold_appended_postings()
+        self._statistics_changed()
+    
+    def _extend_array(self, name: str, array: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """Return ``array`` followed by ``values``, written in place into spare capacity when ``array`` has some.
+        
+        Arrays returned here are views of buffers that grow geometrically, so a
+        series of appends copies the existing values only a logarithmic number
+        of times. Other arrays (e.g. memory-mapped ones) are copied into a new
+        buffer first.
+        """
+        length = len(array) + len(values)
+        buffer = self._buffers.get(name)
+        if buffer is None or array.base is not buffer or len(buffer) < length:
+            buffer = np.empty((max(length, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+            buffer[:len(array)] = array
+            self._buffers[name] = buffer
+        buffer[len(array):length] = values
+        return buffer[:length]
+    
+    def remove_documents(self, document_ids: List[str]) -> int:
+        """Drop the rows of documents, updating the statistics of their terms.
+        
+        Rows are only marked dead until ``compact``; returns how many were removed.
+        """
+        rows = [self.document_rows.pop(doc_id) for doc_id in document_ids if doc_id in self.document_rows]
+        if not rows:
+            return 0
+        
+        rows = np.asarray(rows, dtype=np.int64)
+        self.live_rows = self._writable(self.live_rows)
+        self.live_rows[rows] = False
+        matrix = self.document_matrix
+        self._shift_document_frequencies(
+            np.concatenate([matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]] for row in rows.tolist()]), -1)
+        self._statistics_changed()
+        
+        logger.debug(f"Removed TF-IDF rows for {len(rows)} documents")
+        return len(rows)
+    
+    def compact(self) -> int:
+        """Rebuild the matrices without the rows of removed documents; returns how many were purged."""
+        purged = int(len(self.live_rows) - self.live_rows.sum())
+        if purged:
+            live = np.flatnonzero(self.live_rows)
+            self._set_document_matrix(self.document_matrix[live], [self.document_ids[row] for row in live.tolist()],
+                                      self.norm_moments[live],
+                                      row_scales=self.row_scales[live] if self.row_scales is not None else None)
+        return purged
+    
+    def _shift_document_frequencies(self, columns: np.ndarray, delta: int):
+        """Change the document frequency of every occurrence of a column by ``delta``.
+        
+        The moments of the rows holding those terms follow their new ``log(df + 1)``.
+        """
+        columns, counts = np.unique(columns, return_counts=True)
+        self.document_frequencies = self._writable(self.document_frequencies)
+        old = np.log(self.document_frequencies[columns] + 1.0)
+        self.document_frequencies[columns] += delta * counts
+        new = np.log(self.document_frequencies[columns] + 1.0)
+        self._idf = self._document_norms = None
+        
+        rows, weights, owners = self._column_postings(columns)
+        if not len(rows):
+            return
+        
+        squares = weights.astype(np.float64) ** 2
+        self.norm_moments = self._writable(self.norm_moments)
+        for moment, change in ((1, new - old), (2, new ** 2 - old ** 2)):
+            self.norm_moments[:, moment] += np.bincount(rows, weights=squares * change[owners],
+                                                        minlength=len(self.norm_moments))
+    
+    def _column_postings(self, columns: np.ndarray):
+        """Return (rows, weights, position in ``columns``) of every posting of some matrix columns.
+        
+        Postings come from the column-major term matrix plus the column-sorted
+        postings of rows appended since it was built; columns beyond the term
+        matrix are terms that were new to those rows.
+        """
+        term_matrix = self._term_matrix
+        existing = np.flatnonzero(columns < term_matrix.shape[1])
+        starts = term_matrix.indptr[columns[existing]].astype(np.int64)
+        ends = term_matrix.indptr[columns[existing] + 1].astype(np.int64)
+        sources = [(term_matrix.indices, term_matrix.data, existing, starts, ends - starts)]
+        if self._appended_postings is not None:
+            tail_columns, tail_rows, tail_data = self._appended_postings
+            starts = np.searchsorted(tail_columns, columns)
+            ends = np.searchsorted(tail_columns, columns, side='right')
+            sources.append((tail_rows, tail_data, np.arange(len(columns)), starts, ends - starts))
+        
+        rows, weights, owners = [], [], []
+        for source_rows, source_weights, source_owners, starts, lengths in sources:
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            rows.append(source_rows[positions])
+            weights.append(source_weights[positions])
+            owners.append(np.repeat(source_owners, lengths))
+        return np.concatenate(rows).astype(np.int64), np.concatenate(weights), np.concatenate(owners)
+    
+    def _fold_appended_postings(self):
+        """Rebuild the term matrix from the document matrix, absorbing the appended rows' postings."""
+        if self._appended_postings is not None:
+            self._term_matrix = self.document_matrix.tocsc()
+            self._appended_postings = None
+    
+    @property
+    def term_matrix(self) -> sparse.csc_matrix:
+        """Column-major copy of the document matrix; each term's weights are one contiguous slice.
+        
+        Rows appended by ``add_documents`` are only folded in when the whole
+        matrix is needed (batch scoring, saving).
+        """
+        self._fold_appended_postings()
+        return self._term_matrix
+    
+    @staticmethod
+    def _writable(array: np.ndarray) -> np.ndarray:
+        """Return ``array``, copied first if it is read-only (e.g. memory-mapped)."""
+        return array if array.flags.writeable else np.array(array)
+    
+    def _collect_document_postings(self, document_ids: List[str], document_terms: Dict[str, List[str]] = None):
+        """Return (document ids, row, term, term frequency) of the live postings of some documents.
         
-        # Calculate TF-IDF for each document
-        for doc_id in self.index.document_metadata.keys():
-            tfidf_vector = np.zeros(vocabulary_size)
-            doc_word_count = self.index.document_metadata[doc_id].get('word_count', 1)
+        Rows number the returned documents, which are those the index holds.
+        With ``document_terms`` the frequencies are counted from each
+        document's analyzed terms. Otherwise every term is checked, but only
+        postings from the first requested document's id onwards are read,
+        which for recently added documents is the tail of each posting list.
+        """
+        # A segmented index holds each live document in exactly one segment (or its buffer)
+        indexes = self.index.indexes if hasattr(self.index, 'indexes') else [self.index]
+        remaining = set(document_ids)
+        found, rows, terms, frequencies = [], [], [], []
+        for index in reversed(indexes):
+            wanted = {index.doc_id_map[doc_id]: doc_id for doc_id in remaining if doc_id in index.doc_id_map}
+            if not wanted:
+                continue
+            remaining.difference_update(wanted.values())
+            internal_ids = sorted(wanted)
             
-            for term, idx in self.term_to_index.items():
-                if doc_id in self.index.index.get(term, {}):
-                    # Term Frequency (TF)
-                    tf = len(self.index.index[term][doc_id]) / doc_word_count
-                    
-                    # Inverse Document Frequency (IDF)
-                    doc_freq = len(self.index.index[term])
-                    idf = np.log((self.index.total_documents + 1) / (doc_freq + 1)) + 1
-                    
-                    # TF-IDF
-                    tfidf_score = tf * idf
-                    tfidf_vector[idx] = tfidf_score
+            if document_terms is not None:
+                for internal_id in internal_ids:
+                    for term, frequency in Counter(document_terms.get(wanted[internal_id], ())).items():
+                        rows.append(len(found))
+                        terms.append(term)
+                        frequencies.append(frequency)
+                    found.append(wanted[internal_id])
+                continue
             
-            self.tfidf_vectors[doc_id] = tfidf_vector
-            self.document_vectors[doc_id] = tfidf_vector
+            row_of_id = {internal_id: len(found) + i for i, internal_id in enumerate(internal_ids)}
+            found.extend(wanted[internal_id] for internal_id in internal_ids)
+            first_id = internal_ids[0]
+            for term in index.vocabulary:
+                postings = index.index[term]
+                if not len(postings) or postings.doc_ids[-1] < first_id:
+                    continue
+                # Tails are short, so they are filtered without NumPy overhead
+                start = bisect_left(postings.doc_ids, first_id)
+                for i, internal_id in enumerate(postings.doc_ids[start:], start):
+                    row = row_of_id.get(int(internal_id))
+                    if row is not None:
+                        rows.append(row)
+                        terms.append(term)
+                        frequencies.append(postings.frequencies[i])
         
-        logger.info(f"TF-IDF calculation completed for {len(self.tfidf_vectors)} documents")
+        return found, np.asarray(rows, dtype=np.int64), terms, np.asarray(frequencies, dtype=np.float64)
+    
+    def _collect_postings(self, terms: List[str]):
+        """Return (document ids, row, column, term frequency) arrays for all live postings."""
+        if isinstance(self.index, InvertedIndex):
+            # Integer doc ids map straight to rows: live documents in id order
+            live = ~self.index.deletion_bitmap[:len(self.index.doc_ids)]
+            row_of_id = np.cumsum(live) - 1
+            row_of_id[~live] = -1
+            document_ids = [doc_id for doc_id, is_live in zip(self.index.doc_ids, live.tolist()) if is_live]
+            
+            posting_lists = [self.index.index[term] for term in terms]
+            lengths = np.fromiter((len(postings) for postings in posting_lists), dtype=np.int64, count=len(terms))
+            if posting_lists:
+                doc_ids = np.concatenate([postings.doc_id_array() for postings in posting_lists])
+                frequencies = np.concatenate([postings.frequency_array() for postings in posting_lists])
+            else:
+                doc_ids = frequencies = np.zeros(0, dtype=np.uint32)
+            rows = row_of_id[doc_ids]
+            columns = np.repeat(np.arange(len(terms)), lengths)
+            keep = rows >= 0
+            return document_ids, rows[keep], columns[keep], frequencies[keep].astype(np.float64)
+        
+        # Other index types (e.g. segmented) expose {doc_id: positions} postings
+        document_ids = list(self.index.document_metadata.keys())
+        document_rows = {doc_id: row for row, doc_id in enumerate(document_ids)}
+        rows, columns, frequencies = [], [], []
+        for column, term in enumerate(terms):
+            for doc_id, positions in self.index.get_postings(term).items():
+                row = document_rows.get(doc_id)
+                if row is not None:
+                    rows.append(row)
+                    columns.append(column)
+                    frequencies.append(len(positions))
+        return (document_ids, np.asarray(rows, dtype=np.int64), np.asarray(columns, dtype=np.int64),
+                np.asarray(frequencies, dtype=np.float64))
+    
+    def _quantize(self, matrix: sparse.csr_matrix):
+        """Convert float64 weights to the configured precision, returning (matrix, row scales or None)."""
+        dtype = np.dtype(WEIGHT_PRECISIONS[self.precision])
+        if dtype.kind == 'f':
+            return matrix.astype(dtype), None
+        
+        # Every row's largest weight maps to the largest code; non-zero weights keep a code of at least 1
+        max_code = np.iinfo(dtype).max
+        row_lengths = np.diff(matrix.indptr)
+        row_maxima = np.zeros(matrix.shape[0])
+        nonempty = row_lengths > 0
+        row_maxima[nonempty] = np.maximum.reduceat(matrix.data, matrix.indptr[:-1][nonempty])
+        row_scales = np.where(nonempty, row_maxima / max_code, 1.0).astype(np.float32)
+        codes = np.clip(np.rint(matrix.data / np.repeat(row_scales, row_lengths)), 1, max_code).astype(dtype)
+        return sparse.csr_matrix((codes, matrix.indices, matrix.indptr), shape=matrix.shape), row_scales
+    
+    def _set_document_matrix(self, matrix: sparse.csr_matrix, document_ids: List[str], norm_moments: np.ndarray = None,
+                             term_matrix: sparse.csc_matrix = None, row_scales: np.ndarray = None,
+                             live_rows: np.ndarray = None, document_frequencies: np.ndarray = None):
+        """Install a document matrix and derive row lookups, term statistics, norm moments and per-term postings.
+        
+        Without ``live_rows`` every row is live and document frequencies are
+        counted from the matrix.
+        """
+        self.document_matrix = matrix
+        # Column-major copy: each term's weights are one contiguous slice for accumulator scoring
+        self._term_matrix = matrix.tocsc() if term_matrix is None else term_matrix
+        self._appended_postings = None
+        self.document_ids = list(document_ids)
+        if live_rows is None:
+            live_rows = np.ones(matrix.shape[0], dtype=bool)
+            document_frequencies = np.diff(self._term_matrix.indptr).astype(np.int64)
+        self.live_rows = live_rows
+        self.document_rows = {self.document_ids[row]: row for row in np.flatnonzero(live_rows).tolist()}
+        self.document_frequencies = document_frequencies
+        if norm_moments is None:
+            norm_moments = self._norm_moments(matrix, np.log(document_frequencies + 1.0))
+        self.norm_moments = norm_moments
+        self.row_scales = row_scales
+        self.precision = next(name for name, dtype in WEIGHT_PRECISIONS.items() if np.dtype(dtype) == matrix.dtype)
+        self._statistics_changed()
+    
+    def _statistics_changed(self):
+        """Drop the IDF and norms derived from older statistics and rebuild the vector view."""
+        self._idf = self._document_norms = None
+        self.document_vectors = DocumentVectors(self.document_matrix, self.document_rows, self.row_scales, self.idf)
+        self.tfidf_vectors = self.document_vectors
+    
+    @staticmethod
+    def _norm_moments(matrix: sparse.csr_matrix, log_frequencies: np.ndarray) -> np.ndarray:
+        """Return the (S0, S1, S2) moments of every row for the given ``log(df + 1)`` per column."""
+        # Summed in float64: squares of integer codes would overflow their type
+        squares = sparse.csr_matrix((matrix.data.astype(np.float64) ** 2, matrix.indices, matrix.indptr),
+                                    shape=matrix.shape)
+        return np.column_stack([np.asarray(squares.sum(axis=1)).ravel(), squares @ log_frequencies,
+                                squares @ log_frequencies ** 2])
+    
+    @property
+    def idf(self) -> np.ndarray:
+        """IDF of every column from the live documents' statistics."""
+        if self._idf is None:
+            self._idf = (np.log(len(self.document_rows) + 1.0) + 1 -
+                         np.log(self.document_frequencies + 1.0))
+        return self._idf
+    
+    @property
+    def similarity_idf(self) -> np.ndarray:
+        """``idf`` with the columns of stop terms zeroed, for document-to-document similarity."""
+        stop_columns = [self.term_to_index[term] for term in self.index.stop_terms if term in self.term_to_index]
+        idf = np.array(self.idf)
+        idf[stop_columns] = 0.0
+        return idf
+    
+    @property
+    def document_norms(self) -> np.ndarray:
+        """TF-IDF norm of every row under the current IDF (0 for removed documents)."""
+        if self._document_norms is None:
+            a = np.log(len(self.document_rows) + 1.0) + 1
+            squared = a * a * self.norm_moments[:, 0] - 2 * a * self.norm_moments[:, 1] + self.norm_moments[:, 2]
+            self._document_norms = np.where(self.live_rows, np.sqrt(np.maximum(squared, 0)), 0.0)
+        return self._document_norms
     
     def get_query_vector(self, query_terms: List[str]) -> np.ndarray:
         """Convert query terms to TF-IDF vector."""
-        vocabulary_size = len(self.index.vocabulary)
+        vocabulary_size = len(self.term_to_index)
         query_vector = np.zeros(vocabulary_size)
         
+        # Common (stop) terms only count in queries that have nothing else
+        query_terms = self.index.scoring_terms(query_terms)
         if not query_terms:
             return query_vector
         
@@ -70,28 +517,162 @@ class TFIDFCalculator:
                 tf = freq / query_length
                 
                 # IDF from collection
-                doc_freq = len(self.index.index.get(term, {}))
+                doc_freq = self.index.get_document_frequency(term)
                 idf = np.log((self.index.total_documents + 1) / (doc_freq + 1)) + 1
                 
                 query_vector[idx] = tf * idf
         
         return query_vector
     
-    def get_document_scores(self, query_vector: np.ndarray) -> List[Dict[str, Any]]:
-        """Get TF-IDF scores for documents against query vector."""
-        scores = []
+    def get_query_matrix(self, queries: List[List[str]]) -> sparse.csr_matrix:
+        """Convert analyzed queries to a sparse queries x terms TF-IDF matrix.
         
-        for doc_id, doc_vector in self.document_vectors.items():
-            # Calculate cosine similarity
-            dot_product = np.dot(query_vector, doc_vector)
-            query_norm = np.linalg.norm(query_vector)
-            doc_norm = np.linalg.norm(doc_vector)
+        Row ``i`` equals ``get_query_vector(queries[i])``; each distinct term's
+        IDF is looked up once for the whole batch.
+        """
+        idf = {}
+        rows, columns, weights = [], [], []
+        for row, query_terms in enumerate(queries):
+            query_terms = self.index.scoring_terms(query_terms)
+            term_freq = {}
+            for term in query_terms:
+                term_freq[term] = term_freq.get(term, 0) + 1
             
-            if query_norm == 0 or doc_norm == 0:
-                similarity = 0.0
-            else:
-                similarity = dot_product / (query_norm * doc_norm)
+            for term, freq in term_freq.items():
+                column = self.term_to_index.get(term)
+                if column is None:
+                    continue
+                if term not in idf:
+                    doc_freq = self.index.get_document_frequency(term)
+                    idf[term] = np.log((self.index.total_documents + 1) / (doc_freq + 1)) + 1
+                rows.append(row)
+                columns.append(column)
+                weights.append(freq / len(query_terms) * idf[term])
+        
+        return sparse.csr_matrix((weights, (rows, columns)), shape=(len(queries), len(self.term_to_index)))
+    
+    def accumulate_scores(self, query_vector: np.ndarray):
+        """Term-at-a-time dot products of a query vector with every matching document.
+        
+        Only the postings (matrix columns) of the query's non-zero terms are
+        read, so the cost follows the number of matching postings rather than
+        the corpus size. Returns (row indices, dot products) for documents
+        containing at least one query term.
+        """
+        columns = np.flatnonzero(query_vector)
+        # Rows hold term frequencies, so the query weights carry the documents' IDF too
+        query_weights = query_vector[columns] * self.idf[columns]
+        rows, weights, owners = self._column_postings(columns)
+        if not len(rows):
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        
+        # Sum the per-term contributions into one accumulator slot per matching document
+        rows, slots = np.unique(rows, return_inverse=True)
+        dot_products = np.bincount(slots, weights=weights * query_weights[owners], minlength=len(rows))
+        return rows, dot_products
+    
+    def get_document_scores(self, query_vector: np.ndarray, top_k: int = None) -> List[Dict[str, Any]]:
+        """Get TF-IDF scores for documents matching the query vector, best first.
+        
+        With ``top_k`` only the best matches are returned (and built).
+        """
+        query_norm = np.linalg.norm(query_vector)
+        if query_norm == 0:
+            return []
+        
+        rows, dot_products = self.accumulate_scores(query_vector)
+        return self._rank_rows(rows, dot_products, query_norm, top_k)
+    
+    def get_candidate_scores(self, query_vector: np.ndarray, rows: np.ndarray,
+                             top_k: int = None) -> List[Dict[str, Any]]:
+        """Exact ``get_document_scores`` restricted to candidate document rows (e.g. from an ANN index).
+        
+        Only the candidates' rows of the document matrix are read, so
+        re-ranking a first-stage shortlist costs nothing per non-candidate.
+        """
+        query_norm = np.linalg.norm(query_vector)
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if query_norm == 0 or len(rows) == 0:
+            return []
+        
+        # Rows hold term frequencies, so the query weights carry the documents' IDF too
+        dot_products = np.asarray(self.document_matrix[rows] @ (query_vector * self.idf)).ravel()
+        return self._rank_rows(rows, dot_products, query_norm, top_k)
+    
+    def _rank_rows(self, rows: np.ndarray, dot_products: np.ndarray, query_norm: float,
+                   top_k: int = None) -> List[Dict[str, Any]]:
+        """Score entries of the best ``top_k`` rows by cosine similarity, from their dot products with the query."""
+        # Cosine similarity from the dot products and precomputed document norms
+        denominators = self.document_norms[rows] * query_norm
+        similarities = np.divide(dot_products, denominators, out=np.zeros_like(dot_products),
+                                 where=denominators > 0)
+        
+        matching = similarities > 0
+        rows, similarities = rows[matching], similarities[matching]
+        order = top_k_indices(similarities, top_k)
+        return self._score_entries(rows[order], similarities[order])
+    
+    def get_batch_document_scores(self, query_matrix: sparse.csr_matrix, top_k: int = None,
+                                  batch_size: int = None) -> List[List[Dict[str, Any]]]:
+        """Score a batch of query vectors (see ``get_query_matrix``) at once.
+        
+        The dot products of a block of queries with every document come from
+        one sparse product with the document matrix, and the best ``top_k``
+        documents of every query in the block are selected together: by one
+        sort of the matches when they are few, otherwise row-wise over the
+        dense block. Blocks hold ``batch_size`` queries, by default as many as
+        keep a dense block to about four million entries. Returns one
+        ``get_document_scores`` result per query row.
+        """
+        query_matrix = sparse.csr_matrix(query_matrix)
+        if batch_size is None:
+            batch_size = max(1, (1 << 22) // max(1, len(self.document_ids)))
+        query_norms = np.sqrt(np.asarray(query_matrix.multiply(query_matrix).sum(axis=1)).ravel())
+        inverse_query_norms = np.divide(1.0, query_norms, out=np.zeros(len(query_norms)), where=query_norms > 0)
+        document_norms = self.document_norms
+        inverse_document_norms = np.divide(1.0, document_norms, out=np.zeros(len(document_norms)),
+                                           where=document_norms > 0)
+        # Rows hold term frequencies, so the query weights carry the documents' IDF too
+        query_matrix = sparse.csr_matrix(query_matrix.multiply(self.idf))
+        # The transposed CSC term matrix is a CSR terms x documents matrix, so no copy is made
+        documents = self.term_matrix.T
+        
+        results = []
+        for start in range(0, query_matrix.shape[0], batch_size):
+            block = slice(start, start + batch_size)
+            products = (query_matrix[block] @ documents).tocsr()
+            queries, documents_count = products.shape
             
+            if products.nnz * 16 < queries * documents_count:
+                # Few matches: rank all of them at once, by query, then score, then row
+                query_of_match = np.repeat(np.arange(queries), np.diff(products.indptr))
+                similarities = (products.data * inverse_query_norms[block][query_of_match] *
+                                inverse_document_norms[products.indices])
+                order = np.lexsort((products.indices, -similarities, query_of_match))
+                ranked_rows, ranked_similarities = products.indices[order], similarities[order]
+                for query in range(queries):
+                    begin, end = products.indptr[query], products.indptr[query + 1]
+                    if top_k is not None:
+                        end = min(end, begin + max(top_k, 0))
+                    results.append(self._score_entries(ranked_rows[begin:end], ranked_similarities[begin:end]))
+            else:
+                # Cosine similarity: dot products scaled by both norms
+                similarities = products.toarray()
+                similarities *= inverse_query_norms[block][:, np.newaxis]
+                similarities *= inverse_document_norms
+                best_rows = top_k_per_row(similarities, top_k)
+                best_similarities = np.take_along_axis(similarities, best_rows, axis=1)
+                for rows, row_similarities in zip(best_rows, best_similarities):
+                    results.append(self._score_entries(rows, row_similarities))
+        
+        return results
+    
+    def _score_entries(self, rows: np.ndarray, similarities: np.ndarray) -> List[Dict[str, Any]]:
+        """Build score entries for ranked document rows, skipping those with no similarity."""
+        matching = similarities > 0
+        scores = []
+        for row, similarity in zip(rows[matching].tolist(), similarities[matching].tolist()):
+            doc_id = self.document_ids[row]
             scores.append({
                 'document_id': doc_id,
                 'score': similarity,
@@ -100,30 +681,111 @@ class TFIDFCalculator:
         
         return scores
     
-    def save_tfidf_vectors(self, filepath: str):
-        """Save TF-IDF vectors to file."""
-        import pickle
+    def save_document_matrix(self, filepath: str):
+        """Save the CSR document matrix as raw .npy arrays that can be memory-mapped.
         
-        tfidf_data = {
-            'tfidf_vectors': self.tfidf_vectors,
-            'term_to_index': self.term_to_index,
-            'document_vectors': self.document_vectors
-        }
+        ``filepath`` is a base path: the data, indices and indptr arrays of the
+        row- and column-major matrices, the row norm moments and (integer
+        weights only) the row scales are written as ``<base>.<name>.npy`` next
+        to a JSON manifest. Rows of removed documents are compacted away first.
+        The manifest lists the term of every column, which after incremental
+        updates is neither sorted nor the index's current vocabulary, and
+        records the index the matrix was built for (see ``index_signature``).
+        
+        Every file is written under a temporary name and renamed into place, so
+        processes that memory-mapped the previous files keep reading them.
+        """
+        self.compact()
+        matrix = self.document_matrix
+        for name, array in self._matrix_arrays(matrix).items():
+            path = self._matrix_array_path(filepath, name)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(path + '.tmp', path)
         
-        with open(filepath, 'wb') as f:
-            pickle.dump(tfidf_data, f)
+        manifest = {
+            'format': 'csr',
+            'weighting': 'tf',
+            'precision': self.precision,
+            'index': dict(self.index_signature(), columns=matrix.shape[1]),
+            'documents': self.document_ids,
+            'vocabulary_size': matrix.shape[1],
+            'nnz': int(matrix.nnz),
+            # Columns outlive their terms: segment merges drop terms of deleted documents from the index
+            'terms': list(self.term_to_index)
+        }
+        manifest_path = self.matrix_manifest_path(filepath)
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
         
-        logger.info(f"TF-IDF vectors saved to {filepath}")
+        logger.info(f"Document matrix {matrix.shape} saved to {filepath}")
+    
+    def _matrix_arrays(self, matrix: sparse.csr_matrix) -> Dict[str, np.ndarray]:
+        arrays = {
+            'data': matrix.data,
+            'indices': matrix.indices,
+            'indptr': matrix.indptr,
+            'moments': self.norm_moments,
+            'term_data': self.term_matrix.data,
+            'term_indices': self.term_matrix.indices,
+            'term_indptr': self.term_matrix.indptr
+        }
+        if self.row_scales is not None:
+            arrays['scales'] = self.row_scales
+        return arrays
+    
+    def index_signature(self) -> Dict[str, Any]:
+        """Identify the index state (see the module-level ``index_signature``)."""
+        return index_signature(self.index)
     
-    def load_tfidf_vectors(self, filepath: str):
-        """Load TF-IDF vectors from file."""
-        import pickle
+    def load_document_matrix(self, filepath: str, mmap_mode: str = 'r'):
+        """Load the CSR document matrix, memory-mapped by default.
         
-        with open(filepath, 'rb') as f:
-            tfidf_data = pickle.load(f)
+        The component arrays are views into the mapped files, so weights are
+        paged in on demand and shared between processes serving the same index.
+        With ``mmap_mode=None`` they are read into memory instead. Nothing is
+        unpickled: the manifest is JSON and the arrays are plain ``.npy`` files.
+        """
+        with open(self.matrix_manifest_path(filepath), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
         
-        self.tfidf_vectors = tfidf_data['tfidf_vectors']
-        self.term_to_index = tfidf_data['term_to_index']
-        self.document_vectors = tfidf_data['document_vectors']
+        if manifest.get('format') != 'csr':
+            raise ValueError(f"Document matrix {filepath} uses the old dense layout; rebuild it with run_indexer.py")
+        if manifest.get('weighting') != 'tf':
+            raise ValueError(f"Document matrix {filepath} has IDF built into its weights; rebuild it with run_indexer.py")
+        if 'terms' not in manifest:
+            raise ValueError(f"Document matrix {filepath} does not list its terms; rebuild it with run_indexer.py")
+        # The column count ties the term list to the matrix as well as the index
+        signature = dict(self.index_signature(), columns=len(manifest['terms']))
+        if manifest.get('index') != signature or manifest['vocabulary_size'] != len(manifest['terms']):
+            raise ValueError(f"Document matrix {filepath} was built for a different index "
+                             f"({manifest.get('index')}, index has {signature})")
         
-        logger.info(f"TF-IDF vectors loaded from {filepath}")
\ No newline at end of file
+        names = ['data', 'indices', 'indptr', 'moments', 'term_data', 'term_indices', 'term_indptr']
+        # Integer codes (named int16/int8 by older builds) come with their row scales
+        if manifest.get('precision', 'float64') not in ('float64', 'float32'):
+            names.append('scales')
+        arrays = {name: np.load(self._matrix_array_path(filepath, name), mmap_mode=mmap_mode, allow_pickle=False)
+                  for name in names}
+        shape = (len(manifest['documents']), manifest['vocabulary_size'])
+        matrix = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+        term_matrix = sparse.csc_matrix((arrays['term_data'], arrays['term_indices'], arrays['term_indptr']),
+                                        shape=shape, copy=False)
+        
+        # Terms added incrementally have columns after the sorted vocabulary of the last full build
+        self.term_to_index = {term: idx for idx, term in enumerate(manifest['terms'])}
+        
+        self._set_document_matrix(matrix, manifest['documents'], arrays['moments'], term_matrix, arrays.get('scales'))
+        
+        logger.info(f"Document matrix {matrix.shape} ({self.precision}) loaded from {filepath} (mmap_mode={mmap_mode})")
+    
+    @staticmethod
+    def matrix_manifest_path(filepath: str) -> str:
+        """Return the JSON manifest path stored alongside a document matrix."""
+        return os.path.splitext(filepath)[0] + '.json'
+    
+    @staticmethod
+    def _matrix_array_path(filepath: str, name: str) -> str:
+        """Return the path of one CSR component array of a document matrix."""
+        return f"{os.path.splitext(filepath)[0]}.{name}.npy"
@@ -0,0 +1,94 @@
+"""
+Top-k selection shared by the ranking code.
+
+Ranking only ever returns the best ``k`` results, so sorting every candidate is
+wasted work. Array scores use ``np.partition`` and sort only the winners;
+scores produced one at a time go through a bounded heap. Both keep the order a
+stable descending sort would give: equal scores rank in input order.
+"""
+
+import heapq
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+import numpy as np
+
+
+def top_k_indices(scores: np.ndarray, k: Optional[int]) -> np.ndarray:
+    """Return the indices of the ``k`` highest scores in rank order (all of them if k is None)."""
+    scores = np.asarray(scores)
+    n = len(scores)
+    if k is None or k >= n:
+        return np.argsort(-scores, kind='stable')
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Everything above the k-th best score wins; ties at it go to the earliest indices
+    kth = np.partition(scores, n - k)[n - k]
+    above = np.flatnonzero(scores > kth)
+    ties = np.flatnonzero(scores == kth)[:k - len(above)]
+    selected = np.concatenate((above, ties))
+    return selected[np.lexsort((selected, -scores[selected]))]
+
+
+def top_k_per_row(scores: np.ndarray, k: Optional[int]) -> np.ndarray:
+    """Row-wise ``top_k_indices`` of a 2-D array: column indices of every row's best ``k``, in rank order."""
+    scores = np.asarray(scores)
+    rows, n = scores.shape
+    if k is None or k >= n:
+        return np.argsort(-scores, axis=1, kind='stable')
+    if k <= 0:
+        return np.zeros((rows, 0), dtype=np.int64)
+
+    # Per row: everything above the k-th best score, then the earliest ties with it
+    kth = np.partition(scores, n - k, axis=1)[:, n - k, np.newaxis]
+    above = scores > kth
+    ties = scores == kth
+    needed = k - np.count_nonzero(above, axis=1)[:, np.newaxis]
+    selected = above | (ties & (np.cumsum(ties, axis=1, dtype=np.int32) <= needed))
+    columns = np.nonzero(selected)[1].reshape(rows, k)
+    order = np.lexsort((columns, -np.take_along_axis(scores, columns, axis=1)))
+    return np.take_along_axis(columns, order, axis=1)
+
+
+class TopK:
+    """Bounded min-heap keeping the ``k`` best (score, item) pairs pushed so far."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self._heap = []
+        self._pushed = 0
+
+    def threshold(self) -> float:
+        """Score an item must beat to enter a full heap (-inf until it is full)."""
+        return self._heap[0][0] if len(self._heap) >= self.k else float('-inf')
+
+    def push(self, score: float, item: Any) -> bool:
+        """Offer an item; returns whether it is currently among the best k."""
+        if self.k <= 0:
+            return False
+        # The negated sequence number makes later items lose ties, like a stable sort
+        entry = (score, -self._pushed, item)
+        self._pushed += 1
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+            return True
+        if entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+            return True
+        return False
+
+    def results(self) -> List[Tuple[float, Any]]:
+        """Return the kept (score, item) pairs, best first."""
+        return [(score, item) for score, _, item in sorted(self._heap, key=lambda entry: entry[:2], reverse=True)]
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+
+def top_k_items(items: Iterable[Any], k: Optional[int], key: Callable[[Any], float]) -> List[Any]:
+    """Return the ``k`` items with the highest ``key`` in rank order (all of them if k is None)."""
+    if k is None:
+        return sorted(items, key=key, reverse=True)
+    top = TopK(k)
+    for item in items:
+        top.push(key(item), item)
+    return [item for _, item in top.results()]
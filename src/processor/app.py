@@ -258,11 +258,18 @@ def create_app():
                 'queries_with_expansion': 0
             }
             
-            for query in queries:
-                validation_result = query_validator.validate_query(query)
+            validations = [query_validator.validate_query(query) for query in queries]
+            processed_queries = [validation_result.get('suggested_query', query)
+                                 for query, validation_result in zip(queries, validations)
+                                 if validation_result['valid']]
+            
+            # All valid queries are scored together in one batch
+            batch_results = iter(results_generator.batch_search(processed_queries))
+            
+            for query, validation_result in zip(queries, validations):
                 if validation_result['valid']:
                     processed_query = validation_result.get('suggested_query', query)
-                    search_results = results_generator.search(processed_query)
+                    search_results = next(batch_results)
                     
                     # Track smart features usage
                     has_corrections = validation_result.get('has_corrections', False)
@@ -306,6 +313,43 @@ def create_app():
             logger.error(f"Error processing batch search: {str(e)}")
             return jsonify({'error': 'Error processing batch search'}), 500
     
+    @app.route('/similar/<document_id>', methods=['GET'])
+    def similar(document_id):
+        """Documents similar to a result, from the precomputed neighbor table."""
+        try:
+            top_k = request.args.get('top_k', default=config.get('processor.top_k_results', 10), type=int)
+            if top_k < 1:
+                return jsonify({
+                    'error': 'top_k must be a positive integer',
+                    'error_code': 'INVALID_TOP_K'
+                }), 400
+            
+            if results_generator.document_neighbors is None:
+                return jsonify({
+                    'error': 'Similar documents are not available; run the indexer to build them',
+                    'error_code': 'NO_NEIGHBOR_TABLE'
+                }), 503
+            
+            similar_results = results_generator.similar_documents(document_id, top_k)
+            if similar_results is None:
+                return jsonify({
+                    'error': f"Unknown document: {document_id}",
+                    'error_code': 'UNKNOWN_DOCUMENT'
+                }), 404
+            
+            return jsonify({
+                'document_id': document_id,
+                'results': similar_results,
+                'total_results': len(similar_results)
+            })
+            
+        except Exception as e:
+            logger.error(f"Error finding documents similar to {document_id}: {str(e)}")
+            return jsonify({
+                'error': 'Internal server error',
+                'error_code': 'INTERNAL_ERROR'
+            }), 500
+    
     @app.route('/health', methods=['GET'])
     def health_check():
         """Enhanced health check endpoint."""
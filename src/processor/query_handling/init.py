@@ -13,7 +13,8 @@ class QueryParser:
     
     def __init__(self):
         self.operators = {'AND', 'OR', 'NOT'}
-        self.special_chars = {'"', '(', ')', ':', '-'}
+        self.special_chars = {'"', '(', ')', ':', '-', '~'}
+        self.near_pattern = re.compile(r'\S+(?:\s+NEAR/\d+\s+\S+)+', re.IGNORECASE)
     
     def parse_advanced_query(self, query: str) -> Dict[str, Any]:
         """
@@ -29,9 +30,11 @@ class QueryParser:
             # Clean query
             query = query.strip()
             
-            # Handle phrase queries (quoted text)
+            # Handle phrase queries (quoted text) and proximity queries (a NEAR/n b)
             phrases = self._extract_phrases(query)
             query_without_phrases = self._remove_phrases(query)
+            proximity = self._extract_proximity(query_without_phrases)
+            query_without_phrases = self.near_pattern.sub(' ', query_without_phrases).strip()
             
             # Parse boolean expressions
             terms = self._parse_boolean_expression(query_without_phrases)
@@ -43,8 +46,9 @@ class QueryParser:
                 'original_query': query,
                 'terms': terms,
                 'phrases': phrases,
+                'proximity': proximity,
                 'field_queries': field_queries,
-                'is_advanced': bool(phrases or field_queries or any(op in query.upper() for op in self.operators))
+                'is_advanced': bool(phrases or proximity or field_queries or any(op in query.upper() for op in self.operators))
             }
             
         except Exception as e:
@@ -53,6 +57,7 @@ class QueryParser:
                 'original_query': query,
                 'terms': query.split(),
                 'phrases': [],
+                'proximity': [],
                 'field_queries': {},
                 'is_advanced': False
             }
@@ -63,8 +68,46 @@ class QueryParser:
         return [phrase.strip() for phrase in phrases if phrase.strip()]
     
     def _remove_phrases(self, query: str) -> str:
-        """Remove quoted phrases from query."""
-        return re.sub(r'"[^"]*"', '', query).strip()
+        """Remove quoted phrases (and their ~slop suffix) from query."""
+        return re.sub(r'"[^"]*"(?:~\d+)?', '', query).strip()
+    
+    def _extract_proximity(self, query: str) -> List[Dict[str, Any]]:
+        """Extract proximity groups such as ``web NEAR/3 crawler``.
+        
+        Chained operators form one group whose slop is the largest n given.
+        """
+        groups = []
+        for match in self.near_pattern.finditer(query):
+            parts = re.split(r'\s+NEAR/(\d+)\s+', match.group(0), flags=re.IGNORECASE)
+            groups.append({
+                'terms': parts[0::2],
+                'slop': max(int(slop) for slop in parts[1::2])
+            })
+        return groups
+    
+    def extract_phrase_constraints(self, query: str) -> List[Tuple[str, int]]:
+        """
+        Extract positional constraints as (phrase, slop) pairs.
+        
+        ``"web crawler"`` gives slop 0 (exact phrase), ``"web crawler"~3`` and
+        ``web NEAR/3 crawler`` give slop 3 (terms in any order, at most 3
+        other tokens between them).
+        
+        Args:
+            query: Input query string
+            
+        Returns:
+            List of (phrase text, slop) pairs
+        """
+        constraints = []
+        for phrase, slop in re.findall(r'"([^"]*)"(?:~(\d+))?', query):
+            if phrase.strip():
+                constraints.append((phrase.strip(), int(slop) if slop else 0))
+        
+        for group in self._extract_proximity(self._remove_phrases(query)):
+            constraints.append((' '.join(group['terms']), group['slop']))
+        
+        return constraints
     
     def _parse_boolean_expression(self, query: str) -> List[Dict[str, Any]]:
         """Parse boolean expression into structured terms."""
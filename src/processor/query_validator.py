@@ -3,6 +3,7 @@ import string
 from typing import Dict, List, Any, Tuple
 from common.config import Config
 from common.logger import setup_logger
+from src.indexer.term_dictionary import TermDictionary
 import nltk
 from nltk.corpus import wordnet
 from nltk.tokenize import word_tokenize
@@ -39,6 +40,7 @@ class EnhancedQueryValidator:
         # Enhanced spell checking
         self.spell_checker = None
         self.vocabulary = set()
+        self.term_dictionary = TermDictionary.from_terms([])
         self._initialize_enhanced_spell_checker()
         
         # Query expansion cache
@@ -85,6 +87,7 @@ class EnhancedQueryValidator:
                 'machine', 'learning', 'artificial', 'intelligence'
             }
             self.vocabulary.update(technical_terms)
+            self.term_dictionary = TermDictionary.from_terms(self.vocabulary)
             
             logger.info(f"Enhanced spell checker initialized with {len(self.vocabulary)} terms")
             
@@ -397,10 +400,10 @@ class EnhancedQueryValidator:
         suggestions = []
         query_lower = query.lower()
         
-        # 1. Prefix-based suggestions from vocabulary
+        # 1. Prefix-based suggestions from vocabulary (a range scan of the sorted dictionary)
         vocab_suggestions = [
-            term for term in self.vocabulary 
-            if term.startswith(query_lower) and len(term) > len(query_lower)
+            term for term in self.term_dictionary.with_prefix(query_lower, max_suggestions + 1)
+            if len(term) > len(query_lower)
         ][:max_suggestions]
         
         for term in vocab_suggestions:
@@ -1,12 +1,17 @@
 import time
 import json
 import os
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 from common.config import Config
 from common.logger import setup_logger
 from src.indexer.inverted_index import InvertedIndex
-from src.indexer.tfidf_calculator import TFIDFCalculator
+from src.indexer.tfidf_calculator import TFIDFCalculator, index_signature
 from src.indexer.cosine_similarity import CosineSimilarity
+from src.indexer.segments import SegmentedIndex
+from src.indexer.ann_index import ANNIndex
+from src.indexer.neighbors import DocumentNeighbors
+from src.indexer.topk import TopK
+from src.processor.query_handling.init import QueryParser
 
 logger = setup_logger(__name__)
 
@@ -17,14 +22,19 @@ class EnhancedResultsGenerator:
         self.config = Config()
         self.inverted_index = InvertedIndex()
         self.tfidf_calculator = None
+        self.ann_index = None
+        self.document_neighbors = None
         self.cosine_similarity = CosineSimilarity()
+        self.query_parser = QueryParser()
+        self.scoring_model = self.config.get('indexer.scoring.model', 'tfidf')
         
         # Enhanced ranking parameters
         self.ranking_weights = {
-            'similarity': 0.7,
+            'similarity': 0.6,
             'document_length': 0.1,
             'title_match': 0.15,
-            'url_authority': 0.05
+            'url_authority': 0.05,
+            'term_proximity': 0.1
         }
         
         # Load index data
@@ -33,21 +43,64 @@ class EnhancedResultsGenerator:
     def _load_index_data(self):
         """Load inverted index and TF-IDF vectors."""
         try:
-            index_path = os.path.join(self.config.get('paths.data_index'), 'inverted_index.json')
-            tfidf_path = os.path.join(self.config.get('paths.data_index'), 'tfidf_vectors.pkl')
+            index_dir = self.config.get('paths.data_index')
+            segments_dir = os.path.join(index_dir, 'segments')
+            index_path = os.path.join(index_dir, 'inverted_index.bin')
+            if not os.path.exists(index_path):
+                # Fall back to indexes built before the binary format existed
+                index_path = os.path.join(index_dir, 'inverted_index.json')
+            matrix_path = os.path.join(index_dir, 'tfidf_matrix')
+            use_mmap = self.config.get('processor.memory_map_index', True)
             
-            if os.path.exists(index_path):
-                self.inverted_index.load_index(index_path)
+            if SegmentedIndex.exists(segments_dir):
+                # Incremental segments (run_indexer.py --incremental) include the last full build
+                self.inverted_index = SegmentedIndex(segments_dir)
+                logger.info(f"Loaded segmented index with {self.inverted_index.total_documents} documents")
+            elif os.path.exists(index_path):
+                self.inverted_index.load_index(index_path, mmap=use_mmap)
                 logger.info(f"Loaded inverted index with {self.inverted_index.total_documents} documents")
-                
-                if os.path.exists(tfidf_path):
+            else:
+                logger.warning("Inverted index not found, search functionality limited")
+                return
+            # The build id read with the index ties the derived files to it
+            signature = index_signature(self.inverted_index)
+
+            try:
+                if os.path.exists(TFIDFCalculator.matrix_manifest_path(matrix_path)):
                     self.tfidf_calculator = TFIDFCalculator(self.inverted_index)
-                    self.tfidf_calculator.load_tfidf_vectors(tfidf_path)
-                    logger.info("Loaded TF-IDF vectors")
+                    self.tfidf_calculator.load_document_matrix(matrix_path, mmap_mode='r' if use_mmap else None)
+                    logger.info(f"{'Memory-mapped' if use_mmap else 'Loaded'} TF-IDF document matrix")
                 else:
                     logger.warning("TF-IDF vectors not found, using basic search")
-            else:
-                logger.warning("Inverted index not found, search functionality limited")
+            except ValueError as e:
+                logger.warning(f"TF-IDF vectors are out of date ({str(e)}), using basic search")
+                self.tfidf_calculator = None
+            
+            if (self.tfidf_calculator and
+                    len(self.tfidf_calculator.document_vectors) != self.inverted_index.total_documents):
+                # Incremental indexing updates the vectors of the last full build; without one there are none
+                logger.warning("TF-IDF vectors do not cover every indexed document, using basic search")
+                self.tfidf_calculator = None
+            
+            ann_path = os.path.join(index_dir, 'ann_index')
+            if (self.tfidf_calculator and self.config.get('processor.ann_first_stage', False) and
+                    os.path.exists(ANNIndex.manifest_path(ann_path))):
+                try:
+                    self.ann_index = ANNIndex()
+                    self.ann_index.load_index(ann_path, self.tfidf_calculator, mmap_mode='r' if use_mmap else None)
+                except ValueError as e:
+                    logger.warning(f"ANN index not used ({str(e)}), scoring TF-IDF exactly")
+                    self.ann_index = None
+            
+            neighbors_path = os.path.join(index_dir, 'neighbors')
+            if os.path.exists(DocumentNeighbors.manifest_path(neighbors_path)):
+                try:
+                    self.document_neighbors = DocumentNeighbors()
+                    self.document_neighbors.load_table(neighbors_path, signature,
+                                                       mmap_mode='r' if use_mmap else None)
+                except ValueError as e:
+                    logger.warning(f"Similar documents unavailable ({str(e)})")
+                    self.document_neighbors = None
                 
         except Exception as e:
             logger.error(f"Error loading index data: {str(e)}")
@@ -57,22 +110,32 @@ class EnhancedResultsGenerator:
         start_time = time.time()
         
         try:
+            query_terms = self.inverted_index.preprocess_text(query)
+            
+            # Quoted phrases and NEAR/n groups are matched against the positional postings
+            phrases = self.query_parser.extract_phrase_constraints(query)
+            
             # Basic search
-            if self.tfidf_calculator and self.tfidf_calculator.document_vectors:
-                query_terms = self.inverted_index.preprocess_text(query)
+            if self.scoring_model == 'bm25':
+                basic_scores = self.inverted_index.rank(query, top_k * 2, phrases=phrases)  # Get more for re-ranking
+                if basic_scores:
+                    # BM25 is unbounded; scale by the best match to combine with the [0, 1] factors
+                    best_score = basic_scores[0]['score']
+                    for score_data in basic_scores:
+                        score_data['similarity_score'] = score_data['score'] / best_score if best_score > 0 else 0.0
+            elif self._has_tfidf():
                 query_vector = self.tfidf_calculator.get_query_vector(query_terms)
-                basic_scores = self.tfidf_calculator.get_document_scores(query_vector)
-            else:
-                basic_scores = self.inverted_index.search(query, top_k * 2)  # Get more for re-ranking
-            
-            # Enhanced ranking
-            if use_enhanced_ranking and basic_scores:
-                enhanced_scores = self._apply_enhanced_ranking(basic_scores, query, query_terms)
+                if self.ann_index is not None and not phrases:
+                    # First stage: ANN candidates, re-ranked by exact cosine similarity
+                    basic_scores = self.ann_index.search_scores(self.tfidf_calculator, query_vector, top_k * 2)
+                else:
+                    # Every match is re-ranked; phrase filtering happens after scoring
+                    basic_scores = self.tfidf_calculator.get_document_scores(query_vector)
+                basic_scores = self._filter_phrases(basic_scores, phrases)
             else:
-                enhanced_scores = basic_scores
+                basic_scores = self.inverted_index.search(query, top_k * 2, phrases=phrases)  # Get more for re-ranking
             
-            # Format results
-            results = self._format_enhanced_results(enhanced_scores[:top_k], query, start_time)
+            results = self._rank_and_format(basic_scores, query, query_terms, top_k, use_enhanced_ranking, start_time)
             
             logger.info(f"Enhanced search completed in {time.time() - start_time:.4f}s, found {len(results)} results for query: '{query}'")
             
@@ -82,9 +145,96 @@ class EnhancedResultsGenerator:
             logger.error(f"Error during enhanced search: {str(e)}")
             return []
     
-    def _apply_enhanced_ranking(self, basic_scores: List[Dict[str, Any]], query: str, query_terms: List[str]) -> List[Dict[str, Any]]:
-        """Apply enhanced ranking factors to basic similarity scores."""
-        enhanced_scores = []
+    def batch_search(self, queries: List[str], top_k: int = 10,
+                     use_enhanced_ranking: bool = True) -> List[List[Dict[str, Any]]]:
+        """Search many queries at once, returning one result list per query.
+        
+        With TF-IDF scoring all queries are turned into one sparse query
+        matrix and scored against the document matrix in a single sparse
+        product; other scoring models search query by query.
+        """
+        if self.scoring_model == 'bm25' or not self._has_tfidf():
+            return [self.search(query, top_k, use_enhanced_ranking) for query in queries]
+        
+        start_time = time.time()
+        
+        try:
+            analyzed = [self.inverted_index.preprocess_text(query) for query in queries]
+            phrases = [self.query_parser.extract_phrase_constraints(query) for query in queries]
+            query_matrix = self.tfidf_calculator.get_query_matrix(analyzed)
+            
+            # Every match is re-ranked and phrase queries are filtered after scoring, like in search()
+            basic_scores = [self._filter_phrases(scores, query_phrases) for scores, query_phrases
+                            in zip(self.tfidf_calculator.get_batch_document_scores(query_matrix), phrases)]
+            
+            results = [self._rank_and_format(scores, query, query_terms, top_k, use_enhanced_ranking, start_time)
+                       for scores, query, query_terms in zip(basic_scores, queries, analyzed)]
+            
+            logger.info(f"Batch search of {len(queries)} queries completed in {time.time() - start_time:.4f}s")
+            
+            return results
+            
+        except Exception as e:
+            logger.error(f"Error during batch search: {str(e)}")
+            return [[] for _ in queries]
+    
+    def similar_documents(self, document_id: str, top_k: int = 10) -> Optional[List[Dict[str, Any]]]:
+        """Documents most similar to ``document_id``, from the neighbor table built by run_indexer.py.
+        
+        Returns None when the document is not in the table (or there is no table).
+        """
+        if self.document_neighbors is None:
+            return None
+        neighbors = self.document_neighbors.similar(document_id, top_k)
+        if neighbors is None:
+            return None
+        
+        results = []
+        for rank, neighbor in enumerate(neighbors, 1):
+            metadata = self.inverted_index.document_metadata.get(neighbor['document_id'], {})
+            results.append({
+                'document_id': neighbor['document_id'],
+                'rank': rank,
+                'similarity_score': round(neighbor['similarity_score'], 4),
+                'title': metadata.get('title', 'Untitled Document'),
+                'url': self._generate_proper_url(neighbor['document_id'], metadata),
+                'word_count': metadata.get('word_count', 0)
+            })
+        return results
+    
+    def _has_tfidf(self) -> bool:
+        return bool(self.tfidf_calculator and self.tfidf_calculator.document_vectors)
+    
+    def _filter_phrases(self, basic_scores: List[Dict[str, Any]], phrases) -> List[Dict[str, Any]]:
+        """Keep only the scored documents matching every phrase constraint."""
+        if not phrases:
+            return basic_scores
+        phrase_matches = self.inverted_index.match_phrases(phrases)
+        return [score for score in basic_scores if score['document_id'] in phrase_matches]
+    
+    def _rank_and_format(self, basic_scores: List[Dict[str, Any]], query: str, query_terms: List[str], top_k: int,
+                         use_enhanced_ranking: bool, start_time: float) -> List[Dict[str, Any]]:
+        """Re-rank basic scores with the enhancement factors and format the best ``top_k``."""
+        # Enhanced ranking
+        if use_enhanced_ranking and basic_scores:
+            enhanced_scores = self._apply_enhanced_ranking(basic_scores, query, query_terms, top_k)
+        else:
+            enhanced_scores = basic_scores
+        
+        # Format results
+        return self._format_enhanced_results(enhanced_scores[:top_k], query, start_time)
+    
+    def _apply_enhanced_ranking(self, basic_scores: List[Dict[str, Any]], query: str, query_terms: List[str],
+                                top_k: int = None) -> List[Dict[str, Any]]:
+        """Apply enhanced ranking factors to basic similarity scores, returning the best ``top_k`` (default all)."""
+        top = TopK(top_k if top_k is not None else len(basic_scores))
+        
+        # Query term spans come from the positional postings of the candidates only
+        distinct_terms = list(dict.fromkeys(query_terms))
+        spans = {}
+        if len(distinct_terms) > 1:
+            candidates = [score_data['document_id'] for score_data in basic_scores if score_data.get('score', 0) > 0]
+            spans = self.inverted_index.covering_spans(distinct_terms, candidates)
         
         for score_data in basic_scores:
             document_id = score_data['document_id']
@@ -94,21 +244,25 @@ class EnhancedResultsGenerator:
             
             # Calculate enhancement factors
             enhancement_factors = self._calculate_enhancement_factors(document_id, metadata, query, query_terms)
+            enhancement_factors['term_proximity'] = self._calculate_proximity_score(
+                spans.get(document_id), len(distinct_terms))
             
             # Combine scores
             enhanced_score = self._combine_scores(basic_similarity, enhancement_factors)
-            
+            top.push(enhanced_score, (score_data, enhancement_factors))
+        
+        # Result entries only for the best enhanced scores, best first
+        enhanced_scores = []
+        for enhanced_score, (score_data, enhancement_factors) in top.results():
+            basic_score = score_data.get('score', 0)
             enhanced_scores.append({
-                'document_id': document_id,
+                'document_id': score_data['document_id'],
                 'score': enhanced_score,
-                'similarity_score': basic_similarity,
-                'metadata': metadata,
+                'similarity_score': score_data.get('similarity_score', basic_score),
+                'metadata': score_data.get('metadata', {}),
                 'enhancement_factors': enhancement_factors,
                 'basic_score': basic_score
             })
-        
-        # Sort by enhanced score
-        enhanced_scores.sort(key=lambda x: x['score'], reverse=True)
         return enhanced_scores
     
     def _calculate_enhancement_factors(self, document_id: str, metadata: Dict[str, Any], query: str, query_terms: List[str]) -> Dict[str, float]:
@@ -148,6 +302,22 @@ class EnhancedResultsGenerator:
         
         return factors
     
+    def _calculate_proximity_score(self, span_data: Tuple[int, int], query_term_count: int) -> float:
+        """Score how tightly the query terms cluster in a document.
+        
+        With m of the query's terms present in a window of width ``span``,
+        the score is (m / terms) * ((m - 1) / span): 1.0 when every term
+        appears adjacently, decaying as the terms spread apart.
+        """
+        if not span_data or query_term_count < 2:
+            return 0.0
+        
+        span, matched = span_data
+        if matched < 2 or span <= 0:
+            return 0.0
+        
+        return (matched / query_term_count) * min((matched - 1) / span, 1.0)
+    
     def _calculate_url_authority(self, url: str) -> float:
         """Calculate URL authority score."""
         authority_scores = {
@@ -184,6 +354,7 @@ class EnhancedResultsGenerator:
         enhanced_score += enhancement_factors['document_length'] * self.ranking_weights['document_length']
         enhanced_score += enhancement_factors['title_match'] * self.ranking_weights['title_match']
         enhanced_score += enhancement_factors['url_authority'] * self.ranking_weights['url_authority']
+        enhanced_score += enhancement_factors.get('term_proximity', 0.0) * self.ranking_weights['term_proximity']
         
         return min(enhanced_score, 1.0)  # Cap at 1.0
     
@@ -214,7 +385,8 @@ class EnhancedResultsGenerator:
                 'enhancement_factors': {
                     'title_match': round(enhancement_factors.get('title_match', 0), 3),
                     'document_quality': round(enhancement_factors.get('document_length', 0), 3),
-                    'source_authority': round(enhancement_factors.get('url_authority', 0), 3)
+                    'source_authority': round(enhancement_factors.get('url_authority', 0), 3),
+                    'term_proximity': round(enhancement_factors.get('term_proximity', 0), 3)
                 },
                 'content_preview': metadata.get('content', '')[:200] + '...' if metadata.get('content') else None
             }
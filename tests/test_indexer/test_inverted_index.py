@@ -93,6 +93,911 @@ class TestInvertedIndex:
             if os.path.exists(temp_path):
                 os.unlink(temp_path)
     
+    def test_binary_index_roundtrip(self):
+        """Test that the binary format preserves postings and metadata."""
+        from indexer.inverted_index import InvertedIndex
+        from indexer.postings_format import encode_varbyte, decode_varbyte, is_binary_index
+        
+        values = [0, 1, 127, 128, 300, 2 ** 35]
+        assert decode_varbyte(encode_varbyte(values)).tolist() == values
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "search engine search results", {"title": "Doc 1", "url": "http://a"})
+        index.add_document("doc2", "web search crawling engine", {"title": "Doc 2", "url": "http://b"})
+        
+        with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as f:
+            temp_path = f.name
+        
+        try:
+            index.save_index(temp_path)
+            assert is_binary_index(temp_path)
+            
+            new_index = InvertedIndex()
+            new_index.load_index(temp_path)
+            
+            assert new_index.total_documents == index.total_documents
+            assert new_index.vocabulary == index.vocabulary
+            assert new_index.document_metadata == index.document_metadata
+            assert dict(new_index.index) == dict(index.index)
+            
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+    
+    def test_binary_index_without_terms(self):
+        """Test that indexes with no terms (empty, or every document deleted) save and load in both modes."""
+        from indexer.inverted_index import InvertedIndex
+        
+        emptied = InvertedIndex()
+        emptied.add_document("doc1", "search engine", {})
+        emptied.add_document("doc2", "web crawler", {})
+        emptied.delete_document("doc1")
+        emptied.delete_document("doc2")
+        emptied.compact()
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name, index in (("empty", InvertedIndex()), ("emptied", emptied)):
+                index_path = os.path.join(temp_dir, f"{name}.bin")
+                index.save_index(index_path)
+                for mmap in (False, True):
+                    loaded = InvertedIndex()
+                    loaded.load_index(index_path, mmap=mmap)
+                    assert loaded.total_documents == 0
+                    assert len(loaded.vocabulary) == 0
+                    assert loaded.search("search") == []
+                    assert loaded.rank("search") == []
+                    loaded.close()
+    
+    def test_memory_mapped_index(self):
+        """Test that a memory-mapped index answers lookups like the in-memory one."""
+        from indexer.inverted_index import InvertedIndex
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "search engine search results", {"title": "Doc 1"})
+        index.add_document("doc2", "web search crawling engine", {"title": "Doc 2"})
+        index.add_document("doc3", "information retrieval systems", {"title": "Doc 3"})
+        
+        with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as f:
+            temp_path = f.name
+        
+        try:
+            index.save_index(temp_path)
+            
+            mapped = InvertedIndex()
+            mapped.load_index(temp_path, mmap=True)
+            
+            assert mapped.is_memory_mapped
+            assert mapped.total_documents == 3
+            assert set(mapped.vocabulary) == index.vocabulary
+            for term in index.vocabulary:
+                assert mapped.index[term] == index.index[term]
+                assert mapped.get_document_frequency(term) == index.get_document_frequency(term)
+            assert "missingterm" not in mapped.index
+            assert mapped.get_document_frequency("missingterm") == 0
+            assert mapped.search("search engine") == index.search("search engine")
+            assert mapped.get_statistics() == index.get_statistics()
+            
+            with pytest.raises(RuntimeError):
+                mapped.add_document("doc4", "new content", {})
+            
+            mapped.close()
+            
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+    
+    def test_merge_partial_indexes(self):
+        """Test that merging partial indexes matches a sequential build."""
+        import pickle
+        from indexer.inverted_index import InvertedIndex
+        
+        documents = [
+            ("doc1", "search engine technology", {"title": "Doc 1"}),
+            ("doc2", "web crawling techniques for search", {"title": "Doc 2"}),
+            ("doc3", "information retrieval systems", {"title": "Doc 3"}),
+            ("doc4", "search engine ranking and retrieval", {"title": "Doc 4"}),
+        ]
+        
+        sequential = InvertedIndex()
+        for doc_id, content, metadata in documents:
+            sequential.add_document(doc_id, content, metadata)
+        
+        merged = InvertedIndex()
+        for shard in (documents[:2], documents[2:]):
+            partial = InvertedIndex()
+            for doc_id, content, metadata in shard:
+                partial.add_document(doc_id, content, metadata)
+            # Partials travel between processes, so they must survive pickling
+            merged.merge(pickle.loads(pickle.dumps(partial)))
+        
+        assert dict(merged.index) == dict(sequential.index)
+        assert merged.vocabulary == sequential.vocabulary
+        assert merged.document_metadata == sequential.document_metadata
+        assert merged.total_documents == sequential.total_documents
+    
+    def test_update_and_delete_documents(self):
+        """Test tombstone deletes, in-place updates and compaction."""
+        from indexer.inverted_index import InvertedIndex
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "search engine technology", {"title": "Doc 1"})
+        index.add_document("doc2", "web crawling for search", {"title": "Doc 2"})
+        
+        # Re-adding replaces the old version instead of double counting it
+        index.update_document("doc1", "information retrieval systems", {"title": "Doc 1 v2"})
+        assert index.total_documents == 2
+        assert index.get_term_frequency(index.preprocess_text("technology")[0], "doc1") == 0
+        assert index.document_metadata["doc1"]["title"] == "Doc 1 v2"
+        assert [r['document_id'] for r in index.search("search")] == ["doc2"]
+        
+        assert index.delete_document("doc2")
+        assert not index.delete_document("doc2")
+        assert index.total_documents == 1
+        assert index.search("search") == []
+        assert index.get_document_frequency(index.preprocess_text("search")[0]) == 0
+        
+        # The superseded doc1 version and doc2 are purged
+        assert index.compact() == 2
+        assert index.deleted_documents == set()
+        assert index.preprocess_text("search")[0] not in index.index
+        assert len(index.search("retrieval")) == 1
+    
+    def test_integer_document_ids(self):
+        """Test that postings use integer ids backed by typed arrays."""
+        from indexer.inverted_index import InvertedIndex
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "search engine search", {"title": "Doc 1"})
+        index.add_document("doc2", "web search", {"title": "Doc 2"})
+        
+        term = index.preprocess_text("search")[0]
+        postings = index.index[term]
+        assert index.doc_ids == ["doc1", "doc2"]
+        assert list(postings.doc_ids) == [0, 1]
+        assert list(postings.frequencies) == [2, 1]
+        assert postings.positions_for(0) == [0, 2]
+        assert index.get_postings(term) == {"doc1": [0, 2], "doc2": [1]}
+        
+        # An update gets a new id; saving drops the tombstoned version and renumbers
+        index.update_document("doc1", "engine", {"title": "Doc 1 v2"})
+        assert index.doc_id_map == {"doc2": 1, "doc1": 2}
+        assert index.get_postings(term) == {"doc2": [1]}
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filepath = os.path.join(temp_dir, "index.bin")
+            index.save_index(filepath)
+            
+            loaded = InvertedIndex()
+            loaded.load_index(filepath)
+            assert loaded.doc_ids == ["doc2", "doc1"]
+            assert list(loaded.index[term].doc_ids) == [0]
+            assert loaded.get_term_frequency(loaded.preprocess_text("engine")[0], "doc1") == 1
+    
+    def test_term_dictionary(self):
+        """Test sorted term lookups and prefix scans over the front-coded dictionary."""
+        from indexer.inverted_index import InvertedIndex
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "search searching searcher engine", {})
+        index.add_document("doc2", "seamless season web", {})
+        
+        terms = index.terms
+        assert list(terms) == sorted(terms)
+        assert set(index.vocabulary) == set(index.index.keys())
+        assert terms.term_at(terms["engin"]) == "engin"
+        assert "missingterm" not in terms
+        assert terms.with_prefix("sea") == [t for t in sorted(index.index) if t.startswith("sea")]
+        assert terms.with_prefix("zzz") == []
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filepath = os.path.join(temp_dir, "index.bin")
+            index.save_index(filepath)
+            
+            mapped = InvertedIndex()
+            mapped.load_index(filepath, mmap=True)
+            assert list(mapped.terms) == list(terms)
+            assert mapped.terms.with_prefix("sea") == terms.with_prefix("sea")
+            mapped.close()
+    
+    def test_posting_intersection(self):
+        """Test rarest-first intersection of sorted posting lists."""
+        from array import array
+        from indexer.postings import PostingList, intersect_postings
+        
+        def postings(doc_ids):
+            return PostingList(array('I', doc_ids), array('I', [1] * len(doc_ids)), array('I', [0] * len(doc_ids)))
+        
+        common = postings(range(0, 10000))
+        even = postings(range(0, 10000, 2))
+        rare = postings([3, 4, 5000, 9999, 20000])
+        
+        assert list(intersect_postings([common, even, rare])) == [4, 5000]
+        assert list(intersect_postings([rare, common])) == [3, 4, 5000, 9999]
+        assert list(intersect_postings([postings([]), common])) == []
+        assert list(intersect_postings([even])) == list(range(0, 10000, 2))
+    
+    def test_phrase_queries(self):
+        """Test exact phrase and NEAR/n matching over positional postings."""
+        from indexer.inverted_index import InvertedIndex
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "a fast web crawler written in python", {})
+        index.add_document("doc2", "crawler for the web", {})
+        index.add_document("doc3", "web pages need a crawler that is polite and fast", {})
+        index.add_document("doc4", "web crawler web crawler", {})
+        
+        def ids(results):
+            return sorted(r['document_id'] for r in results)
+        
+        assert ids(index.search("web crawler")) == ["doc1", "doc2", "doc3", "doc4"]
+        assert ids(index.search("", phrases=[("web crawler", 0)])) == ["doc1", "doc4"]
+        assert ids(index.search("crawler", phrases=[("crawler web", 0)])) == ["doc2", "doc4"]
+        assert index.match_phrases([("web crawler", 1)]) == {"doc1", "doc2", "doc4"}
+        assert index.match_phrases([("web crawler", 3)]) == {"doc1", "doc2", "doc3", "doc4"}
+        assert index.match_phrases([("fast web crawler python", 2)]) == {"doc1"}
+        assert index.match_phrases([("web unknownterm", 0)]) == set()
+        
+        index.delete_document("doc4")
+        assert index.match_phrases([("web crawler", 0)]) == {"doc1"}
+    
+    def test_covering_spans(self):
+        """Test minimal covering spans of query terms for candidate documents."""
+        from indexer.inverted_index import InvertedIndex
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "web crawler python", {})
+        index.add_document("doc2", "web pages need a polite crawler", {})
+        index.add_document("doc3", "python crawler web", {})
+        index.add_document("doc4", "python tutorial", {})
+        
+        terms = index.preprocess_text("web crawler python")
+        spans = index.covering_spans(terms, ["doc1", "doc2", "doc3", "doc4", "missing"])
+        assert spans["doc1"] == (2, 3)
+        assert spans["doc2"] == (4, 2)
+        assert spans["doc3"] == (2, 3)
+        assert spans["doc4"] == (0, 1)
+        assert "missing" not in spans
+        
+        assert index.covering_spans(terms[:2], ["doc2"]) == {"doc2": (4, 2)}
+    
+    def test_sparse_tfidf_matrix(self):
+        """Test that the sparse TF-IDF matrix matches dense per-document weights."""
+        import math
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        from indexer.tfidf_calculator import TFIDFCalculator
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "web crawler crawler python", {"word_count": 4})
+        index.add_document("doc2", "python search engine", {"word_count": 3})
+        index.add_document("doc3", "stale content", {"word_count": 2})
+        index.add_document("doc3", "web search ranking", {"word_count": 3})
+        
+        calculator = TFIDFCalculator(index)
+        calculator.calculate_tfidf()
+        
+        matrix = calculator.document_matrix
+        assert matrix.shape == (3, len(index.vocabulary))
+        assert calculator.document_ids == ["doc1", "doc2", "doc3"]
+        
+        # The matrix holds term frequencies; IDF is applied at query time
+        crawler = calculator.term_to_index[index.preprocess_text("crawler")[0]]
+        assert math.isclose(matrix[0, crawler], 2 / 4)
+        assert math.isclose(calculator.document_vectors["doc1"][crawler], 2 / 4 * (math.log(4 / 2) + 1))
+        dense = np.array([calculator.document_vectors[doc_id] for doc_id in calculator.document_ids])
+        assert np.allclose(dense, matrix.toarray() * calculator.idf)
+        assert np.allclose(calculator.document_norms, np.linalg.norm(dense, axis=1))
+        
+        query_vector = calculator.get_query_vector(index.preprocess_text("python search"))
+        ranked = calculator.get_document_scores(query_vector)
+        assert [score['score'] for score in ranked] == sorted((score['score'] for score in ranked), reverse=True)
+        scores = {score['document_id']: score['score'] for score in ranked}
+        for row, doc_id in enumerate(calculator.document_ids):
+            expected = dense[row] @ query_vector / (np.linalg.norm(dense[row]) * np.linalg.norm(query_vector))
+            assert math.isclose(scores[doc_id], expected)
+        
+        # Only documents containing a query term are scored
+        crawler_scores = calculator.get_document_scores(calculator.get_query_vector(index.preprocess_text("crawler")))
+        assert [score['document_id'] for score in crawler_scores] == ["doc1"]
+        assert calculator.get_document_scores(calculator.get_query_vector(["unknown"])) == []
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            matrix_path = os.path.join(temp_dir, "tfidf_matrix")
+            calculator.save_document_matrix(matrix_path)
+            loaded = TFIDFCalculator(index)
+            loaded.load_document_matrix(matrix_path)
+            assert loaded.document_ids == calculator.document_ids
+            assert (loaded.document_matrix != matrix).nnz == 0
+            assert loaded.get_document_scores(query_vector) == ranked
+    
+    def test_tfidf_precision(self):
+        """Test reduced-precision TF-IDF weights against the float64 ranking."""
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        from indexer.tfidf_calculator import TFIDFCalculator
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "web crawler crawler python", {"word_count": 4})
+        index.add_document("doc2", "python search engine", {"word_count": 3})
+        index.add_document("doc3", "web search ranking ranking ranking", {"word_count": 5})
+        index.add_document("doc4", "python web tutorial", {"word_count": 3})
+        
+        exact = TFIDFCalculator(index)
+        exact.calculate_tfidf()
+        query_vector = exact.get_query_vector(index.preprocess_text("python web search"))
+        expected = exact.get_document_scores(query_vector)
+        
+        for precision, dtype in (("float32", np.float32), ("uint16", np.uint16), ("uint8", np.uint8)):
+            calculator = TFIDFCalculator(index)
+            calculator.precision = precision
+            calculator.calculate_tfidf()
+            assert calculator.document_matrix.dtype == dtype
+            assert np.allclose(calculator.document_vectors["doc3"], exact.document_vectors["doc3"], rtol=0.01)
+            
+            ranked = calculator.get_document_scores(query_vector)
+            assert [score['document_id'] for score in ranked] == [score['document_id'] for score in expected]
+            assert np.allclose([score['score'] for score in ranked], [score['score'] for score in expected], atol=0.01)
+            batch = calculator.get_batch_document_scores(calculator.get_query_matrix([index.preprocess_text("python web search")]))
+            assert [score['document_id'] for score in batch[0]] == [score['document_id'] for score in ranked]
+            
+            with tempfile.TemporaryDirectory() as temp_dir:
+                matrix_path = os.path.join(temp_dir, "tfidf_matrix")
+                calculator.save_document_matrix(matrix_path)
+                loaded = TFIDFCalculator(index)
+                loaded.load_document_matrix(matrix_path)
+                assert loaded.precision == precision
+                assert loaded.get_document_scores(query_vector) == ranked
+                assert np.allclose(loaded.document_vectors["doc1"], calculator.document_vectors["doc1"])
+    
+    def test_incremental_tfidf(self):
+        """Test that added and removed documents keep IDF and norms equal to a full recomputation."""
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        from indexer.tfidf_calculator import TFIDFCalculator
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "web crawler crawler python", {})
+        index.add_document("doc2", "python search engine", {})
+        index.add_document("doc3", "web search ranking", {})
+        
+        calculator = TFIDFCalculator(index)
+        calculator.calculate_tfidf()
+        
+        index.add_document("doc4", "python tutorial tutorial ranking", {})
+        index.update_document("doc2", "search engine indexing", {})
+        index.delete_document("doc3")
+        assert calculator.add_documents(["doc4", "doc2", "missing"]) == 2
+        assert calculator.remove_documents(["doc3", "missing"]) == 1
+        assert set(calculator.document_vectors) == {"doc1", "doc2", "doc4"}
+        
+        rebuilt = TFIDFCalculator(index)
+        rebuilt.calculate_tfidf()
+        for doc_id in ("doc1", "doc2", "doc4"):
+            vector = calculator.document_vectors[doc_id]
+            expected = rebuilt.document_vectors[doc_id]
+            assert np.allclose([vector[calculator.term_to_index[term]] for term in rebuilt.term_to_index], expected)
+            assert np.isclose(calculator.document_norms[calculator.document_rows[doc_id]],
+                              rebuilt.document_norms[rebuilt.document_rows[doc_id]])
+        
+        query_vector = calculator.get_query_vector(index.preprocess_text("python search tutorial"))
+        ranked = calculator.get_document_scores(query_vector)
+        expected = rebuilt.get_document_scores(rebuilt.get_query_vector(index.preprocess_text("python search tutorial")))
+        assert [score['document_id'] for score in ranked] == [score['document_id'] for score in expected]
+        assert np.allclose([score['score'] for score in ranked], [score['score'] for score in expected])
+        batch = calculator.get_batch_document_scores(
+            calculator.get_query_matrix([index.preprocess_text("python search tutorial")]))
+        assert [score['document_id'] for score in batch[0]] == [score['document_id'] for score in ranked]
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Saving compacts the removed rows; new terms keep their appended columns
+            matrix_path = os.path.join(temp_dir, "tfidf_matrix")
+            calculator.save_document_matrix(matrix_path)
+            assert calculator.compact() == 0 and len(calculator.document_ids) == 3
+            with open(TFIDFCalculator.matrix_manifest_path(matrix_path), 'r', encoding='utf-8') as f:
+                assert json.load(f)['terms'] == list(calculator.term_to_index)
+            loaded = TFIDFCalculator(index)
+            loaded.load_document_matrix(matrix_path)
+            assert loaded.get_document_scores(query_vector) == ranked
+            
+            loaded.remove_documents(["doc1"])
+            assert "doc1" not in {score['document_id'] for score in loaded.get_document_scores(query_vector)}
+            
+            # In-memory arrays can be updated and saved over the files they were read from
+            loaded = TFIDFCalculator(index)
+            loaded.load_document_matrix(matrix_path, mmap_mode=None)
+            assert loaded.get_document_scores(query_vector) == ranked
+            index.add_document("doc5", "python search", {})
+            loaded.add_documents(["doc5"])
+            loaded.save_document_matrix(matrix_path)
+            loaded = TFIDFCalculator(index)
+            loaded.load_document_matrix(matrix_path)
+            assert "doc5" in {score['document_id'] for score in loaded.get_document_scores(query_vector)}
+            
+            # A matrix only loads against the index state it was saved with
+            index.delete_document("doc5")
+            with pytest.raises(ValueError):
+                TFIDFCalculator(index).load_document_matrix(matrix_path)
+    
+    def test_incremental_tfidf_appends(self):
+        """Test that rows appended from analyzed terms match a full recomputation without a matrix rebuild."""
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        from indexer.tfidf_calculator import TFIDFCalculator
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "web crawler crawler python", {})
+        index.add_document("doc2", "python search engine", {})
+        calculator = TFIDFCalculator(index)
+        calculator.calculate_tfidf()
+        term_matrix = calculator._term_matrix
+        
+        contents = {"doc3": "web search ranking", "doc4": "python tutorial tutorial ranking",
+                    "doc2": "search engine indexing", "doc5": "crawler tutorial"}
+        for doc_id, content in contents.items():
+            terms = index.add_document(doc_id, content, {})
+            assert calculator.add_documents([doc_id], {doc_id: terms}) == 1
+            # A small append only extends the rows; the column-major matrix is rebuilt once appends outgrow it
+            if doc_id == "doc3":
+                assert calculator._term_matrix is term_matrix
+        
+        rebuilt = TFIDFCalculator(index)
+        rebuilt.calculate_tfidf()
+        for doc_id in rebuilt.document_ids:
+            vector = calculator.document_vectors[doc_id]
+            assert np.allclose([vector[calculator.term_to_index[term]] for term in rebuilt.term_to_index],
+                               rebuilt.document_vectors[doc_id])
+            assert np.isclose(calculator.document_norms[calculator.document_rows[doc_id]],
+                              rebuilt.document_norms[rebuilt.document_rows[doc_id]])
+        
+        for query in ("python search tutorial", "crawler ranking", "indexing"):
+            ranked = calculator.get_document_scores(calculator.get_query_vector(index.preprocess_text(query)))
+            expected = rebuilt.get_document_scores(rebuilt.get_query_vector(index.preprocess_text(query)))
+            assert [score['document_id'] for score in ranked] == [score['document_id'] for score in expected]
+            assert np.allclose([score['score'] for score in ranked], [score['score'] for score in expected])
+            batch = calculator.get_batch_document_scores(calculator.get_query_matrix([index.preprocess_text(query)]))
+            assert [score['document_id'] for score in batch[0]] == [score['document_id'] for score in ranked]
+    
+    def test_bm25_impacts(self):
+        """Test precomputed BM25 impacts, ranked retrieval and impact persistence."""
+        import math
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "python crawler python tutorial", {})
+        index.add_document("doc2", "python search engine ranking", {})
+        index.add_document("doc3", "web crawler", {})
+        
+        # Quantized impacts follow the exact BM25 contributions
+        python = index.preprocess_text("python")[0]
+        k1, b = index.bm25.k1, index.bm25.b
+        lengths = {"doc1": 4, "doc2": 4, "doc3": 2}
+        average_length = sum(lengths.values()) / 3
+        idf = math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))
+        expected = [idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[doc] / average_length))
+                    for doc, tf in (("doc1", 2), ("doc2", 1))]
+        approximate = index.impacts(python) * index.impact_scale
+        assert np.allclose(approximate, expected, rtol=0.02)
+        
+        # Ranked retrieval matches documents holding any query term
+        results = index.rank("python crawler")
+        assert [result['document_id'] for result in results] == ["doc1", "doc3", "doc2"]
+        assert index.rank("python crawler", phrases=[("python crawler", 0)])[0]['document_id'] == "doc1"
+        assert len(index.rank("python crawler", phrases=[("python crawler", 0)])) == 1
+        
+        index.delete_document("doc1")
+        assert "doc1" not in {result['document_id'] for result in index.rank("python crawler")}
+        index.compact()
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_path = os.path.join(temp_dir, "index.bin")
+            index.save_index(index_path)
+            for mmap in (False, True):
+                loaded = InvertedIndex()
+                loaded.load_index(index_path, mmap=mmap)
+                assert loaded._impacts is not None
+                assert loaded.rank("python crawler") == index.rank("python crawler")
+                loaded.close()
+    
+    def test_maxscore_pruning(self):
+        """Test that MaxScore pruning returns the exhaustive top K."""
+        import random
+        from indexer.inverted_index import InvertedIndex
+        
+        words = ["python", "crawler", "search", "engine", "ranking", "index", "query", "web",
+                 "page", "link", "score", "vector", "token", "stem", "graph", "node"]
+        rng = random.Random(7)
+        index = InvertedIndex()
+        # Skewed word frequencies give the rare-plus-common queries pruning is for
+        frequencies = [1 / (rank + 1) ** 2 for rank in range(len(words))]
+        for i in range(200):
+            index.add_document(f"doc{i}", " ".join(rng.choices(words, frequencies, k=rng.randint(3, 30))), {})
+        
+        for _ in range(20):
+            query_terms = index.preprocess_text(" ".join(rng.sample(words, rng.randint(2, 8))))
+            for top_k in (1, 5, 20):
+                pruned = index.rank_terms(query_terms, top_k)
+                assert pruned == index.rank_terms(query_terms, top_k, prune=False)
+                assert len(pruned) == top_k
+        
+        term = index.preprocess_text("python")[0]
+        assert index.upper_bound(term) == index.impacts(term).max()
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_path = os.path.join(temp_dir, "index.bin")
+            index.save_index(index_path)
+            loaded = InvertedIndex()
+            loaded.load_index(index_path, mmap=True)
+            assert loaded.upper_bound(term) == index.upper_bound(term)
+            assert loaded.rank_terms([term, "crawler"], 5) == index.rank_terms([term, "crawler"], 5)
+            loaded.close()
+    
+    def test_accumulator_paths(self):
+        """Test that ranking gives the same results with the dense and the sparse impact accumulator."""
+        from indexer.inverted_index import InvertedIndex
+        
+        documents = [
+            ("doc1", "search engine ranking search"),
+            ("doc2", "web crawler search"),
+            ("doc3", "search engine crawler"),
+            ("doc4", "ranking web crawler engine"),
+        ]
+        small, large = InvertedIndex(), InvertedIndex()
+        for doc_id, content in documents:
+            small.add_document(doc_id, content, {})
+            large.add_document(doc_id, content, {})
+        
+        # Filler documents of hapax words lose every posting to pruning, so BM25
+        # statistics stay the same while the query postings become sparse
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        for number in range(100):
+            large.add_document(f"filler{number}", f"zq{letters[number // 26]}{letters[number % 26]}x", {})
+        large.prune_vocabulary(min_document_frequency=2, max_document_frequency=1.0)
+        assert large.vocabulary == small.vocabulary
+        
+        for query in ("search crawler", "engine ranking web", "search search engine"):
+            for top_k in (2, 10):
+                expected = small.rank(query, top_k=top_k)
+                assert expected
+                assert large.rank(query, top_k=top_k) == expected
+    
+    def test_block_max_metadata(self):
+        """Test per-block impact maxima and block-max pruning."""
+        import random
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        from indexer.scoring import BM25
+        
+        words = ["python", "crawler", "search", "engine", "ranking", "index", "query", "web"]
+        rng = random.Random(3)
+        index = InvertedIndex()
+        index.bm25 = BM25(block_size=4)
+        for i in range(60):
+            index.add_document(f"doc{i}", " ".join(rng.choices(words, k=rng.randint(2, 12))), {})
+        
+        term = index.preprocess_text("python")[0]
+        doc_ids, impacts = index.index[term].doc_id_array(), index.impacts(term)
+        blocks = range(0, len(doc_ids), 4)
+        assert index.impact_index.block_last_ids[term].tolist() == [doc_ids[min(i + 3, len(doc_ids) - 1)] for i in blocks]
+        assert index.impact_index.block_maxima[term].tolist() == [impacts[i:i + 4].max() for i in blocks]
+        assert np.all(index.block_bounds(term, doc_ids) >= impacts)
+        
+        query_terms = index.preprocess_text(" ".join(words))
+        assert index.rank_terms(query_terms, 3) == index.rank_terms(query_terms, 3, prune=False)
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_path = os.path.join(temp_dir, "index.bin")
+            index.save_index(index_path)
+            for mmap in (False, True):
+                loaded = InvertedIndex()
+                loaded.bm25 = BM25(block_size=4)
+                loaded.load_index(index_path, mmap=mmap)
+                assert np.array_equal(loaded.impact_index.block_maxima[term], index.impact_index.block_maxima[term])
+                assert np.array_equal(loaded.impact_index.block_last_ids[term], index.impact_index.block_last_ids[term])
+                assert loaded.rank_terms(query_terms, 3) == index.rank_terms(query_terms, 3)
+                loaded.close()
+    
+    def test_top_k_selection(self):
+        """Test heap and partition top-k selection against a full stable sort."""
+        import random
+        import numpy as np
+        from indexer.topk import TopK, top_k_indices, top_k_items
+        
+        rng = random.Random(5)
+        scores = [rng.randint(0, 20) for _ in range(300)]
+        expected = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        for k in (0, 1, 7, 50, 300, 400, None):
+            limit = len(scores) if k is None else k
+            assert top_k_indices(np.array(scores), k).tolist() == expected[:limit]
+            assert top_k_items(range(len(scores)), k, key=lambda i: scores[i]) == expected[:limit]
+        
+        top = TopK(3)
+        for i, score in enumerate([0.5, 0.9, 0.1, 0.9, 0.7]):
+            top.push(score, f"doc{i}")
+        assert top.results() == [(0.9, "doc1"), (0.9, "doc3"), (0.7, "doc4")]
+        assert top.threshold() == 0.7
+    
+    def test_batch_document_scores(self):
+        """Test that batch scoring matches scoring each query vector separately."""
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        from indexer.tfidf_calculator import TFIDFCalculator
+        from indexer.cosine_similarity import CosineSimilarity
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "web crawler crawler python", {"word_count": 4})
+        index.add_document("doc2", "python search engine", {"word_count": 3})
+        index.add_document("doc3", "web search ranking ranking", {"word_count": 4})
+        for i in range(30):
+            index.add_document(f"other{i}", f"unrelated filler{i} pages", {"word_count": 3})
+        calculator = TFIDFCalculator(index)
+        calculator.calculate_tfidf()
+        
+        # Rare and common queries, so blocks are ranked both from sparse matches and densely
+        queries = [index.preprocess_text(text) for text in
+                   ["python search", "crawler", "unknown words", "", "web ranking python", "unrelated pages"]]
+        query_matrix = calculator.get_query_matrix(queries)
+        assert query_matrix.shape == (len(queries), len(calculator.term_to_index))
+        for row, query_terms in enumerate(queries):
+            assert np.allclose(query_matrix[row].toarray().ravel(), calculator.get_query_vector(query_terms))
+        
+        for top_k, batch_size in ((None, 1), (1, 2), (2, None), (40, 3)):
+            batch = calculator.get_batch_document_scores(query_matrix, top_k, batch_size)
+            expected = [calculator.get_document_scores(calculator.get_query_vector(query_terms), top_k)
+                        for query_terms in queries]
+            assert len(batch) == len(queries)
+            for scores, expected_scores in zip(batch, expected):
+                assert [score['document_id'] for score in scores] == \
+                    [score['document_id'] for score in expected_scores]
+                assert np.allclose([score['score'] for score in scores], [score['score'] for score in expected_scores])
+        
+        # Pairwise query similarities agree for dense and sparse input
+        dense = [calculator.get_query_vector(query_terms) for query_terms in queries]
+        similarities = CosineSimilarity().batch_similarity(query_matrix)
+        assert np.allclose(similarities, CosineSimilarity().batch_similarity(dense))
+        assert np.isclose(similarities[0, 0], 1.0) and similarities[2, 2] == 0.0
+        
+        # Tiny memory budgets stream one-row blocks with the same result
+        documents = calculator.document_matrix.multiply(calculator.idf).tocsr()
+        full = CosineSimilarity().batch_similarity(documents)
+        assert np.allclose(CosineSimilarity().batch_similarity(documents, memory_mb=1e-6), full)
+        assert np.allclose(CosineSimilarity().batch_similarity(documents.toarray(), memory_mb=1e-3), full)
+        indices, neighbor_similarities = CosineSimilarity().top_k_neighbors(documents, 3, memory_mb=1e-4)
+        assert indices.shape == (documents.shape[0], 3)
+        for row in range(documents.shape[0]):
+            others = np.delete(np.arange(documents.shape[0]), row)
+            expected = others[np.argsort(-full[row, others], kind='stable')[:3]]
+            assert indices[row].tolist() == expected.tolist()
+            assert np.allclose(neighbor_similarities[row], full[row, expected])
+    
+    def test_rank_matrix(self):
+        """Test ranking a stacked, normalized document matrix against per-document similarities."""
+        import numpy as np
+        from scipy import sparse
+        from indexer.inverted_index import InvertedIndex
+        from indexer.tfidf_calculator import TFIDFCalculator
+        from indexer.cosine_similarity import CosineSimilarity
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "web crawler crawler python", {})
+        index.add_document("doc2", "python search engine", {})
+        index.add_document("doc3", "web search ranking", {})
+        index.add_document("doc4", "python web", {})
+        index.add_document("doc5", "unrelated page", {})
+        calculator = TFIDFCalculator(index)
+        calculator.calculate_tfidf()
+        
+        cosine = CosineSimilarity()
+        query_vector = calculator.get_query_vector(index.preprocess_text("python web"))
+        expected = sorted(((cosine.calculate_similarity(query_vector, vector), doc_id)
+                           for doc_id, vector in calculator.document_vectors.items()), key=lambda pair: -pair[0])
+        
+        ranked = cosine.rank_documents(query_vector, calculator.document_vectors, top_k=3)
+        assert [result['document_id'] for result in ranked] == [doc_id for _, doc_id in expected[:3]]
+        assert np.allclose([result['similarity_score'] for result in ranked], [score for score, _ in expected[:3]])
+        
+        dense = np.array([calculator.document_vectors[doc_id] for doc_id in calculator.document_ids])
+        for matrix in (dense, sparse.csr_matrix(dense)):
+            normalized = cosine.normalize_rows(matrix)
+            top = cosine.rank_matrix(query_vector, normalized, calculator.document_ids, top_k=3)
+            assert [result['document_id'] for result in top] == [result['document_id'] for result in ranked]
+            assert np.allclose([result['similarity_score'] for result in top],
+                               [result['similarity_score'] for result in ranked])
+            everything = cosine.rank_matrix(query_vector, normalized, calculator.document_ids, top_k=None)
+            assert len(everything) == 5 and everything[-1] == {'document_id': "doc5", 'similarity_score': 0.0}
+        assert cosine.rank_matrix(np.zeros(len(query_vector)), cosine.normalize_rows(dense),
+                                  calculator.document_ids, top_k=2)[0]['similarity_score'] == 0.0
+        assert cosine.rank_documents(query_vector, {}) == []
+    
+    def test_ann_index(self):
+        """Test the NumPy ANN first stage against exact TF-IDF search, and its persistence."""
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        from indexer.tfidf_calculator import TFIDFCalculator
+        from indexer.ann_index import ANNIndex
+        
+        rng = np.random.default_rng(7)
+        topics = [[f"topic{topic}word{word}" for word in range(12)] for topic in range(6)]
+        index = InvertedIndex()
+        for doc in range(120):
+            words = rng.choice(topics[doc % 6], 8).tolist() + rng.choice(topics[(doc + 1) % 6], 2).tolist()
+            index.add_document(f"doc{doc}", " ".join(words), {})
+        calculator = TFIDFCalculator(index)
+        calculator.calculate_tfidf()
+        queries = [calculator.get_query_vector(index.preprocess_text(" ".join(rng.choice(topic, 3).tolist())))
+                   for topic in topics]
+        
+        # Exact re-ranking of every row is exact search
+        query_vector = queries[0]
+        everything = np.arange(len(calculator.document_ids))
+        assert calculator.get_candidate_scores(query_vector, everything, 5) == calculator.get_document_scores(query_vector, 5)
+        assert calculator.get_candidate_scores(np.zeros_like(query_vector), everything, 5) == []
+        
+        # Hashed into fewer dimensions than terms, probing every cell
+        ann = ANNIndex(backend='numpy')
+        ann.embedding_dim, ann.nlist, ann.nprobe = 32, 6, 6
+        ann.build_index(calculator)
+        assert ann.dimension == 32 and ann.vectors.shape == (120, 32)
+        assert set(np.diff(ann.cell_offsets).tolist()) != {0} and ann.cell_offsets[-1] == 120
+        rows = ann.search(query_vector, 10)
+        assert len(rows) == 10 and len(set(rows.tolist())) == 10
+        report = ann.evaluate(calculator, queries, k=5)
+        assert report['queries'] == 6 and report['recall_at_k'] >= 0.8
+        assert report['ann_latency_ms'] >= 0 and report['exact_latency_ms'] >= 0
+        
+        # A vocabulary no wider than the dimension keeps one dimension per term
+        exact = ANNIndex(backend='numpy')
+        exact.nprobe = exact.nlist
+        exact.build_index(calculator)
+        assert exact.dimension == len(calculator.term_to_index)
+        assert exact.evaluate(calculator, queries, k=5)['recall_at_k'] == 1.0
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ann_path = os.path.join(temp_dir, "ann_index")
+            ann.save_index(ann_path)
+            loaded = ANNIndex(backend='numpy')
+            loaded.nprobe = ann.nprobe
+            loaded.load_index(ann_path, calculator)
+            assert loaded.dimension == 32
+            assert loaded.search(query_vector, 10).tolist() == rows.tolist()
+            
+            # An index only loads against the document matrix it was built from
+            index.add_document("doc120", "topic0word1 topic0word2", {})
+            calculator.add_documents(["doc120"])
+            with pytest.raises(ValueError):
+                ANNIndex(backend='numpy').load_index(ann_path, calculator)
+    
+    def test_document_neighbors(self):
+        """Test the precomputed neighbor table against brute-force cosine similarity, and its persistence."""
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        from indexer.tfidf_calculator import TFIDFCalculator
+        from indexer.cosine_similarity import CosineSimilarity
+        from indexer.neighbors import DocumentNeighbors
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "web crawler crawler python", {})
+        index.add_document("doc2", "python search engine", {})
+        index.add_document("doc3", "web search ranking", {})
+        index.add_document("doc4", "python web crawler", {})
+        index.add_document("doc5", "unrelated page", {})
+        calculator = TFIDFCalculator(index)
+        calculator.precision = "uint8"
+        calculator.calculate_tfidf()
+        
+        neighbors = DocumentNeighbors()
+        neighbors.build_table(calculator, count=3)
+        assert neighbors.neighbors.shape == (5, 3)
+        
+        cosine = CosineSimilarity()
+        vectors = calculator.document_vectors
+        for doc_id in ("doc1", "doc2", "doc4"):
+            expected = sorted(((cosine.calculate_similarity(vectors[doc_id], vectors[other]), other)
+                               for other in vectors if other != doc_id), key=lambda pair: -pair[0])
+            expected = [(score, other) for score, other in expected[:3] if score > 0]
+            similar = neighbors.similar(doc_id)
+            assert [entry['document_id'] for entry in similar] == [other for _, other in expected]
+            assert np.allclose([entry['similarity_score'] for entry in similar], [score for score, _ in expected],
+                               atol=0.02)
+        assert neighbors.similar("doc5") == []
+        assert len(neighbors.similar("doc1", top_k=1)) == 1
+        assert neighbors.similar("missing") is None
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            neighbors_path = os.path.join(temp_dir, "neighbors")
+            neighbors.save_table(neighbors_path)
+            loaded = DocumentNeighbors()
+            loaded.load_table(neighbors_path, calculator.index_signature())
+            assert loaded.similar("doc1") == neighbors.similar("doc1")
+            
+            index.delete_document("doc3")
+            with pytest.raises(ValueError):
+                DocumentNeighbors().load_table(neighbors_path, calculator.index_signature())
+    
+    def test_vocabulary_pruning(self):
+        """Test document frequency pruning of the vocabulary and its persistence."""
+        from indexer.inverted_index import InvertedIndex
+        from indexer.tfidf_calculator import TFIDFCalculator
+        
+        index = InvertedIndex()
+        index.add_document("doc1", "python web crawler tutorial", {"word_count": 4})
+        index.add_document("doc2", "python search engine crawler", {"word_count": 4})
+        index.add_document("doc3", "python search ranking", {"word_count": 3})
+        index.add_document("doc4", "python web ranking engine", {"word_count": 4})
+        index.add_document("doc5", "python crawler ranking", {"word_count": 3})
+        python, crawler, tutorial = (index.preprocess_text(word)[0] for word in ("python", "crawler", "tutorial"))
+        vocabulary_size = len(index.vocabulary)
+        
+        # Thresholds come from indexer.min/max_document_frequency (2 and 0.8)
+        pruning = index.prune_vocabulary()
+        assert tutorial not in index.vocabulary
+        assert python in index.vocabulary and crawler in index.vocabulary
+        assert pruning['pruned_rare_terms'] == 1 and pruning['pruned_common_terms'] == 1
+        assert pruning['pruned_postings'] == 1 and pruning['stop_terms'] == [python]
+        assert len(index.vocabulary) == vocabulary_size - 1
+        assert index.get_statistics()['pruned_terms'] == 2
+        
+        # Stop terms are ignored next to other query terms; phrases still match them exactly
+        assert index.scoring_terms([python, crawler]) == [crawler]
+        assert {result['document_id'] for result in index.search("python crawler")} == {"doc1", "doc2", "doc5"}
+        assert index.match_phrases([("python web crawler", 0)]) == {"doc1"}
+        assert index.match_phrases([("web python crawler", 0)]) == set()
+        
+        # A query of stop terms alone still finds its documents on every scoring path
+        everything = {"doc1", "doc2", "doc3", "doc4", "doc5"}
+        assert index.scoring_terms([python]) == [python]
+        assert {result['document_id'] for result in index.search("python")} == everything
+        assert {result['document_id'] for result in index.rank("python")} == everything
+        
+        calculator = TFIDFCalculator(index)
+        calculator.calculate_tfidf()
+        assert calculator.document_matrix.shape == (5, vocabulary_size - 1)
+        query_vector = calculator.get_query_vector([python])
+        assert {score['document_id'] for score in calculator.get_document_scores(query_vector)} == everything
+        assert not calculator.get_query_vector([python, crawler])[calculator.term_to_index[python]]
+        assert calculator.similarity_idf[calculator.term_to_index[python]] == 0
+        
+        # Nothing is pruned when no term would be left
+        single = InvertedIndex()
+        single.add_document("doc1", "python crawler", {"word_count": 2})
+        assert single.prune_vocabulary() == {} and len(single.vocabulary) == 2
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for filename in ("index.bin", "index.json"):
+                index_path = os.path.join(temp_dir, filename)
+                index.save_index(index_path)
+                loaded = InvertedIndex()
+                loaded.load_index(index_path)
+                assert loaded.pruning == pruning
+            loaded.load_index(os.path.join(temp_dir, "index.bin"), mmap=True)
+            assert loaded.pruning == pruning
+            assert {result['document_id'] for result in loaded.search("python")} == everything
+            loaded.close()
+            
+            # Segments built on a pruned index share its stop terms
+            from indexer.segments import SegmentedIndex
+            segmented = SegmentedIndex(os.path.join(temp_dir, "segments"), background_merges=False)
+            segmented.add_segment_file(os.path.join(temp_dir, "index.bin"))
+            assert segmented.scoring_terms([python, crawler]) == [crawler]
+            assert {result['document_id'] for result in segmented.search("python")} == everything
+            
+            # New segments are not pruned; merges keep the adopted build's pruning records
+            segmented.add_document("doc6", "python tutorial", {"word_count": 2})
+            segmented.flush()
+            assert {result['document_id'] for result in segmented.search("tutorial")} == {"doc6"}
+            adopted = segmented.segments[0].name
+            segmented.delete_document("doc3")
+            segmented.delete_document("doc4")
+            assert segmented.segments[0].name != adopted
+            assert segmented.segments[0].index.pruning == pruning
+            segmented.close()
+        
+        # Merged partials add up their pruning counts
+        merged = InvertedIndex()
+        merged.merge(index)
+        merged.merge(index)
+        assert merged.pruning == dict(pruning, pruned_rare_terms=2, pruned_common_terms=2, pruned_postings=2)
+    
     def test_search_functionality(self):
         """Test basic search functionality."""
         from indexer.inverted_index import InvertedIndex
@@ -0,0 +1,290 @@
+"""
+Tests for the segmented (incremental) index.
+"""
+
+import pytest
+import tempfile
+import os
+
+SAMPLE_DOCUMENTS = [
+    ("doc1", "search engine technology", {"title": "Doc 1"}),
+    ("doc2", "web crawling techniques for search", {"title": "Doc 2"}),
+    ("doc3", "information retrieval systems", {"title": "Doc 3"}),
+    ("doc4", "search engine ranking and retrieval", {"title": "Doc 4"}),
+    ("doc5", "python web frameworks", {"title": "Doc 5"}),
+]
+
+class TestSegmentedIndex:
+    """Test cases for segment-based incremental indexing."""
+    
+    def test_merge_policy(self):
+        """Test that the tiered policy merges runs of similarly sized segments."""
+        from indexer.segments import TieredMergePolicy
+        
+        policy = TieredMergePolicy(segments_per_tier=3)
+        
+        assert policy.find_merges([1, 1]) == []
+        assert policy.find_merges([1, 1, 1]) == [(0, 3)]
+        assert policy.find_merges([30, 1, 2, 1, 1]) == [(1, 4)]
+    
+    def test_segments_match_single_index(self):
+        """Test that searching several segments matches one monolithic index."""
+        from indexer.inverted_index import InvertedIndex
+        from indexer.segments import SegmentedIndex, TieredMergePolicy
+        
+        monolithic = InvertedIndex()
+        for doc_id, content, metadata in SAMPLE_DOCUMENTS:
+            monolithic.add_document(doc_id, content, metadata)
+        
+        with tempfile.TemporaryDirectory() as directory:
+            segmented = SegmentedIndex(directory, merge_policy=TieredMergePolicy(10), background_merges=False)
+            for doc_id, content, metadata in SAMPLE_DOCUMENTS:
+                segmented.add_document(doc_id, content, metadata)
+                segmented.flush()
+            
+            assert len(segmented.segments) == len(SAMPLE_DOCUMENTS)
+            assert segmented.total_documents == monolithic.total_documents
+            assert segmented.vocabulary == monolithic.vocabulary
+            assert segmented.get_document_frequency("search") == monolithic.get_document_frequency("search")
+            
+            results = segmented.search("search engine", top_k=10)
+            expected = monolithic.search("search engine", top_k=10)
+            assert sorted((r['document_id'], r['score']) for r in results) == \
+                sorted((r['document_id'], r['score']) for r in expected)
+            
+            segmented.close()
+    
+    def test_rank_matches_single_index(self):
+        """Test that BM25 scores across segments equal those of one index over the same documents."""
+        import numpy as np
+        from indexer.inverted_index import InvertedIndex
+        from indexer.scoring import BM25
+        from indexer.segments import SegmentedIndex, TieredMergePolicy
+        
+        documents = SAMPLE_DOCUMENTS + [
+            ("doc6", "search search engine optimization guide", {}),
+            ("doc7", "distributed retrieval engine", {}),
+        ]
+        monolithic = InvertedIndex()
+        monolithic.bm25 = BM25(impact_bits=16)  # fine quantization, to compare with exact scores
+        for doc_id, content, metadata in documents:
+            monolithic.add_document(doc_id, content, metadata)
+        
+        with tempfile.TemporaryDirectory() as directory:
+            segmented = SegmentedIndex(directory, merge_policy=TieredMergePolicy(10), background_merges=False)
+            for position, (doc_id, content, metadata) in enumerate(documents):
+                segmented.add_document(doc_id, content, metadata)
+                if position % 3 == 2:
+                    segmented.flush()
+            # A tombstoned old version must not count towards the statistics
+            segmented.add_document("doc8", "search engine retrieval", {})
+            segmented.flush()
+            assert segmented.delete_document("doc8")
+            assert len(segmented.segments) > 1
+            
+            for query, phrases in [("search engine", None), ("retrieval engine", None),
+                                   ("search", [("search engine", 0)])]:
+                results = segmented.rank(query, top_k=5, phrases=phrases)
+                expected = monolithic.rank(query, top_k=5, phrases=phrases)
+                assert [r['document_id'] for r in results] == [r['document_id'] for r in expected]
+                assert np.allclose([r['score'] for r in results], [r['score'] for r in expected], rtol=1e-3)
+            
+            segmented.close()
+    
+    def test_merge_and_reopen(self):
+        """Test that merges shrink the segment list and survive reopening."""
+        from indexer.segments import SegmentedIndex, TieredMergePolicy
+        
+        with tempfile.TemporaryDirectory() as directory:
+            segmented = SegmentedIndex(directory, merge_policy=TieredMergePolicy(2), background_merges=True)
+            for doc_id, content, metadata in SAMPLE_DOCUMENTS:
+                segmented.add_document(doc_id, content, metadata)
+                segmented.flush()
+            segmented.wait_for_merges()
+            
+            assert len(segmented.segments) < len(SAMPLE_DOCUMENTS)
+            assert segmented.total_documents == len(SAMPLE_DOCUMENTS)
+            segmented.close()
+            
+            reopened = SegmentedIndex(directory, background_merges=False)
+            assert reopened.total_documents == len(SAMPLE_DOCUMENTS)
+            assert len(reopened.search("retrieval")) == 2
+            assert sorted(os.listdir(directory)) == sorted(
+                [SegmentedIndex.MANIFEST_NAME] + [segment.name for segment in reopened.segments])
+            reopened.close()
+    
+    def test_delete_and_update_across_segments(self):
+        """Test that tombstones hide old versions, persist and are purged by merges."""
+        from indexer.segments import SegmentedIndex, TieredMergePolicy
+        
+        with tempfile.TemporaryDirectory() as directory:
+            segmented = SegmentedIndex(directory, merge_policy=TieredMergePolicy(10), background_merges=False)
+            for doc_id, content, metadata in SAMPLE_DOCUMENTS:
+                segmented.add_document(doc_id, content, metadata)
+            segmented.flush()
+            
+            segmented.update_document("doc1", "python programming tutorial", {"title": "Doc 1 v2"})
+            assert segmented.delete_document("doc2")
+            segmented.flush()
+            
+            assert segmented.total_documents == len(SAMPLE_DOCUMENTS) - 1
+            assert {r['document_id'] for r in segmented.search("search")} == {"doc4"}
+            assert {r['document_id'] for r in segmented.search("python")} == {"doc1", "doc5"}
+            segmented.close()
+            
+            # Tombstones are recorded in the manifest and survive reopening
+            reopened = SegmentedIndex(directory, merge_policy=TieredMergePolicy(2), background_merges=False)
+            assert reopened.total_documents == len(SAMPLE_DOCUMENTS) - 1
+            assert {r['document_id'] for r in reopened.search("search")} == {"doc4"}
+            
+            # Merging purges the tombstoned postings
+            reopened.maybe_merge()
+            assert all(not segment.index.deleted_documents for segment in reopened.segments)
+            assert reopened.get_document_frequency("search") == 1
+            assert reopened.total_documents == len(SAMPLE_DOCUMENTS) - 1
+            reopened.close()
+    
+    def test_tfidf_matrix_after_merged_delete(self):
+        """Test that a saved TF-IDF matrix keeps its columns when a merge drops a deleted document's terms."""
+        from indexer.segments import SegmentedIndex, TieredMergePolicy
+        from indexer.tfidf_calculator import TFIDFCalculator
+        
+        with tempfile.TemporaryDirectory() as directory:
+            segmented = SegmentedIndex(os.path.join(directory, "segments"), merge_policy=TieredMergePolicy(2),
+                                       background_merges=False)
+            segmented.add_document("A", "alpha bravo", {})
+            segmented.add_document("B", "bravo charlie", {})
+            segmented.add_document("C", "charlie delta", {})
+            segmented.flush()
+            calculator = TFIDFCalculator(segmented)
+            calculator.calculate_tfidf()
+            
+            # The merge purging A removes "alpha", whose column stays in the matrix
+            segmented.delete_document("A")
+            segmented.flush()
+            segmented.wait_for_merges()
+            assert "alpha" not in segmented.vocabulary
+            calculator.remove_documents(["A"])
+            matrix_path = os.path.join(directory, "tfidf_matrix")
+            calculator.save_document_matrix(matrix_path)
+            assert calculator.document_matrix.shape == (2, 4)
+            
+            loaded = TFIDFCalculator(segmented)
+            loaded.load_document_matrix(matrix_path)
+            for query, expected in (("delta", ["C"]), ("bravo", ["B"]), ("charlie", ["B", "C"])):
+                query_vector = loaded.get_query_vector(segmented.preprocess_text(query))
+                assert sorted(score['document_id'] for score in loaded.get_document_scores(query_vector)) == expected
+            segmented.close()
+    
+    def test_build_id(self):
+        """Test that saved indexes and segment manifests keep their build id until the documents change."""
+        from indexer.inverted_index import InvertedIndex
+        from indexer.segments import SegmentedIndex, TieredMergePolicy
+        from indexer.tfidf_calculator import TFIDFCalculator
+        
+        index = InvertedIndex()
+        for doc_id, content, metadata in SAMPLE_DOCUMENTS[:3]:
+            index.add_document(doc_id, content, metadata)
+        
+        with tempfile.TemporaryDirectory() as directory:
+            for filename, mmap in (("index.bin", True), ("index.bin", False), ("index.json", False)):
+                path = os.path.join(directory, filename)
+                index.save_index(path)
+                loaded = InvertedIndex()
+                loaded.load_index(path, mmap=mmap)
+                assert loaded.build_id == index.build_id
+                loaded.close()
+            
+            # A matrix saved for the full build loads against the segmented index adopting it
+            calculator = TFIDFCalculator(index)
+            calculator.calculate_tfidf()
+            matrix_path = os.path.join(directory, "tfidf_matrix")
+            calculator.save_document_matrix(matrix_path)
+            segments_dir = os.path.join(directory, "segments")
+            segmented = SegmentedIndex(segments_dir, merge_policy=TieredMergePolicy(2), background_merges=False)
+            segmented.add_segment_file(os.path.join(directory, "index.bin"))
+            assert segmented.build_id == index.build_id
+            TFIDFCalculator(segmented).load_document_matrix(matrix_path)
+            
+            # Adding documents starts a new id; merges and reopening keep it
+            segmented.add_document(*SAMPLE_DOCUMENTS[3])
+            segmented.flush()
+            build_id = segmented.build_id
+            assert build_id != index.build_id
+            segmented.add_document(*SAMPLE_DOCUMENTS[4])
+            segmented.flush()
+            build_id = segmented.build_id
+            segmented.wait_for_merges()
+            assert segmented.build_id == build_id
+            segmented.close()
+            
+            reopened = SegmentedIndex(segments_dir, background_merges=False)
+            assert reopened.build_id == build_id
+            with pytest.raises(ValueError):
+                TFIDFCalculator(reopened).load_document_matrix(matrix_path)
+            reopened.delete_document("doc1")
+            assert reopened.build_id != build_id
+            reopened.close()    
+    def test_segment_files_lifecycle(self):
+        """Test that merges release replaced segments and only a writer removes unlisted segment files."""
+        from indexer.segments import SegmentedIndex, TieredMergePolicy
+        
+        with tempfile.TemporaryDirectory() as directory:
+            segmented = SegmentedIndex(directory, merge_policy=TieredMergePolicy(2), background_merges=False)
+            segmented.add_document(*SAMPLE_DOCUMENTS[0])
+            first = segmented.flush()
+            segmented.add_document(*SAMPLE_DOCUMENTS[1])
+            segmented.flush()
+            assert first not in segmented.segments
+            assert not first.index.is_memory_mapped and not os.path.exists(os.path.join(directory, first.name))
+            
+            # A segment another process is still writing is not listed in the manifest yet
+            in_progress = os.path.join(directory, "segment_999999.bin")
+            with open(in_progress, 'wb') as f:
+                f.write(b"partial")
+            reader = SegmentedIndex(directory, background_merges=False)
+            assert reader.total_documents == 2 and os.path.exists(in_progress)
+            reader.close()
+            
+            # Once the writer is done, the next writer clears what it left behind
+            writer = SegmentedIndex(directory, background_merges=False)
+            writer.add_document(*SAMPLE_DOCUMENTS[2])
+            writer.flush()
+            assert not os.path.exists(in_progress)
+            writer.close()
+            segmented.close()    
+    def test_query_during_merge(self):
+        """Test that a query keeps reading the segments a concurrent merge replaces."""
+        import threading
+        from indexer.segments import SegmentedIndex, TieredMergePolicy
+        
+        with tempfile.TemporaryDirectory() as directory:
+            segmented = SegmentedIndex(directory, merge_policy=TieredMergePolicy(2), background_merges=False)
+            segmented.add_document(*SAMPLE_DOCUMENTS[0])
+            first = segmented.flush()
+            
+            # Hold the query inside the first segment until the merge has replaced it
+            entered, proceed = threading.Event(), threading.Event()
+            search_terms = first.index.search_terms
+            def blocking_search_terms(*args):
+                entered.set()
+                proceed.wait(10)
+                return search_terms(*args)
+            first.index.search_terms = blocking_search_terms
+            
+            results = []
+            query = threading.Thread(target=lambda: results.extend(segmented.search("search engine")))
+            query.start()
+            assert entered.wait(10)
+            segmented.add_document(*SAMPLE_DOCUMENTS[3])
+            segmented.flush()
+            assert first not in segmented.segments
+            assert first.index.is_memory_mapped and os.path.exists(os.path.join(directory, first.name))
+            
+            proceed.set()
+            query.join(10)
+            assert "doc1" in [result['document_id'] for result in results]
+            # The last reader closes the retired segment and deletes its file
+            assert not first.index.is_memory_mapped and not os.path.exists(os.path.join(directory, first.name))
+            assert sorted(result['document_id'] for result in segmented.search("search engine")) == ["doc1", "doc4"]
+            segmented.close()
\ No newline at end of file
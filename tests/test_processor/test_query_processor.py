@@ -36,6 +36,20 @@ class TestQueryProcessor:
         result = validator.validate_query("search@engine")
         assert result['valid'] == False
     
+    def test_phrase_constraints(self):
+        """Test extraction of quoted phrases and NEAR/n groups."""
+        from src.processor.query_handling.init import QueryParser
+        
+        parser = QueryParser()
+        
+        constraints = parser.extract_phrase_constraints('"web crawler" python NEAR/3 tutorial "search engine"~2')
+        assert constraints == [("web crawler", 0), ("search engine", 2), ("python tutorial", 3)]
+        assert parser.extract_phrase_constraints("search engine") == []
+        
+        parsed = parser.parse_advanced_query('"web crawler" python NEAR/3 tutorial')
+        assert parsed['proximity'] == [{'terms': ['python', 'tutorial'], 'slop': 3}]
+        assert parsed['terms'] == []
+    
     def test_query_suggestions(self):
         """Test query suggestions."""
         from src.processor.query_validator import QueryValidator
@@ -61,4 +75,51 @@ class TestQueryProcessor:
         
         assert app is not None
         # Test that app has expected configuration
-        assert hasattr(app, 'config')
\ No newline at end of file
+        assert hasattr(app, 'config')
+    
+    def test_similar_endpoint(self):
+        """Test /similar against a neighbor table built in a temporary index directory."""
+        import os
+        import tempfile
+        from common.config import Config
+        from src.indexer.inverted_index import InvertedIndex
+        from src.indexer.tfidf_calculator import TFIDFCalculator
+        from src.indexer.neighbors import DocumentNeighbors
+        from src.processor.app import create_app
+        
+        config = Config()
+        index_dir = config.get('paths.data_index')
+        with tempfile.TemporaryDirectory() as directory:
+            index = InvertedIndex()
+            index.add_document("doc1", "search engine ranking", {"title": "Ranking"})
+            index.add_document("doc2", "search engine crawling", {"title": "Crawling"})
+            index.add_document("doc3", "python web frameworks", {"title": "Frameworks"})
+            index.save_index(os.path.join(directory, "inverted_index.bin"))
+            calculator = TFIDFCalculator(index)
+            calculator.calculate_tfidf()
+            calculator.save_document_matrix(os.path.join(directory, "tfidf_matrix"))
+            neighbors = DocumentNeighbors()
+            neighbors.build_table(calculator)
+            neighbors.save_table(os.path.join(directory, "neighbors"))
+            
+            config.set('paths.data_index', directory)
+            try:
+                client = create_app().test_client()
+                
+                response = client.get('/similar/doc1')
+                assert response.status_code == 200
+                results = response.get_json()['results']
+                assert [result['document_id'] for result in results] == ["doc2"]
+                assert results[0]['title'] == "Crawling" and results[0]['similarity_score'] > 0
+                assert client.get('/similar/doc1?top_k=1').get_json()['total_results'] == 1
+                
+                for top_k in (0, -1):
+                    response = client.get(f'/similar/doc1?top_k={top_k}')
+                    assert response.status_code == 400
+                    assert response.get_json()['error_code'] == 'INVALID_TOP_K'
+                
+                response = client.get('/similar/no-such-document')
+                assert response.status_code == 404
+                assert response.get_json()['error_code'] == 'UNKNOWN_DOCUMENT'
+            finally:
+                config.set('paths.data_index', index_dir)
\ No newline at end of file